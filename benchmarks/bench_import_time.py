@@ -0,0 +1,89 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" PyVal - Benchmarks - Import Time
+
+    Times importing pyval_exec/pyval_commands, and the --help/--version
+    paths of pyvalbot.py and pyval_exec.py, each in a fresh process.
+
+    With --max, it exits with 1 when any average goes over the limit,
+    so it can be used to catch import-time regressions.
+"""
+
+from __future__ import print_function
+import os.path
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+BENCHDIR = os.path.split(os.path.abspath(__file__))[0]
+PYVALDIR = os.path.split(BENCHDIR)[0]
+
+USAGESTR = """bench_import_time.py
+
+    Usage:
+        bench_import_time.py [-h] [-m ms] [-n num]
+
+    Options:
+        -h,--help           : Show this message.
+        -m ms,--max ms      : Fail if any average is over this many
+                              milliseconds.
+        -n num,--runs num   : Number of runs for each mode. Default: 20
+"""
+
+
+def time_runs(cmdargs, runs):
+    """ Run a command `runs` times from the PyVal directory.
+        Returns the average seconds per run.
+    """
+    start = time.time()
+    for _ in range(runs):
+        proc = subprocess.Popen(
+            cmdargs,
+            cwd=PYVALDIR,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        proc.communicate()
+    return (time.time() - start) / runs
+
+
+def main():
+    argd = docopt(USAGESTR)
+    try:
+        runs = int(argd['--runs'] or 20)
+        maxms = float(argd['--max'] or 0)
+    except ValueError:
+        print('Invalid number for --runs/--max: {}, {}'.format(
+            argd['--runs'],
+            argd['--max']))
+        return 1
+
+    modes = (
+        ('python only', [sys.executable, '-c', 'pass']),
+        ('import pyval_exec', [sys.executable, '-c', 'import pyval_exec']),
+        ('import pyval_commands', [
+            sys.executable,
+            '-c',
+            'import pyval_commands'
+        ]),
+        ('pyvalbot --version', [sys.executable, 'pyvalbot.py', '--version']),
+        ('pyvalbot --help', [sys.executable, 'pyvalbot.py', '--help']),
+        ('pyval_exec --help', [sys.executable, 'pyval_exec.py', '--help']),
+    )
+    print('Runs: {}'.format(runs))
+    slow = []
+    for name, cmdargs in modes:
+        avg = time_runs(cmdargs, runs) * 1000
+        print('{:>22}: {:.2f}ms per run'.format(name, avg))
+        if maxms and (avg > maxms):
+            slow.append(name)
+    if slow:
+        print('\nOver the limit ({}ms): {}'.format(maxms, ', '.join(slow)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,85 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" PyVal - Benchmarks - Rate Limiter
+
+    Times RateLimiter.allow() with many distinct nicks (100k by default),
+    using fake timestamps so the run is quick. Reports the time per check,
+    the most nicks held at once, and the nicks left at the end.
+
+    Nicks arrive at --rate commands per second, so with the default
+    limiter (one command every 3 seconds, burst of 2) only the nicks from
+    the last 3 to 6 seconds should be held.
+"""
+
+from __future__ import print_function
+import os.path
+import sys
+import time
+
+from docopt import docopt
+
+BENCHDIR = os.path.split(os.path.abspath(__file__))[0]
+sys.path.insert(0, os.path.split(BENCHDIR)[0])
+from pyval_ratelimit import RateLimiter  # noqa
+
+USAGESTR = """bench_ratelimit.py
+
+    Usage:
+        bench_ratelimit.py [-h] [-n num] [-r rate] [-R num]
+
+    Options:
+        -h,--help             : Show this message.
+        -n num,--nicks num    : Number of distinct nicks. Default: 100000
+        -R num,--repeat num   : Commands sent by each nick. Default: 3
+        -r rate,--rate rate   : Commands per second. Default: 1000
+"""
+
+
+def run(nicks, repeat, rate):
+    """ Send `repeat` commands for every nick, round-robin.
+        Returns (seconds, checks, allowed, most nicks held, nicks left).
+    """
+    limiter = RateLimiter()
+    names = ['nick{}'.format(i) for i in range(nicks)]
+    step = 1.0 / rate
+    now = 0.0
+    allowed = 0
+    biggest = 0
+    start = time.time()
+    for _ in range(repeat):
+        for name in names:
+            now += step
+            if limiter.allow(name, now=now):
+                allowed += 1
+            if len(limiter) > biggest:
+                biggest = len(limiter)
+    duration = time.time() - start
+    return duration, nicks * repeat, allowed, biggest, len(limiter)
+
+
+def main():
+    argd = docopt(USAGESTR)
+    try:
+        nicks = int(argd['--nicks'] or 100000)
+        repeat = int(argd['--repeat'] or 3)
+        rate = float(argd['--rate'] or 1000)
+    except ValueError:
+        print('Invalid number for --nicks/--repeat/--rate.')
+        return 1
+
+    duration, checks, allowed, biggest, left = run(nicks, repeat, rate)
+    print('Nicks: {}, commands each: {}, rate: {}/s'.format(
+        nicks,
+        repeat,
+        rate))
+    print('  Checks: {} ({} allowed)'.format(checks, allowed))
+    print('    Time: {:.2f}s, {:.2f}us per check'.format(
+        duration,
+        (duration / checks) * 1e6))
+    print('    Held: {} at most, {} at the end'.format(biggest, left))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,91 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" PyVal - Benchmarks - Sandbox Startup
+
+    Times pyval_sandbox.py startup for an empty snippet, with the
+    whitelisted modules imported lazily (current behavior) and eagerly
+    (every module imported up front, like older versions did).
+
+    This runs pyval_sandbox.py with the current python, not pypy-sandbox,
+    so only the relative difference matters.
+"""
+
+from __future__ import print_function
+import os.path
+import subprocess
+import sys
+import time
+
+from docopt import docopt
+
+BENCHDIR = os.path.split(os.path.abspath(__file__))[0]
+SANDBOX_FILE = os.path.join(
+    os.path.split(BENCHDIR)[0],
+    'pyval_sandbox',
+    'pyval_sandbox.py')
+sys.path.insert(0, os.path.split(SANDBOX_FILE)[0])
+from pyval_sandbox import whitelist_modules  # noqa
+
+USAGESTR = """bench_sandbox_startup.py
+
+    Usage:
+        bench_sandbox_startup.py [-h] [-n num]
+
+    Options:
+        -h,--help           : Show this message.
+        -n num,--runs num   : Number of runs for each mode. Default: 50
+"""
+
+# Imports every whitelisted module, then runs the sandbox as __main__.
+EAGER_CODE = '; '.join((
+    'import sys',
+    '[__import__(m) for m in {modules!r}]',
+    'sys.argv = [{sandbox!r}]',
+    '__name__ = "__main__"',
+    'execfile({sandbox!r})',
+))
+
+
+def time_runs(cmdargs, runs):
+    """ Run a command `runs` times with 'pass' as stdin.
+        Returns the average seconds per run.
+    """
+    start = time.time()
+    for _ in range(runs):
+        proc = subprocess.Popen(
+            cmdargs,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        proc.communicate(b'pass')
+    return (time.time() - start) / runs
+
+
+def main():
+    argd = docopt(USAGESTR)
+    try:
+        runs = int(argd['--runs'] or 50)
+    except ValueError:
+        print('Invalid number for --runs: {}'.format(argd['--runs']))
+        return 1
+
+    modes = (
+        ('python only', [sys.executable, '-c', 'pass']),
+        ('eager', [
+            sys.executable,
+            '-c',
+            EAGER_CODE.format(modules=whitelist_modules, sandbox=SANDBOX_FILE)
+        ]),
+        ('lazy', [sys.executable, SANDBOX_FILE]),
+    )
+    print('Modules: {}'.format(', '.join(whitelist_modules)))
+    print('Runs: {}'.format(runs))
+    for name, cmdargs in modes:
+        avg = time_runs(cmdargs, runs)
+        print('{:>12}: {:.2f}ms per run'.format(name, avg * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" PyVal - Benchmarks - Output Truncation
+
+    Times pyval_util.truncate_output() against the old split/rebuild
+    truncation (what safe_output() and safe_pastebin() used to do) on big
+    outputs, with the chat and paste limits.
+"""
+
+from __future__ import print_function
+import os.path
+import sys
+import time
+
+from docopt import docopt
+
+BENCHDIR = os.path.split(os.path.abspath(__file__))[0]
+sys.path.insert(0, os.path.split(BENCHDIR)[0])
+from pyval_util import truncate_output  # noqa
+
+USAGESTR = """bench_truncate.py
+
+    Usage:
+        bench_truncate.py [-h] [-s mb]
+
+    Options:
+        -h,--help           : Show this message.
+        -s mb,--size mb     : Size of each input in megabytes. Default: 100
+"""
+
+
+def old_truncate(s, maxlines=300, maxlength=400):
+    """ The old safe_pastebin() truncation, splitting everything first. """
+    lines = s.split('\n' if '\n' in s else '\\n')
+    truncatedlines = False
+    if len(lines) > maxlines:
+        lines = lines[:maxlines]
+        truncatedlines = True
+    trimmedlines = []
+    for line in lines:
+        if len(line) > maxlength:
+            trimmedlines.append('{} ..truncated ({} chars)'.format(
+                line[:maxlength],
+                maxlength))
+        else:
+            trimmedlines.append(line)
+    if truncatedlines:
+        trimmedlines.append('..truncated at {} lines.'.format(maxlines))
+    return '\n'.join(trimmedlines)
+
+
+def new_truncate(s, maxlines=300, maxlength=400):
+    """ safe_pastebin() truncation with truncate_output(). """
+    return truncate_output(
+        s,
+        maxlines=maxlines,
+        maxlinelength=maxlength,
+        sep='\n' if '\n' in s else '\\n',
+        line_marker=' ..truncated ({maxlinelength} chars)',
+        lines_marker='..truncated at {maxlines} lines.')
+
+
+def new_chat(s, maxlines=30, maxlength=140):
+    """ safe_output() truncation with truncate_output(). """
+    return truncate_output(
+        s,
+        maxlines=maxlines,
+        maxlength=maxlength,
+        joiner='\\n')
+
+
+def time_func(func, s):
+    """ Returns seconds for one call. """
+    start = time.time()
+    func(s)
+    return time.time() - start
+
+
+def main():
+    argd = docopt(USAGESTR)
+    try:
+        size = int(argd['--size'] or 100) * 1024 * 1024
+    except ValueError:
+        print('Invalid number for --size: {}'.format(argd['--size']))
+        return 1
+
+    inputs = (
+        ('short lines', ('x' * 79 + '\n') * (size // 80)),
+        ('one long line', 'x' * size),
+        ('escaped newlines', ('x' * 78 + '\\n') * (size // 80)),
+    )
+    print('Input size: {}MB'.format(size // (1024 * 1024)))
+    for name, s in inputs:
+        print('\n{}:'.format(name))
+        for funcname, func in (
+                ('old paste', old_truncate),
+                ('new paste', new_truncate),
+                ('new chat', new_chat)):
+            print('    {:>10}: {:.2f}ms'.format(
+                funcname,
+                time_func(func, s) * 1000))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Admission Scheduler
+    Decides when command functions run. Each nick gets a small queue, the
+    queues are served round-robin, and each cost class (see pyval_registry)
+    has its own limit on how many commands run at once. Evaluations are
+    limited to `workers`. Admin and instant commands skip the queues, so
+    they can't be blocked by evaluations.
+
+    Nicks belong to a group (an IRC network, when one scheduler is shared
+    by several connections). Groups take turns first, then the nicks in
+    each group, so a busy network can't starve the others.
+"""
+
+from collections import deque
+import time
+
+from twisted.internet import defer
+
+from pyval_metrics import EVAL_SECONDS
+from pyval_registry import COST_CLASSES, COST_EVALUATION, COST_NETWORK
+
+
+class AdmissionScheduler(object):
+
+    """ Admits command functions fairly between nicks.
+        submit() returns a Deferred that fires with the command's result,
+        or with a 'queue full' message when the nick has too many commands
+        waiting.
+    """
+
+    def __init__(self, workers=1, maxqueue=3, network=2):
+        """ Arguments:
+                workers   : Number of evaluations that may run at once.
+                maxqueue  : Number of commands a nick may have waiting.
+                network   : Number of network commands that may run at
+                            once.
+        """
+        self.workers = workers
+        self.maxqueue = maxqueue
+        # Commands allowed to run at once for each cost class,
+        # None means no limit (no queue).
+        self.limits = dict((cost, None) for cost in COST_CLASSES)
+        self.limits[COST_EVALUATION] = workers
+        self.limits[COST_NETWORK] = network
+        # Message sent when a nick's queue is full.
+        self.full_msg = (
+            'you already have {queued} commands waiting, '
+            'try again when they finish.'
+        )
+        # {(group, nick): deque([
+        #     (deferred, func, args, kwargs, cost, queued), ...
+        # ])}
+        # where `queued` is the time the command was submitted.
+        self.queues = {}
+        # Groups with waiting commands, in the order they are served.
+        self.order = deque()
+        # {group: deque([nick, ...])}, nicks with waiting commands in each
+        # group, in the order they are served.
+        self.nickorder = {}
+        # Number of commands running now, for each cost class.
+        self.running = dict((cost, 0) for cost in COST_CLASSES)
+        # Total admitted (ran) and rejected (queue full) commands.
+        self.admitted = 0
+        self.rejected = 0
+        # Set while _pump() is starting commands, so commands that finish
+        # right away don't start it again.
+        self.pumping = False
+
+    def _finished(self, result, cost):
+        """ Callback for a finished command, frees its slot. """
+        self.running[cost] -= 1
+        self._pump()
+        return result
+
+    def _next_job(self):
+        """ Pop the next command that can run, or return None.
+            Groups take turns, and the nicks in each group take turns.
+            Groups and nicks waiting on a full cost class keep their turn.
+        """
+        job = None
+        # Groups passed over because their nicks' cost classes are full.
+        skippedgroups = []
+        while self.order and (job is None):
+            group = self.order.popleft()
+            nicks = self.nickorder[group]
+            skipped = []
+            while nicks:
+                nick = nicks.popleft()
+                queue = self.queues[(group, nick)]
+                if not self.has_slot(queue[0][4]):
+                    skipped.append(nick)
+                    continue
+                job = queue.popleft()
+                if queue:
+                    # Back of the line for this nick's next command.
+                    nicks.append(nick)
+                else:
+                    self.queues.pop((group, nick))
+                break
+            nicks.extendleft(reversed(skipped))
+            if job is None:
+                skippedgroups.append(group)
+            elif nicks:
+                # Back of the line for this group's next command.
+                self.order.append(group)
+            else:
+                self.nickorder.pop(group)
+        self.order.extendleft(reversed(skippedgroups))
+        return job
+
+    def _pump(self):
+        """ Start waiting commands while there are free slots. """
+        if self.pumping:
+            return None
+        self.pumping = True
+        try:
+            job = self._next_job()
+            while job is not None:
+                self._run(*job)
+                job = self._next_job()
+        finally:
+            self.pumping = False
+
+    def _run(self, d, func, args, kwargs, cost, queued):
+        """ Run a command, firing `d` with its result when it finishes. """
+        if cost == COST_EVALUATION:
+            EVAL_SECONDS.observe(time.time() - queued, stage='queue')
+        self.running[cost] += 1
+        self.admitted += 1
+        funcd = defer.maybeDeferred(func, *args, **kwargs)
+        funcd.addBoth(self._finished, cost)
+        funcd.chainDeferred(d)
+
+    def has_slot(self, cost):
+        """ Returns True if a command of this cost class could run now. """
+        limit = self.limits[cost]
+        return (limit is None) or (self.running[cost] < limit)
+
+    def queued(self, nick=None, group=None):
+        """ Number of commands waiting, for one nick (in a group)
+            or for everyone.
+        """
+        if nick is not None:
+            return len(self.queues.get((group, nick), ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    def set_workers(self, workers):
+        """ Change the number of commands that may run at once.
+            Waiting commands are started if there are new free slots.
+        """
+        self.workers = workers
+        self.limits[COST_EVALUATION] = workers
+        self._pump()
+
+    def status(self):
+        """ Return a short status string for chat. """
+        running = ', '.join(
+            '{}: {}/{}'.format(cost, self.running[cost], self.limits[cost])
+            for cost in COST_CLASSES
+            if self.limits[cost] is not None)
+        return ', '.join((
+            'running {}'.format(running),
+            'queued: {} ({} nicks)'.format(self.queued(), len(self.queues)),
+            'admitted: {}'.format(self.admitted),
+            'rejected: {}'.format(self.rejected),
+        ))
+
+    def submit(self, nick, func, args=None, kwargs=None, is_admin=False,
+               cost=COST_EVALUATION, group=None):
+        """ Run a command function now, or queue it for later.
+            Returns a Deferred that fires with the function's result.
+
+            Arguments:
+                nick      : Nick that sent the command.
+                func      : Command function to call.
+                args      : List of args for the function.
+                kwargs    : Dict of keyword args for the function.
+                is_admin  : Admin commands run right away, without using
+                            a slot.
+                cost      : Cost class for the command. Classes without
+                            a limit run right away.
+                group     : Group (network) for the nick.
+        """
+        args = args or []
+        kwargs = kwargs or {}
+        if is_admin or (self.limits[cost] is None):
+            self.admitted += 1
+            return defer.maybeDeferred(func, *args, **kwargs)
+
+        queued = self.queued(nick, group=group)
+        if queued >= self.maxqueue:
+            self.rejected += 1
+            return defer.succeed(self.full_msg.format(queued=queued))
+
+        d = defer.Deferred()
+        if not queued:
+            if group not in self.nickorder:
+                self.nickorder[group] = deque()
+                self.order.append(group)
+            self.nickorder[group].append(nick)
+        self.queues.setdefault((group, nick), deque()).append(
+            (d, func, args, kwargs, cost, time.time()))
+        # Runs right away if there is a free slot, and nobody is waiting
+        # for it.
+        self._pump()
+        return d
@@ -15,22 +15,50 @@ import json
 import os
 import re
 from sys import version as sysversion
-import urllib2
+import time
 
 from easysettings import EasySettings
-from twisted.python import log
+from twisted.internet import defer, threads
+from twisted.python import failure, log
 
+from pyval_admission import AdmissionScheduler
 from pyval_exec import ExecBox, TimedOut
+from pyval_load import LoadController
+from pyval_masks import MaskRegistry
+from pyval_metrics import (
+    EVAL_SECONDS,
+    PASTE_FAILURES,
+    PASTE_SECONDS,
+    SANDBOX_KILLS,
+    SANDBOX_SPAWNS,
+)
+from pyval_paste import PASTE_URL, encode_paste, parse_response
+from pyval_pastecache import PasteCache, paste_key
+from pyval_quota import CPUQuota
+from pyval_ratelimit import RateLimiter
+from pyval_registry import (
+    COST_EVALUATION,
+    COST_NETWORK,
+    FLAG_CALLER,
+    FLAG_TRACED,
+    CommandRegistry,
+    command)
+from pyval_trace import Tracer
 from pyval_util import (
     NAME,
     VERSION,
     get_args,
     humantime,
-    timefromsecs)
+    timefromsecs,
+    truncate_output)
 
 ADMINFILE = '{}_admins.lst'.format(NAME.lower().replace(' ', '-'))
 BANFILE = '{}_banned.lst'.format(NAME.lower().replace(' ', '-'))
-HELPFILE = '{}_help.json'.format(NAME.lower().replace(' ', '-'))
+PASTECACHEFILE = '{}_pastes.json'.format(NAME.lower().replace(' ', '-'))
+# Default file for trace dumps (Chrome trace-event format).
+TRACEFILE = '{}_traces.json'.format(NAME.lower().replace(' ', '-'))
+# Config options for the CPU quotas, applied when set with configset.
+QUOTA_OPTIONS = ('quotanick', 'quotachan', 'quotawindow')
 
 # Parses common string for True/False values.
 true_values = ('true', 'on', 'yes', '1')
@@ -81,24 +109,15 @@ def block_dict_val(data, blockedlst, value=None):
     return newdata
 
 
-def load_json_object(filename):
-    """ Loads an object from a json file,
-        returns {} on failure.
+def network_file(filename, network=None):
+    """ Return a network's own file for admins/bans, like
+        pyval_admins.freenode.lst for pyval_admins.lst.
+        Without a network name (a single network), it is unchanged.
     """
-    try:
-        with open(filename, 'r') as fjson:
-            rawjson = fjson.read()
-    except (OSError, IOError) as exio:
-        log.msg('\nError loading json from: {}\n{}'.format(filename, exio))
-        return {}
-
-    try:
-        jsonobj = json.loads(rawjson)
-    except Exception as ex:
-        log.msg('\nError parsing json from: {}\n{}'.format(filename, ex))
-        return {}
-
-    return jsonobj
+    if not network:
+        return filename
+    base, ext = os.path.splitext(filename)
+    return '{}.{}{}'.format(base, re.sub(r'[^\w.-]', '_', network), ext)
 
 
 def parse_bool(s):
@@ -113,7 +132,7 @@ def parse_true(s):
     return s.lower() in true_values
 
 
-def pasteit(data):
+def pasteit(data, timeout=15):
     """ Submit a paste to welbornprod.com/paste ...
         data should be a dict with at least:
         {'content': <paste content>}
@@ -125,73 +144,70 @@ def pasteit(data):
          'private': True,
          'onhold': True,
          }
+
+        This blocks, it is only used without a reactor (like the tests).
+        The bot uses pyval_paste.PasteClient.
     """
-    pasteurl = 'https://welbornprod.com/paste/api/submit'
-    try:
-        newdata = json.dumps(data)
-    except Exception as exenc:
-        log.msg('Unable to encode paste data: {}\n{}'.format(data, exenc))
+    # Only needed for pastes, so it isn't imported with pyval_commands.
+    import urllib2
+    newdata = encode_paste(data)
+    if newdata is None:
         return None
 
     req = urllib2.Request(
-        pasteurl,
-        data=newdata.encode('utf-8'),
+        PASTE_URL,
+        data=newdata,
         headers={
             'User-Agent': '{} v. {}'.format(NAME, VERSION),
             'Content-Type': 'application/json; charset=utf-8',
             'Content-Encoding': 'utf-8'
         })
     try:
-        con = urllib2.urlopen(req)
+        con = urllib2.urlopen(req, timeout=timeout)
     except Exception as exopen:
-        log.msg('Unable to open paste url: {}\n{}'.format(pasteurl, exopen))
+        log.msg('Unable to open paste url: {}\n{}'.format(PASTE_URL, exopen))
         return None
     try:
         resp = con.read()
     except Exception as exread:
         log.msg(
             'Unable to read paste response from {}\n{}'.format(
-                pasteurl,
+                PASTE_URL,
                 exread))
         return None
-    try:
-        respdata = json.loads(resp)
-    except Exception as exjson:
-        log.error('Unable to decode JSON from {}\n{}'.format(
-            pasteurl,
-            exjson))
-        return None
 
-    status = respdata.get('status', 'error')
-    if status == 'error':
-        # Server responded with json error response.
-        errmsg = respdata.get('message', '<no msg>')
-        log.msg('Paste site responded with error: {}'.format(errmsg))
+    return parse_response(
+        resp,
         # Little something for the unit tests..
-        # The error is most likely 'too many pastes in a row',
-        # just return the error msg so the test will pass and be printed.
-        if data.get('author', '').startswith('<pyvaltest>'):
-            return 'TESTERROR: {}'.format(errmsg)
-        # Paste site errored, no url given to the chat user.
-        return None
+        testing=data.get('author', '').startswith('<pyvaltest>'))
 
-    # Good response.
-    suburl = respdata.get('url', None)
-    if suburl:
-        finalurl = 'https://welbornprod.com{}'.format(suburl)
-        return finalurl
 
-    # No url found to respond with.
-    return None
+class Reply(str):
+
+    """ A command's chat reply, with a follow-up message to send to the
+        same place later. `followup` is a deferred that fires with the
+        follow-up message (or None for no message).
+    """
+
+    followup = None
 
 
 class AdminHandler(object):
 
     """ Handles admin functions like bans/admins/settings. """
 
-    def __init__(self, help_info=None):
+    def __init__(self, network=None, scheduler=None, pastecache=None):
+        """ Arguments:
+                network     : Name of the IRC network for this handler.
+                scheduler   : AdmissionScheduler shared with the other
+                              networks, a new one is used if not given.
+                pastecache  : PasteCache shared with the other networks,
+                              a new one is used if not given.
+        """
         # These are overwritten by the PyValIRCProtocol()
         self.quit = None
+        self.reload_config = None
+        self.refresh_config = None
         self.sendLine = None
         self.ctcpMakeQuery = None
         self.do_action = None
@@ -203,6 +219,7 @@ class AdminHandler(object):
         self.channels = []
 
         # These are all set by PyValIRCProtocol after config is loaded.
+        self.network = network
         self.argd = {}
         self.cmdchar = '*'
         self.config = {}
@@ -213,47 +230,82 @@ class AdminHandler(object):
 
         # Whether or not to use PyVal.ExecBoxs blacklist.
         self.blacklist = False
+        # Step budget (traced calls/lines) for evaluations, 0 disables it.
+        self.eval_steps = 0
+        # Modules available to evaluations (list of names),
+        # None uses the pyval_sandbox whitelist.
+        self.eval_modules = None
         # Monitoring options. (privmsgs, all recvline, include ips)
         self.monitor = False
         self.monitordata = False
         self.monitorips = False
         # If this is true, privmsgs are forwarded to the admins.
         self.forwardmsgs = True
-        # List of admins/banned
+        # Admins/banned, nicks or nick!user@host masks (MaskRegistry).
+        # Each network has its own, nicks aren't the same person on
+        # another network.
         self.admins = self.admins_load()
         self.banned = self.ban_load()
+        # Ban warnings: {nick: {'last': time.time(), 'count': warnings}}
+        # Warnings are forgotten after banwarn_expire seconds.
         self.banned_warned = {}
-        # Time of last response sent (rate-limiting/bans)
-        self.last_handle = None
         # The msg that was last sent.
         self.last_msg = None
-        # Last nick responded to (rate-limiting/bans)
+        # Last nick/channel a msg was sent to (dupe-blocking)
         self.last_nick = None
         # Last command handled (dupe-blocking/rate-limiting)
         self.last_command = None
-        # Whether or not response rate-limiting is enabled.
+        # Whether or not response rate-limiting is enabled. Load shedding
+        # (self.load) doesn't depend on it.
         self.limit_rate = True
-        # Time in between commands required for a user.
-        # If the user sends multiple commands before this limit is reached,
-        # their 'ban-warned' count increases.
-        self.msg_timelimit = 3
+        # Per-nick command rate, 2 commands at once and then one every
+        # 3 seconds. Nicks that send commands faster than this get a
+        # 'ban-warning'.
+        self.ratelimit = RateLimiter(interval=3, burst=2)
         # Number of 'ban-warns' before perma-banning a nick.
         self.banwarn_limit = 3
+        # Seconds without a warning before a nick's warnings are forgotten.
+        self.banwarn_expire = 600
         # Current load, and lock required to change its value.
         self.handlingcount = 0
         self.handlinglock = None
         # Number of handled requests
         self.handled = 0
-        # Help dict {'user': {'cmd': {'args': null, {'desc': 'mycommand'}}},
-        #            'admin': <same as 'user' key> }
-        # Tests can pass a preloaded help_info in.
-        self.help_info = help_info if help_info else self.load_help()
-        if self.help_info:
-            if (not help_info):
-                # Print a message if help was loaded from file
-                log.msg('Help info file loaded: {}'.format(HELPFILE))
-        else:
-            log.msg('No help commands will be available.')
+        # Number of evaluations that may run at once (thread pool workers).
+        # Set with set_workers().
+        self.workers = 1
+        # Decides when commands run, with fair per-network and per-nick
+        # queues.
+        if scheduler is None:
+            scheduler = AdmissionScheduler(workers=self.workers)
+        self.scheduler = scheduler
+        # Load state (shorter timeouts, no pastes, shedding) based on load.
+        # PyValIRCProtocol samples it periodically.
+        self.load = LoadController(workers=self.workers)
+        # Outgoing reply queue (pyval_sendq.SendQueue).
+        # Set by PyValIRCProtocol.
+        self.sendq = None
+        # Non-blocking paste client (pyval_paste.PasteClient).
+        # Set by PyValIRCProtocol, pastes block without it (tests).
+        self.paster = None
+        # Paste urls by content, so repeated results aren't pasted again.
+        if pastecache is None:
+            pastecache = PasteCache(PASTECACHEFILE)
+        self.pastecache = pastecache
+        # Recent command traces, for latency breakdowns.
+        self.tracer = Tracer()
+        # Channels spread across several connections (pyval_shards).
+        # Set by PyValIRCProtocol when there is more than one.
+        self.shards = None
+        # Log pipeline (pyval_logging.LogPipeline).
+        # Set by PyValIRCProtocol.
+        self.logger = None
+        # CPU-time budgets for evaluations, per nick and per channel.
+        # Nicks over budget are refused, channels over budget get the short
+        # timeout. Set with the quotanick, quotachan, and quotawindow config
+        # options.
+        self.quota_nick = CPUQuota(limit=30, window=300)
+        self.quota_chan = CPUQuota(limit=120, window=300)
 
     def admins_add(self, nick):
         """ Add an admin to the list and save it. """
@@ -261,10 +313,7 @@ class AdminHandler(object):
             return 'already an admin: {}'.format(nick)
 
         self.admins.add(nick)
-        if self.admins_save():
-            return 'added admin: {}'.format(nick)
-        else:
-            return 'unable to save admins, {} is not permanent.'.format(nick)
+        return 'added admin: {}'.format(nick)
 
     def admins_list(self):
         """ List admins. """
@@ -272,46 +321,21 @@ class AdminHandler(object):
 
     def admins_load(self):
         """ Load admins from list. """
-
         # admin is cj until the admins file says otherwise.
-        admins = {'cjwelborn'}
-
-        if not os.path.exists(ADMINFILE):
-            log.msg('No admins list, defaults will be used.')
-            return admins
-
-        try:
-            with open(ADMINFILE) as fread:
-                admins = set(l.strip() for l in fread.readlines())
-        except EnvironmentError as ex:
-            log.msg('Unable to load admins list:\n{}'.format(ex))
-            pass
-
+        filename = network_file(ADMINFILE, self.network)
+        admins = MaskRegistry(filename, defaults=('cjwelborn',))
+        if not os.path.exists(filename):
+            log.msg('No admins list, defaults will be used: {}'.format(
+                filename))
         return admins
 
     def admins_remove(self, nick):
         """ Remove an admin from the list and save it. """
-        if nick in self.admins:
-            self.admins.remove(nick)
-            if self.admins_save():
-                msg = 'removed admin: {nick}'
-            else:
-                msg = 'unable to save admins, {nick} will persist on restart'
-            return msg.format(nick=nick)
+        if self.admins.remove(nick):
+            return 'removed admin: {}'.format(nick)
 
         return 'not an admin: {}'.format(nick)
 
-    def admins_save(self):
-        """ Save current admins list. """
-        try:
-            with open(ADMINFILE, 'w') as f:
-                f.write('\n'.join(sorted(self.admins)))
-                f.write('\n')
-                return True
-        except (IOError, OSError) as ex:
-            log.msg('Error saving admin list:\n{}'.format(ex))
-            return False
-
     def ban_add(self, nick, permaban=False):
         """ Add a warning to a nick, after 3 warnings ban them for good. """
 
@@ -325,15 +349,15 @@ class AdminHandler(object):
             return 'no more.'
 
         # Auto banner.
-        if nick in self.banned_warned.keys():
+        self.ban_expire_warnings(nick=nick)
+        if nick in self.banned_warned:
             # Increment the warning count.
-            self.banned_warned[nick]['last'] = datetime.now()
+            self.banned_warned[nick]['last'] = time.time()
             self.banned_warned[nick]['count'] += 1
             newcount = self.banned_warned[nick]['count']
             if newcount == self.banwarn_limit:
                 # No more warnigns, permaban.
-                self.banned.append(nick)
-                self.ban_save()
+                self.banned.add(nick)
                 return 'no more.'
             elif newcount == (self.banwarn_limit - 1):
                 # last warning.
@@ -341,80 +365,61 @@ class AdminHandler(object):
 
         else:
             # First warning.
-            self.banned_warned[nick] = {'last': datetime.now(), 'count': 1}
+            self.banned_warned[nick] = {'last': time.time(), 'count': 1}
 
         # Warning count increased, not last warning or permaban yet.
         return 'slow down with your commands.'
 
     def ban_addperma(self, nick):
-        """ Add a permanently banned nick. """
-
-        banned = []
-        if isinstance(nick, (list, tuple)):
-            for n in nick:
-                if (n not in self.admins) and (n not in self.banned):
-                    self.banned.append(n)
-                    banned.append(n)
-        else:
-            if (nick not in self.admins) and (nick not in self.banned):
-                self.banned.append(nick)
-                banned.append(n)
-
-        saved = self.ban_save() if banned else False
-        if saved:
-            return banned
-        else:
-            return []
+        """ Add permanently banned nicks/masks (a nick or list of nicks).
+            Masks that would cover an admin are refused.
+            Returns a list of the newly banned ones.
+        """
+        nicks = nick if isinstance(nick, (list, tuple)) else [nick]
+        return [
+            n for n in nicks
+            if (not self.ban_covers_admin(n)) and self.banned.add(n)
+        ]
+
+    def ban_covers_admin(self, mask):
+        """ Returns True if a ban nick/mask matches an admin entry, or an
+            admin entry matches it (like '*', '*!*@*', or '*@adminhost').
+        """
+        if mask in self.admins:
+            return True
+        ban = MaskRegistry()
+        ban.add(mask, save=False)
+        return any(entry in ban for entry in self.admins)
+
+    def ban_expire_warnings(self, nick=None, now=None):
+        """ Forget ban warnings older than banwarn_expire seconds,
+            for one nick or for everyone.
+        """
+        if now is None:
+            now = time.time()
+        oldest = now - self.banwarn_expire
+        nicks = list(self.banned_warned) if nick is None else [nick]
+        for warnednick in nicks:
+            warning = self.banned_warned.get(warnednick, None)
+            if warning and (warning['last'] <= oldest):
+                self.banned_warned.pop(warnednick)
 
     def ban_load(self):
-        """ Load banned nicks if any are available. """
-
-        banned = []
-        if not os.path.isfile(BANFILE):
-            return banned
-
-        try:
-            with open(BANFILE) as fread:
-                banned = [l.strip('\n') for l in fread.readlines()]
-        except (IOError, OSError) as exos:
-            log.msg('Unable to load banned file: {}\n{}'.format(
-                BANFILE,
-                exos))
-        return banned
+        """ Load banned nicks/masks if any are available. """
+        return MaskRegistry(network_file(BANFILE, self.network))
 
     def ban_remove(self, nicklst):
-        """ Remove nicks from the banned list. """
+        """ Remove nicks/masks from the banned list. """
         if not nicklst:
             return []
 
         removed = []
         for nick in nicklst:
-            if nick in self.banned:
-                while nick in self.banned:
-                    self.banned.remove(nick)
+            if self.banned.remove(nick):
                 # Reset ban warnings.
-                if nick in self.banned_warned.keys():
-                    self.banned_warned[nick] = {'last': datetime.now(),
-                                                'count': 0}
+                self.banned_warned.pop(nick, None)
                 removed.append(nick)
-
-        saved = self.ban_save()
-        if saved:
-            return removed
-        else:
-            return []
-
-    def ban_save(self):
-        """ Load perma-banned list. """
-        try:
-            with open(BANFILE, 'w') as f:
-                f.write('\n'.join(self.banned))
-                return True
-        except (IOError, OSError) as exos:
-            log.msg('Unable to save banned file: {}\n{}'.format(
-                BANFILE,
-                exos))
-        return False
+        return removed
 
     def get_uptime(self):
         """ Return the current uptime in seconds for this instance.
@@ -422,6 +427,25 @@ class AdminHandler(object):
         """
         return int((datetime.now() - self.starttime).total_seconds())
 
+    def apply_quota_config(self):
+        """ Set the CPU quota limits from config.
+            Bad values are logged, and the current values are kept.
+        """
+        for option, quota, attr in (
+                ('quotanick', self.quota_nick, 'limit'),
+                ('quotachan', self.quota_chan, 'limit'),
+                ('quotawindow', self.quota_nick, 'window'),
+                ('quotawindow', self.quota_chan, 'window')):
+            val = self.config.get(option, None)
+            if val is None:
+                continue
+            try:
+                val = int(val)
+            except (TypeError, ValueError):
+                log.msg('Invalid number for {}: {!r}'.format(option, val))
+                continue
+            setattr(quota, attr, max(val, 0))
+
     def handling_decrease(self):
         if self.handlingcount > 0:
             self.handlinglock.acquire()
@@ -443,11 +467,6 @@ class AdminHandler(object):
                       '{} {}'.format(self.nickname, pw))
         return None
 
-    def load_help(self):
-        """ Load help from json file. """
-
-        return load_json_object(HELPFILE)
-
     def op_request(self, channel=None, nick=None, reverse=False):
         """ op or deop a user through ChanServ.
             Arguments:
@@ -494,6 +513,12 @@ class AdminHandler(object):
             # No items to save.
             return 0
 
+    def set_workers(self, workers):
+        """ Set the number of evaluations that may run at once. """
+        self.workers = max(int(workers), 1)
+        self.scheduler.set_workers(self.workers)
+        self.load.workers = self.workers
+
     def sendmsg_tochans(self, msgtext):
         """ Send the same message to all channels pyvalbot is in. """
         for chan in self.channels:
@@ -510,7 +535,7 @@ class AdminHandler(object):
             msg = '{}'.format(msgtext)
 
         if self.forwardmsgs:
-            for adminnick in self.admins:
+            for adminnick in self.admins.nicks():
                 # Don't send the admin's own message to them.
                 if fromnick != adminnick:
                     self.sendmsg(adminnick, msg)
@@ -553,23 +578,23 @@ class CommandHandler(object):
                                      reactor_=self.reactor,
                                      task_=self.task,
                                      adminhandler=self.admin)
+        # Commands are looked up here, it is only built once.
+        self.registry = CommandRegistry(self.commands)
+        self.commands.registry = self.registry
 
     def parse_command(self, msg, username=None):
-        """ Parse a message, return corresponding command function if found,
-            otherwise, return None.
+        """ Parse a message, return the corresponding (callable) Command
+            if found, otherwise, return None.
+            username can be a nick, or nick!user@host for admin masks.
         """
-        command, sep, rest = msg.lstrip(self.admin.cmdchar).partition(' ')
-        # Retrieve function related to this command.
-        func = getattr(self.commands, 'cmd_' + command, None)
+        cmdname, sep, rest = msg.lstrip(self.admin.cmdchar).partition(' ')
         # Check admin command.
         if username and (username in self.admin.admins):
-            adminfunc = getattr(self.commands, 'admin_' + command, None)
-            if adminfunc:
-                # return callable admin command.
-                return adminfunc
+            admincmd = self.registry.get(cmdname, role='admin')
+            if admincmd:
+                return admincmd
 
-        # Return callable function for command.
-        return func
+        return self.registry.get(cmdname, role='user')
 
     def parse_data(self, user, channel, msg):
         """ Parse raw data from privmsg().
@@ -592,7 +617,9 @@ class CommandHandler(object):
                 userstr = '{} ({})'.format(username, ipstr)
             else:
                 userstr = username
-            log.msg('[{}]\t{}:\t{}'.format(channel, userstr, msg))
+            log.msg(
+                '[{}]\t{}:\t{}'.format(channel, userstr, msg),
+                category='monitor')
         elif (channel == self.admin.nickname):
             if not msg.startswith(self.admin.cmdchar):
                 # normal private msg sent directly to pyval.
@@ -601,7 +628,7 @@ class CommandHandler(object):
 
         # Handle message
         if msg.startswith(self.admin.cmdchar):
-            return self.parse_command(msg, username=username)
+            return self.parse_command(msg, username=user)
 
         # Not a command.
         return None
@@ -640,22 +667,36 @@ class CommandFuncs(object):
         self.defer = kwargs.get('defer_', None)
         self.reactor = kwargs.get('reactor_', None)
         self.task = kwargs.get('task_', None)
-
-    # Commands (must begin with cmd)
+        # CommandRegistry for these functions, set by CommandHandler.
+        self.registry = None
+
+    # Commands (must begin with admin_ or cmd_, see pyval_registry)
+    @command(
+        args='<nick | nick!user@host>',
+        desc='Add an administrator by nick, or by mask (* and ? are '
+             'wildcards).')
     def admin_adminadd(self, rest, nick=None):
         """ Add an admin to the list. """
         return self.admin.admins_add(rest)
 
+    @command(
+        args='[cmd]',
+        desc='Show help for an admin command, or list all cmds.')
     def admin_adminhelp(self, rest, nick=None):
         """ Build list of admin commands. """
         self.admin.sendmsg(
             nick,
             self.get_help(role='admin', cmdname=rest, usernick=None))
 
+    @command(
+        desc='List all current administrators.')
     def admin_adminlist(self, rest, nick=None):
         """ List current admins. """
         return self.admin.admins_list()
 
+    @command(
+        args='<msg>',
+        desc='Send a msg to all pyvalbot admins.')
     def admin_adminmsg(self, rest, nick=None):
         """ Send a message to all pyvalbot admins. """
         if not rest:
@@ -664,25 +705,32 @@ class CommandFuncs(object):
         self.admin.sendmsg_toadmins(rest)
         return None
 
+    @command(
+        desc='Reload admins list from disk.')
     def admin_adminreload(self, rest, nick=None):
         """ Reloads admin list for IRCClient. """
         # Really need to reorganize things, this is getting ridiculous.
-        self.admin.admins_load()
+        self.admin.admins = self.admin.admins_load()
         return 'admins loaded.'
 
-    def admin_adminrem(self, rest, nick=None):
-        """ Alias for admin_adminremove """
-        return self.admin_adminremove(rest)
-
+    @command(
+        args='<nick | nick!user@host>',
+        desc='Remove an administrator by nick or mask.',
+        aliases=('adminrem',))
     def admin_adminremove(self, rest, nick=None):
         """ Remove an admin from the handlers list. """
         return self.admin.admins_remove(rest)
 
+    @command(
+        args='<nick | nick!user@host> ...',
+        desc='Ban nicks or masks from using the bot. * and ? are wildcards, '
+             'like *!*@example.com.')
     def admin_ban(self, rest, nick=None):
         """ Ban a nick. """
 
         if not rest:
-            return 'usage: {}ban <nick>'.format(self.admin.cmdchar)
+            return 'usage: {}ban <nick | nick!user@host>'.format(
+                self.admin.cmdchar)
 
         nicks = rest.split(' ')
         alreadybanned = [n for n in nicks if n in self.admin.banned]
@@ -702,6 +750,8 @@ class CommandFuncs(object):
             msg.append('unable to ban: {}'.format(', '.join(notbanned)))
         return ', '.join(msg)
 
+    @command(
+        desc='List all currently banned nicks.')
     def admin_banned(self, rest, nick=None):
         """ list banned. """
         banned = ', '.join(sorted(self.admin.banned))
@@ -710,10 +760,13 @@ class CommandFuncs(object):
         else:
             return 'nobody is banned.'
 
+    @command(
+        desc='Show ban warnings count.')
     def admin_banwarns(self, rest, nick=None):
         """ list ban warnings. """
 
         banwarns = []
+        self.admin.ban_expire_warnings()
         for warnednick in sorted(self.admin.banned_warned.keys()):
             count = self.admin.banned_warned[warnednick]['count']
             banwarns.append('{}: {}'.format(warnednick, count))
@@ -723,6 +776,10 @@ class CommandFuncs(object):
         else:
             return 'no ban warnings issued.'
 
+    @command(
+        args='[on, off, ?]',
+        desc="Change pyvalexec's blacklist option, or show the current "
+             "value.")
     def admin_blacklist(self, rest, nick=None):
         """ Toggle the blacklist option """
         if rest == '?' or (not rest):
@@ -740,10 +797,15 @@ class CommandFuncs(object):
                 return 'invalid value for blacklist option (true/false).'
         return 'blacklist enabled: {}'.format(self.admin.blacklist)
 
+    @command(
+        desc='Show current channels that pyval is in.')
     def admin_channels(self, rest, nick=None):
         """ Return a list of current channels for the bot. """
         return 'current channels: {}'.format(', '.join(self.admin.channels))
 
+    @command(
+        args='<msg>',
+        desc='Send a msg to all channels pyvalbot is in.')
     def admin_chanmsg(self, rest, nick=None):
         """ Send a msg to all channels pyvalbot is in. """
         if not rest:
@@ -752,6 +814,10 @@ class CommandFuncs(object):
         self.admin.sendmsg_tochans(rest)
         return None
 
+    @command(
+        args='<option>',
+        desc="Get a config option's value. Certain options are hidden from "
+             "chat.")
     def admin_configget(self, rest, nick=None):
         """ Retrieve value for a config setting. """
         if not rest:
@@ -769,11 +835,23 @@ class CommandFuncs(object):
         # Value is ok to send to chat.
         return '{}: {}'.format(rest, val)
 
+    @command(
+        desc='List current config.')
     def admin_configlist(self, rest, nick=None):
         """ List current config. Filters certain items from chat. """
 
         return self.admin_getattr('admin.config')
 
+    @command(
+        desc='Reload the config file, and apply the changed settings.')
+    def admin_configreload(self, rest, nick=None):
+        """ Reload the config file, without restarting. """
+        if self.admin.reload_config is None:
+            return 'config reloading is not available.'
+        return self.admin.reload_config()
+
+    @command(
+        desc='Save current command-line options to permanent config.')
     def admin_configsave(self, rest, nick=None):
         """ Save the current config (cmdline options) to disk. """
         saved = self.admin.save_config()
@@ -782,6 +860,10 @@ class CommandFuncs(object):
 
         return 'saved {} new config settings.'.format(saved)
 
+    @command(
+        args='<option> <value>',
+        desc="Set a config option's value. String values only for now. "
+             "Remove options by passing - as the value.")
     def admin_configset(self, rest, nick=None):
         """ Set value for a config setting. """
 
@@ -811,11 +893,20 @@ class CommandFuncs(object):
                 return 'bad int value: {}'.format(val[1:-1])
 
         if self.admin.config.setsave(opt, val):
+            if opt in QUOTA_OPTIONS:
+                self.admin.apply_quota_config()
+            if self.admin.refresh_config is not None:
+                # Apply it live, like a config reload.
+                self.admin.refresh_config()
             return 'saved {}: {}'.format(opt, val)
 
         # Failure.
         return 'unable to save: {}: {}'.format(opt, val)
 
+    @command(
+        args='[channel] [nick]',
+        desc='Request deop from ChanServ. Default channel is ##<botnick>. '
+             'Default nick is the bot.')
     def admin_deop(self, rest, nick=None):
         """ Request deop from ChanServ on behalf of the bot. """
         if not rest:
@@ -830,11 +921,18 @@ class CommandFuncs(object):
 
         self.admin.op_request(channel=chan, nick=nick, reverse=True)
 
+    @command(
+        args='[channel]',
+        desc='Shortcut to `deop [channel] <yournick>')
     def admin_deopme(self, rest, nick=None):
         """ Request deop from the bot (if the bot is an op itself) """
         chan = rest if rest.startswith('#') else None
         self.admin.op_request(channel=chan, nick=nick, reverse=True)
 
+    @command(
+        args='<attribute>',
+        desc='Retrieve the value of a pyval CommandFuncs attribute. (ex: '
+             'admins.channels)')
     def admin_getattr(self, rest, nick=None):
         """ Return value for attribute. """
         if not rest:
@@ -856,15 +954,19 @@ class CommandFuncs(object):
             attrval = '{} ...truncated'.format(attrval[:250])
         return '{} = {}'.format(rest, attrval)
 
-    def admin_id(self, rest, nick=None):
-        """ Shortcut for admin_identify """
-        return self.admin.identify(rest)
-
+    @command(
+        args='<password>',
+        desc='Identify with NickServ.',
+        aliases=('id',))
     def admin_identify(self, rest, nick=None):
         """ Identify with nickserv, expects !identify password """
 
         return self.admin.identify(rest)
 
+    @command(
+        args='<channels>',
+        desc='Join a channel or multiple channels (using a comma-separated '
+             'list)')
     def admin_join(self, rest, nick=None):
         """ Join a channel as pyval. """
         if ',' in rest:
@@ -882,6 +984,10 @@ class CommandFuncs(object):
             if chan in self.admin.channels:
                 # already in that channel, send a msg in a moment.
                 alreadyin.append(chan)
+            elif self.admin.shards is not None:
+                # The connection that owns the channel joins it.
+                log.msg('Joining: {}'.format(chan))
+                self.admin.shards.add_channels([chan])
             else:
                 log.msg('Joining: {}'.format(chan))
                 self.admin.sendLine('JOIN {}'.format(chan))
@@ -894,6 +1000,9 @@ class CommandFuncs(object):
         # (you can look at the log/stdout)
         return None
 
+    @command(
+        args='[on, off, ?]',
+        desc="Change pyval's limitrate option, or show the current value.")
     def admin_limitrate(self, rest, nick=None):
         """ Toggle limit_rate """
         if rest == '?' or (not rest):
@@ -911,6 +1020,54 @@ class CommandFuncs(object):
                 return 'invalid value for limitrate option (true/false).'
         return 'limitrate enabled: {}'.format(self.admin.limit_rate)
 
+    @command(
+        desc='Show the current load state, the last state change, and the '
+             'command queues.')
+    def admin_load(self, rest, nick=None):
+        """ Show the current load state, and the admission queues. """
+        return '{} | {}'.format(
+            self.admin.load.status(),
+            self.admin.scheduler.status())
+
+    @command(
+        desc='Show the log pipeline: queued, written, dropped, and sampled '
+             'out log messages, and log file rotations.')
+    def admin_logs(self, rest, nick=None):
+        """ Show the log pipeline state. """
+        if self.admin.logger is None:
+            return 'no log pipeline.'
+        return self.admin.logger.status()
+
+    @command(
+        args='[nick | #channel]',
+        desc='Show CPU quota use for a nick or channel, or the top users. '
+             'Limits are set with the quotanick, quotachan, and quotawindow '
+             'config options.')
+    def admin_quota(self, rest, nick=None):
+        """ Show CPU quota usage for a nick/channel, or the top users. """
+        if rest:
+            quota = self.admin.quota_chan
+            if not rest.startswith('#'):
+                quota = self.admin.quota_nick
+            return quota.status(rest)
+
+        statuslst = []
+        for label, quota in (
+                ('nicks', self.admin.quota_nick),
+                ('channels', self.admin.quota_chan)):
+            top = ', '.join(
+                '{} {:.2f}s'.format(key, secs)
+                for key, secs in quota.top())
+            statuslst.append('{} (limit {}s/{}s): {}'.format(
+                label,
+                quota.limit,
+                quota.window,
+                top or 'none'))
+        return ' | '.join(statuslst)
+
+    @command(
+        args='<channel> <text>',
+        desc='Make pyval perform an irc action (/ME <text>) in a channel.')
     def admin_me(self, rest, nick=None):
         """ Perform an irc action, /ME <channel> <text> """
         cmdargs = rest.split()
@@ -925,6 +1082,9 @@ class CommandFuncs(object):
         self.admin.do_action(channel, text)
         return None
 
+    @command(
+        args='<target> <message>',
+        desc='Send a message to a nick or channel as pyvalbot.')
     def admin_msg(self, rest, nick=None):
         """ Send a private msg, expects !msg nick/channel message """
 
@@ -936,6 +1096,10 @@ class CommandFuncs(object):
         self.admin.sendmsg(target, msgtext)
         return None
 
+    @command(
+        args='[channel] [nick]',
+        desc='Request ops from ChanServ. Default channel is ##<botnick>. '
+             'Default nick is the bot.')
     def admin_op(self, rest, nick=None):
         """ Request ops from ChanServ on behalf of the bot. """
         if not rest:
@@ -950,11 +1114,18 @@ class CommandFuncs(object):
 
         self.admin.op_request(channel=chan, nick=nick)
 
+    @command(
+        args='[channel]',
+        desc='Shortcut to `op [channel] <yournick>')
     def admin_opme(self, rest, nick=None):
         """ Request ops from the bot (if the bot is an op itself) """
         chan = rest if rest.startswith('#') else None
         self.admin.op_request(channel=chan, nick=nick)
 
+    @command(
+        args='<channels>',
+        desc='Part/Leave a channel or multiple channels (using a comma- '
+             'separated list)')
     def admin_part(self, rest, nick=None):
         """ Leave a channel as pyval. """
         if ',' in rest:
@@ -969,7 +1140,12 @@ class CommandFuncs(object):
             if not chan.startswith('#'):
                 chan = '#{}'.format(chan)
 
-            if chan in self.admin.channels:
+            if self.admin.shards is not None and (
+                    chan in self.admin.shards.channels):
+                # The connection that owns the channel leaves it.
+                log.msg('Parting from: {}'.format(chan))
+                self.admin.shards.remove_channels([chan])
+            elif chan in self.admin.channels:
                 log.msg('Parting from: {}'.format(chan))
                 self.admin.sendLine('PART {}'.format(chan))
             else:
@@ -984,6 +1160,8 @@ class CommandFuncs(object):
         # (you can check the log/stdout)
         return None
 
+    @command(
+        desc='Part/Leave all current channels.')
     def admin_partall(self, rest, nick=None):
         """ Part all current channels.
             The only way to re-join is to send a private msg to pyval,
@@ -992,6 +1170,20 @@ class CommandFuncs(object):
 
         return self.admin_part(','.join(self.admin.channels))
 
+    @command(
+        desc='Show the paste client: sent, failed, and skipped pastes, '
+             'retries, the circuit breaker state, and the paste cache.')
+    def admin_paste(self, rest, nick=None):
+        """ Show the paste client and cache state. """
+        if self.admin.paster is None:
+            status = 'no paste client'
+        else:
+            status = self.admin.paster.status()
+        return '{}, {}'.format(status, self.admin.pastecache.status())
+
+    @command(
+        args='<message>',
+        desc='Make pyvalbot respond to you with a message.')
     def admin_say(self, rest, nick=None):
         """ Send chat message back to person. """
         if not rest:
@@ -999,6 +1191,9 @@ class CommandFuncs(object):
         log.msg('Saying: {}'.format(rest))
         return rest
 
+    @command(
+        args='<data>',
+        desc='Send a raw line to the irc server as pyvalbot.')
     def admin_sendline(self, rest, nick=None):
         """ Send raw line as pyval. """
         if rest:
@@ -1006,6 +1201,19 @@ class CommandFuncs(object):
             self.admin.sendLine(rest)
         return None
 
+    @command(
+        desc='Show the outgoing reply queue: waiting replies, merged '
+             'replies, flood backoffs, and send latency.')
+    def admin_sendq(self, rest, nick=None):
+        """ Show the outgoing reply queue state. """
+        if self.admin.sendq is None:
+            return 'no send queue.'
+        return self.admin.sendq.status()
+
+    @command(
+        args='<attribute> <val>',
+        desc='Set a pyval CommandFuncs attribute. (ex: !setattr '
+             'admin.blacklist True)')
     def admin_setattr(self, rest, nick=None):
         """ Set an attribute to self or children of self by string.
             Example:
@@ -1050,6 +1258,17 @@ class CommandFuncs(object):
             newval = '{} ...truncated'.format(newval[:250])
         return '{} = {}'.format(attrstr, newval)
 
+    @command(
+        desc='Show the connections that channels are spread across, and '
+             'how many channels each one is in.')
+    def admin_shards(self, rest, nick=None):
+        """ Show the channel shards for this network. """
+        if self.admin.shards is None:
+            return 'one connection, channels are not sharded.'
+        return self.admin.shards.status()
+
+    @command(
+        desc='Shut pyval down cleanly, disconnect and kill the process.')
     def admin_shutdown(self, rest, nick=None):
         """ Shutdown the bot. """
         finalmsg = 'Shutting down: {}'.format(rest if rest else 'No reason.')
@@ -1060,17 +1279,48 @@ class CommandFuncs(object):
         # Unreachable code.
         return finalmsg
 
+    @command(
+        args='[latency | trace [file]]',
+        desc='Show handled-count (number of commands handled), and uptime '
+             '(time since startup). "latency" shows p50/p95/p99 for each '
+             'stage of recent commands, "trace" writes them to a file in '
+             'Chrome trace-event format.')
     def admin_stats(self, rest, nick=None):
-        """ Return simple stats info. """
+        """ Return simple stats info, or latency stats for recent
+            commands.
+        """
+        subcmd, _, filename = rest.partition(' ')
+        if subcmd == 'latency':
+            return self.admin.tracer.latency()
+        elif subcmd == 'trace':
+            filename = filename.strip() or TRACEFILE
+            d = self.admin.tracer.dump(filename)
+            d.addCallbacks(
+                lambda _: 'wrote {} traces to: {}'.format(
+                    len(self.admin.tracer),
+                    filename),
+                lambda failureobj: 'unable to write traces: {}'.format(
+                    failureobj.getErrorMessage()))
+            return self.deferred_result(d)
+        elif subcmd:
+            return 'usage: {}stats [latency | trace [file]]'.format(
+                self.admin.cmdchar)
         uptime = timefromsecs(self.admin.get_uptime())
         statslst = (
             'uptime: {}'.format(uptime),
             'handled: {}'.format(self.admin.handled),
             'banned: {}'.format(len(self.admin.banned)),
             'warned: {}'.format(len(self.admin.banned_warned)),
+            'load: {}'.format(self.admin.load.state),
         )
+        if self.admin.sendq is not None:
+            statslst += ('sendq: {}'.format(self.admin.sendq.depth()),)
         return ', '.join(statslst)
 
+    @command(
+        args='[<channel>] <message>',
+        desc="Set the topic for a channel. Defaults to the bot's channel and "
+             "default message.")
     def admin_topic(self, rest, nick=None):
         """ Set the topic for a channel.
             Defaults to bot channel and default topic.
@@ -1087,10 +1337,14 @@ class CommandFuncs(object):
 
         self.admin.set_topic(topic=msg, channel=chan)
 
+    @command(
+        args='<nick | nick!user@host> ...',
+        desc='Remove nicks or masks from the banned list.')
     def admin_unban(self, rest, nick=None):
         """ Unban a nick. """
         if not rest.strip():
-            return 'usage: {}unban <nick>'.format(self.admin.cmdchar)
+            return 'usage: {}unban <nick | nick!user@host>'.format(
+                self.admin.cmdchar)
 
         nicks = rest.split()
         unbanned = self.admin.ban_remove(nicks)
@@ -1108,17 +1362,25 @@ class CommandFuncs(object):
             else:
                 return 'unable to unban: {}'.format(rest)
 
+    @command(
+        args='[cmdname]',
+        desc='list commands or show command help.')
     def cmd_help(self, rest, nick=None):
         """ Returns a short help string. """
         self.admin.sendmsg(
             nick,
             self.get_help(role='user', cmdname=rest, usernick=nick))
 
-    def cmd_py(self, rest, nick=None):
-        """ Shortcut for cmd_python """
-        return self.cmd_python(rest, nick=nick)
-
-    def cmd_python(self, rest, nick=None):
+    @command(
+        args='[--paste] [--time] <python code>',
+        desc="evaluates python code through pypy-sandbox. force output to "
+             "the pastebin with -p or --paste. time the code with -t or "
+             "--time, separate two snippets with ' ;; ' to compare them.",
+        aliases=('py',),
+        cost=COST_EVALUATION,
+        flags=(FLAG_CALLER, FLAG_TRACED))
+    def cmd_python(self, rest, nick=None, trace=None, is_admin=False,
+                   channel=None):
         """ Evaluate python code and return the answer.
             Restrictions are set. No os module, no nested eval() or exec().
         """
@@ -1128,90 +1390,145 @@ class CommandFuncs(object):
             return None
 
         # Parse command arguments and trim them from the command.
-        argd, rest = get_args(rest, (('-p', '--paste'),))
-
-        def pastebin_chatout(pastebinurl):
-            """ Callback for deferred print_topastebin.
-                Expects result from print_topastebin(content).
-                Returns final chat output when finished.
-
-                It uses the 'execbox' created in cmd_python() to get output.
-                ...so it must be local to cmd_python() for now.
-
-            """
-            # Get chat safe output (partial eval output with pastebin url)
-            if pastebinurl:
-                # Build chat result
-                # semi-full output was pasted, but still need acceptable chat
-                # msg.
-                chatout = execbox.safe_output(maxlines=30, maxlength=140)
-                if len(chatout) > 100:
-                    chatout = chatout[:100]
-                return ('{} '.format(chatout) +
-                        ' - goto: {}'.format(pastebinurl))
-            else:
-                # failed to pastebin.
-                chatout = execbox.safe_output(maxlines=30, maxlength=140)
-                if len(chatout) > 100:
-                    chatout = chatout[:100]
-                return '{} (...truncated)'.format(chatout)
+        argd, rest = get_args(rest, (('-p', '--paste'), ('-t', '--time')))
 
         # User wants help.
         if rest.lower().startswith('help'):
             return self.cmd_help(rest)
 
+        # Refuse evaluations from non-admins when the bot is overloaded.
+        if not self.admin.load.allow_eval(is_admin=is_admin):
+            return 'too busy right now, try again in a minute.'
+
+        # Refuse nicks that used up their CPU budget, and give channels that
+        # used up theirs the short timeout.
+        if self.admin.quota_nick.is_over(nick) and (not is_admin):
+            return 'cpu quota used up, try again in {}s.'.format(
+                self.admin.quota_nick.retry_after(nick))
+        timeout = self.admin.load.get_timeout()
+        if self.admin.quota_chan.is_over(channel):
+            timeout = min(timeout, self.admin.load.timeout_short)
+
+        def eval_done(result):
+            """ Callback for the evaluation, passes the result through.
+                Reports the time/cpu used, whether it worked or not.
+            """
+            self.admin.load.add_busy(time.time() - starttime)
+            self.admin.quota_nick.add(nick, execbox.cputime)
+            self.admin.quota_chan.add(channel, execbox.cputime)
+            for stage, start, end in execbox.timings:
+                EVAL_SECONDS.observe(end - start, stage=stage)
+                if stage == 'spawn':
+                    SANDBOX_SPAWNS.inc()
+                if trace is not None:
+                    trace.add(stage, start, end)
+            if execbox.killed:
+                SANDBOX_KILLS.inc()
+            return result
+
+        def eval_chatout(results):
+            """ Callback for the evaluation, returns chat output. """
+            formatstart = time.time()
+            output = self.python_chatout(
+                results,
+                execbox,
+                rest,
+                paste=argd['--paste'],
+                nick=nick,
+                trace=trace)
+            formatend = time.time()
+            EVAL_SECONDS.observe(formatend - formatstart, stage='format')
+            if trace is not None:
+                trace.add('format', formatstart, formatend)
+            return output
+
+        def eval_failed(failureobj):
+            """ Errback for the evaluation, returns chat output. """
+            if failureobj.check(TimedOut):
+                return 'result: timed out.'
+            return 'error: {}'.format(failureobj.getErrorMessage())
+
         # Execute using pypy-sandbox/pyval_sandbox powered ExecBox.
         execbox = ExecBox(rest)
-        try:
-            # Get raw output from eval, this will have to be checked
-            # and possibly trimmed later before returning a result.
-            results = execbox.execute(use_blacklist=self.admin.blacklist,
-                                      raw_output=True)
-        except TimedOut:
-            return 'result: timed out.'
-        except Exception as ex:
-            return 'error: {}'.format(ex)
-
-        if argd['--paste'] or (len(results) > 160):
-            # Parse output to replace 'fake' newlines with realones,
-            # use it for pastebin output.
-            parsed = execbox.parse_input(rest, stringmode=True)
-
-            # Use pastebinit, with safe_pastebin() settings.
-            pastebincontent = self.safe_pastebin(execbox.output)
-            if self.admin.handlingcount > 1:
-                # Delay this pastebin call based on the handling count.
-                timeout = 3 * self.admin.handlingcount
-                log.msg('Delaying pastebin call for '
-                        '{} seconds.'.format(timeout))
-                # Create a deferred that will be called at a later time.
-                deferredurl = self.task.deferLater(self.reactor,
-                                                   timeout,
-                                                   self.print_topastebin,
-                                                   parsed,
-                                                   pastebincontent,
-                                                   author=nick)
-                # Create a callback that takes in the url and produces
-                # the final chat response.
-                # IRCClient.privmsg() looks for a deferred and will add
-                # the _sendMessage callback to this when it is finished.
-                # (after some further checking/processing ofcourse)
-                deferredurl.addCallback(pastebin_chatout)
-                return deferredurl
-
-            else:
-                # paste it right away
-                pastebinout = self.print_topastebin(parsed,
-                                                    pastebincontent,
-                                                    author=nick)
-                resultstr = pastebin_chatout(pastebinout)
+        starttime = time.time()
+        # Get raw output from eval, this will have to be checked
+        # and possibly trimmed later before returning a result.
+        d = self.defer_eval(
+            execbox.execute,
+            use_blacklist=self.admin.blacklist,
+            raw_output=True,
+            steps=self.admin.eval_steps,
+            modules=self.admin.eval_modules,
+            timeit=argd['--time'],
+            timeout=timeout)
+        d.addBoth(eval_done)
+        d.addCallbacks(eval_chatout, eval_failed)
+        return self.deferred_result(d)
+
+    def paste_later(self, query, result, nick=None, trace=None):
+        """ Paste evaluation results in the background, as a network
+            command for the nick (see pyval_admission).
+            Returns a deferred that fires with a follow-up chat message.
+        """
+        def paste_done(pasteurl):
+            if trace is not None:
+                trace.end('paste')
+            if pasteurl:
+                return 'full output: {}'.format(pasteurl)
+            return 'unable to paste the full output.'
+
+        scheduler = self.admin.scheduler
+        queued = scheduler.queued(nick, group=self.admin.network)
+        if queued >= scheduler.maxqueue:
+            # Too many commands waiting, don't queue a paste behind them.
+            return defer.succeed(
+                'too many commands waiting, full output not pasted.')
+        if trace is not None:
+            trace.start('paste')
+        d = scheduler.submit(
+            nick,
+            self.print_topastebin,
+            args=[query, result],
+            kwargs={'author': nick},
+            cost=COST_NETWORK,
+            group=self.admin.network)
+        d.addCallback(paste_done)
+        return d
 
-        else:
+    def python_chatout(self, results, execbox, rest, paste=False, nick=None,
+                       trace=None):
+        """ Build chat output for cmd_python() from evaluation results.
+            When the results need a paste, what fits is returned right
+            away as a Reply, and the paste url follows when the upload
+            finishes.
+        """
+        needpaste = paste or (len(results) > 160)
+        if not needpaste:
             # No pastebin needed.
-            resultstr = execbox.safe_output()
-
-        return resultstr
-
+            return execbox.safe_output()
+
+        # Chat safe output (partial eval output).
+        chatout = execbox.safe_output(maxlines=30, maxlength=140)
+        if len(results) > 160:
+            chatout = '{} (...truncated)'.format(chatout[:100])
+
+        if not self.admin.load.allow_paste():
+            # Paste uploads are disabled under load, send what fits.
+            return '{} (paste is disabled under load)'.format(chatout)
+
+        # Parse output to replace 'fake' newlines with realones,
+        # use it for pastebin output, with safe_pastebin() settings.
+        reply = Reply(chatout)
+        reply.followup = self.paste_later(
+            execbox.parse_input(rest, stringmode=True),
+            self.safe_pastebin(execbox.output),
+            nick=nick,
+            trace=trace)
+        return reply
+
+    @command(
+        args='<message>',
+        desc='say something to the pyval operator.')
     def cmd_pyval(self, rest, nick=None):
         """ Someone addressed 'pyval' directly. """
         if rest.replace(' ', '').replace('\t', ''):
@@ -1240,11 +1557,15 @@ class CommandFuncs(object):
         # maybeDeferred in pyvalbot.PyValIRCProtocol.privmsg.
         return d
 
+    @command(
+        desc='shows current time for pyval.')
     def cmd_time(self, rest, nick=None):
         """ Retrieve current date and time. """
 
         return humantime(datetime.now())
 
+    @command(
+        desc='show uptime for pyval.')
     def cmd_uptime(self, rest, nick=None):
         """ Return uptime, and starttime """
         uptime = timefromsecs(self.admin.get_uptime())
@@ -1252,6 +1573,8 @@ class CommandFuncs(object):
                                        uptime)
         return s
 
+    @command(
+        desc='show versions for pyval and python.')
     def cmd_version(self, rest, nick=None):
         """ Return pyval version, and sys.version. """
         pyvalver = '{}: {}'.format(NAME, VERSION)
@@ -1260,33 +1583,47 @@ class CommandFuncs(object):
         verstr = '{}, {}, {}'.format(pyvalver, pyver, gccver)
         return verstr
 
-    def get_commands(self, role='user', usernick=None):
-        """ Returns a list of available user commands. """
-        if role == 'user':
-            # Not dynamically generating list right now, maybe later when
-            # commands are final and stable.
-            # This is a list of 'acceptable' commands right now.
-            if usernick and (usernick in self.admin.admins):
-                # hint an admin user towards the adminhelp command.
-                usercmds = ['adminhelp']
-            else:
-                usercmds = []
-            usercmds.extend(['help', 'py', 'python',
-                             'pyval', 'uptime', 'version'])
-            return usercmds
+    def defer_eval(self, func, **kwargs):
+        """ Run an evaluation function in the reactor's thread pool, so
+            it doesn't block the bot (or other evaluations).
+            Without a reactor (like the tests), it runs right away.
+            Returns a deferred that fires with the function's result.
+        """
+        if self.reactor is None:
+            return defer.maybeDeferred(func, **kwargs)
+        return threads.deferToThreadPool(
+            self.reactor,
+            self.reactor.getThreadPool(),
+            func,
+            **kwargs)
+
+    def deferred_result(self, d):
+        """ Return the result of a deferred that has already fired,
+            so commands stay synchronous when there is no reactor.
+            A deferred that is still waiting is returned as-is.
+        """
+        results = []
+        d.addBoth(lambda result: results.append(result) or result)
+        if not results:
+            # Still waiting (evaluating in a thread, or pasting).
+            return d
+        result = results[0]
+        if isinstance(result, failure.Failure):
+            # Raised here instead, don't log it as unhandled.
+            d.addErrback(lambda failureobj: None)
+            result.raiseException()
+        return result
 
-        else:
-            # Dynamically generate a list of admin commands.
-            admincmds = [a for a in dir(self) if a.startswith('admin_')]
-            admincmdnames = [s.split('_')[1] for s in admincmds]
-            return sorted(admincmdnames)
+    def get_commands(self, role='user', usernick=None):
+        """ Returns a list of available commands for a role. """
+        cmds = self.registry.names(role=role)
+        if (role == 'user') and usernick and (usernick in self.admin.admins):
+            # hint an admin user towards the adminhelp command.
+            cmds.insert(0, 'adminhelp')
+        return cmds
 
     def get_help(self, role='user', cmdname=None, usernick=None):
         """ Retrieve help for a command. """
-
-        if not self.admin.help_info:
-            return 'help isn\'t available right now.'
-
         # Handle python style help (still only works for pyval cmds)
         if cmdname and '(' in cmdname:
             # Convert 'help(test)' into 'help test', or 'help()' into 'help '
@@ -1305,21 +1642,11 @@ class CommandFuncs(object):
                 cmdname = ' '.join(cmdname.split()[1:])
 
         if cmdname:
-            # Look for cmd name in help_info.
-            cmdname = cmdname.lower()
-            if cmdname in self.admin.help_info[role]:
-                cmdhelp = self.admin.help_info[role][cmdname]
-                if cmdhelp['args']:
-                    return '{}{} {}: {}'.format(self.admin.cmdchar,
-                                                cmdname,
-                                                cmdhelp['args'],
-                                                cmdhelp['desc'])
-                else:
-                    return '{}{}: {}'.format(self.admin.cmdchar,
-                                             cmdname,
-                                             cmdhelp['desc'])
-            else:
+            # Look for cmd name in the registry.
+            cmd = self.registry.get(cmdname, role=role)
+            if cmd is None:
                 return 'no {} command named: {}'.format(role, cmdname)
+            return cmd.help(cmdchar=self.admin.cmdchar)
 
         else:
             # All commands
@@ -1381,7 +1708,12 @@ class CommandFuncs(object):
         return converted
 
     def print_topastebin(self, query, result, author=None, title=None):
-        """ Uses welbornprod.com/paste to paste a response. """
+        """ Uses welbornprod.com/paste to paste a response.
+            Returns the url (or None), or a deferred that fires with it
+            when the paste client is set.
+            The same paste (content, author, and title) made recently
+            reuses the cached url.
+        """
 
         if (not query) or (not result):
             return None
@@ -1410,7 +1742,29 @@ class CommandFuncs(object):
             pastedata['disabled'] = True
             pastedata['author'] = '<pyvaltest> {}'.format(author)
 
-        return pasteit(pastedata)
+        def cache_url(url):
+            PASTE_SECONDS.observe(time.time() - pastestart)
+            if not url:
+                PASTE_FAILURES.inc()
+            elif key is not None:
+                self.admin.pastecache.put(key, url)
+            return url
+
+        if pastedata.get('disabled', False):
+            # Test pastes aren't cached.
+            key = None
+        else:
+            # The author names the nick, so it's part of the key too.
+            key = paste_key(json.dumps(pastedata, sort_keys=True))
+            url = self.admin.pastecache.get(key)
+            if url is not None:
+                return url
+        pastestart = time.time()
+        if self.admin.paster is not None:
+            d = self.admin.paster.paste(pastedata)
+            d.addCallback(cache_url)
+            return d
+        return cache_url(pasteit(pastedata))
 
     def proc_output(self, proc):
         """ Get process output, whether its on stdout or stderr.
@@ -1463,31 +1817,11 @@ class CommandFuncs(object):
         if not s:
             return s
 
-        if '\n' in s:
-            lines = s.split('\n')
-        elif '\\n' in s:
-            lines = s.split('\\n')
-        else:
-            lines = [s]
-
-        truncatedlines = False
-        # truncate by line count first.
-        if len(lines) > maxlines:
-            lines = lines[:maxlines]
-            truncatedlines = True
-
-        # Truncate each line if maxlength is set.
-        trimmedlines = []
-        for line in lines:
-            if len(line) > maxlength:
-                newline = ('{} ..truncated'.format(line[:maxlength]) +
-                           ' ({} chars)'.format(maxlength))
-                trimmedlines.append(newline)
-            else:
-                trimmedlines.append(line)
-        lines = trimmedlines
-
-        if truncatedlines:
-            lines.append('..truncated at {} lines.'.format(maxlines))
-
-        return '\n'.join(lines)
+        return truncate_output(
+            s,
+            maxlines=maxlines,
+            maxlinelength=maxlength,
+            # Escaped newlines are used when there are no real ones.
+            sep='\n' if '\n' in s else '\\n',
+            line_marker=' ..truncated ({maxlinelength} chars)',
+            lines_marker='..truncated at {maxlines} lines.')
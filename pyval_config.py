@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Config Snapshots
+    Settings are read from an immutable snapshot of the command-line args
+    and config file, built once instead of looking through both on every
+    read. Reloading the config builds a new snapshot and swaps it in, so
+    readers see either the old settings or the new ones, never a mix.
+    The differences between two snapshots are the settings to apply live.
+"""
+
+from easysettings import EasySettings
+
+# Settings that are never sent to chat or logged.
+SECRET_OPTIONS = ('pw', 'password')
+
+
+def format_value(option, value):
+    """ Format a setting's value for the log, hiding passwords. """
+    if is_secret(option) and (value is not None):
+        return '********'
+    return repr(value)
+
+
+def is_secret(option):
+    """ Return True for password options. """
+    return (
+        option.startswith(SECRET_OPTIONS) or
+        option.endswith(SECRET_OPTIONS))
+
+
+def load_settings(filename):
+    """ Load a config file into a new EasySettings, without touching the
+        current one. Raises EnvironmentError if it can't be loaded.
+    """
+    settings = EasySettings()
+    try:
+        loaded = settings.load_file(filename)
+    except (TypeError, ValueError) as ex:
+        raise EnvironmentError('Bad config file: {}'.format(ex))
+    if not loaded:
+        raise EnvironmentError('No config file: {}'.format(filename))
+    return settings
+
+
+class ConfigSnapshot(object):
+
+    """ Read-only settings, cmdline args first, then the config file. """
+
+    __slots__ = ('values',)
+
+    def __init__(self, values=None):
+        """ Arguments:
+                values  : {option: value}, options without the '--'.
+        """
+        object.__setattr__(self, 'values', dict(values or {}))
+
+    def __contains__(self, option):
+        return option.lstrip('-') in self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return 'ConfigSnapshot({} settings)'.format(len(self.values))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('ConfigSnapshot is read-only.')
+
+    @classmethod
+    def build(cls, argd=None, settings=None):
+        """ Build a snapshot from docopt args and config file settings
+            ({option: value}, like EasySettings.settings).
+            Cmdline args that were given win over config file settings.
+        """
+        values = dict(settings or {})
+        for argopt, argval in (argd or {}).items():
+            if argval and argopt.startswith('--'):
+                values[argopt[2:]] = argval
+        return cls(values)
+
+    def diff(self, other):
+        """ Return [(option, old value, new value), ...] for the settings
+            that are different in another snapshot, sorted by option.
+            Missing settings are None.
+        """
+        return [
+            (option, self.values.get(option), other.values.get(option))
+            for option in sorted(set(self.values) | set(other.values))
+            if self.values.get(option) != other.values.get(option)
+        ]
+
+    def get(self, option, default=None):
+        """ Return a setting's value, or default if it isn't set.
+            Options may start with '--', like cmdline args.
+        """
+        if not option:
+            return default
+        return self.values.get(option.lstrip('-'), default)
+
+    def items(self):
+        return sorted(self.values.items())
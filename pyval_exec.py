@@ -32,15 +32,24 @@
 from __future__ import print_function
 from tempfile import SpooledTemporaryFile
 import inspect
-import multiprocessing
+import math
 import os
+import resource
+import signal
 import subprocess
 import sys
-
-from docopt import docopt
+import threading
+import time
 
 from pyval_util import __file__ as PYVAL_FILE  # noqa
-from pyval_util import VERSION
+from pyval_util import (
+    EXEC_HEAPSIZE,
+    EXEC_MAXMEMORY,
+    EXEC_MAXOUTPUT,
+    EXEC_TIMEOUT,
+    TIMEIT_DELIMITER,
+    VERSION,
+    truncate_output)
 
 NAME = 'PyValExec'
 SCRIPTNAME = os.path.split(sys.argv[0])[-1]
@@ -49,21 +58,42 @@ USAGESTR = """{name} v. {version}
 
     Usage:
         {script} -h | -p | -v
-        {script} [-b] [-d] [-q] [-r] [-t secs] [CODE]
+        {script} [-b] [-c secs] [-d] [-m names] [-M bytes] [-o bytes]
+                  [-q] [-r] [-s steps] [-S path] [-t secs] [-T] [CODE]
 
     Options:
         CODE                    : Code to evaluate/execute,
                                   or a file to read code from.
                                   stdin is used when not given.
         -b,--blacklist          : Use blacklist (testing).
+        -c secs,--cputimeout secs
+                                : CPU-time limit for code execution in
+                                  seconds. Default: the timeout
         -d,--debug              : Prints extra info before,
                                   during, and after execution.
         -h,--help               : Show this message.
+        -m names,--modules names
+                                : Comma-separated list of modules the code
+                                  can use. Default: pyval_sandbox's list.
+        -M bytes,--maxmemory bytes
+                                : Address space limit for the sandbox.
+                                  Default: {maxmemory}
+        -o bytes,--maxoutput bytes
+                                : Maximum bytes of output the sandbox will
+                                  send back. Default: {maxoutput}
         -p,--printblacklist     : Print blacklisted strings only.
         -q,--quiet              : Print output only.
         -r,--raw                : Show unsafe, raw output.
+        -s steps,--steps steps  : Maximum number of steps (traced calls and
+                                  lines) the code may use. Default: 0
+                                  (no limit)
+        -S path,--sandbox path  : pypy-sandbox executable to use.
+                                  Default: search $PATH
         -t secs,--timeout secs  : Timeout for code execution in
-                                  seconds. Default: 5
+                                  seconds. Default: {timeout}
+        -T,--timeit             : Time the code like timeit instead of
+                                  running it once. Separate snippets with
+                                  '{delimiter}' to compare them.
         -v,--version            : Show version and exit.
 
     Notes:
@@ -77,7 +107,14 @@ USAGESTR = """{name} v. {version}
         You can explicitly bypass this, but it may be
         better to write a specific sandbox-friendly
         script to test things out.
-""".format(name=NAME, version=VERSION, script=SCRIPTNAME)
+""".format(
+    name=NAME,
+    version=VERSION,
+    script=SCRIPTNAME,
+    timeout=EXEC_TIMEOUT,
+    maxoutput=EXEC_MAXOUTPUT,
+    maxmemory=EXEC_MAXMEMORY,
+    delimiter=TIMEIT_DELIMITER.strip())
 
 # Allow debug early.
 
@@ -130,37 +167,22 @@ if __name__ == '__main__':
     if DEBUG:
         debug = _debug  # noqa
 
-# Location for pypy-sandbox.
+# Location for pypy-sandbox, found on first use by get_pypysandbox().
+# Use set_pypysandbox() to skip the search.
 PYPYSANDBOX_EXE = None
-PATH = set((s.strip() for s in os.environ.get('PATH', '').split(':') if s))
-if not PATH:
-    debug('No $PATH variable set!\n..only defaults will be used.')
-
-for knownpath in (
-        os.path.expanduser('~/bin'),
-        os.path.expanduser('~/.local/bin'),
-        os.path.expanduser('~/local/bin'),
-        '/usr/bin',
-        '/usr/local/bin'):
-    PATH.add(knownpath)
-
-for dirname in PATH:
-    pypypath = os.path.join(dirname, 'pypy-sandbox')
-    if os.path.exists(pypypath):
-        debug('Found pypy-sandbox: {}'.format(pypypath))
-        PYPYSANDBOX_EXE = pypypath
-        break
-else:
-    print('\nUnable to find pypy-sandbox.')
-    print('Looked in:\n    {}'.format('\n    '.join(PATH)))
-    sys.exit(1)
+
+
+class SandboxNotFound(Exception):
+
+    """ Raised when the pypy-sandbox executable can't be found. """
+    pass
 
 
 class ExecBox(object):
 
     """ Handles python code execution using pypy-sandbox/pyval_sandbox.
         Uses safe_output() by default for irc-friendly short output.
-        Uses timed_call() for a timeout on long running code.
+        Each evaluation has wall-clock, CPU-time, and memory limits.
 
     """
 
@@ -174,7 +196,32 @@ class ExecBox(object):
         # This is the final string sent to the interpreter.
         self.parsed = ''
         # Maximum number of seconds to run.
-        self.timeout = 5
+        self.timeout = EXEC_TIMEOUT
+        # Maximum CPU seconds (RLIMIT_CPU) for the sandbox processes.
+        # The wall-clock timeout is used if None.
+        self.cputimeout = None
+        # Maximum address space (RLIMIT_AS) in bytes for the sandbox
+        # processes, and pypy's GC heap size inside the sandbox.
+        # Disabled if < 1.
+        self.maxmemory = EXEC_MAXMEMORY
+        self.heapsize = EXEC_HEAPSIZE
+        # CPU seconds used by the sandbox for the last execute().
+        self.cputime = 0.0
+        # Stages of the last execute(), [(stage, start time, end time)],
+        # for 'blacklist', 'spawn', and 'run'. Also whether the sandbox was
+        # killed at the timeout.
+        self.timings = []
+        self.killed = False
+        # Maximum number of steps (traced calls/lines) to run.
+        # Disabled if < 1.
+        self.steps = 0
+        # Maximum bytes of output pyval_sandbox will write.
+        # The sandbox stops the code when it is reached.
+        # Disabled if < 1.
+        self.maxoutput = EXEC_MAXOUTPUT
+        # Modules available to the code, as a list of names.
+        # pyval_sandbox's whitelist is used if None.
+        self.modules = None
         # Maximum lines/length for safe_output()
         # Disabled if < 1.
         self.maxlines = 0
@@ -230,16 +277,36 @@ class ExecBox(object):
                 return True
         return False
 
-    def _exec(self, pipesend=None, stringmode=True, timeout=None):
+    def _exec(
+            self, stringmode=True, timeout=None, steps=None,
+            maxoutput=None, modules=None, timeit=False, cputimeout=None,
+            maxmemory=None, heapsize=None):
         """ Execute actual code using pypy-sandbox/pyval_sandbox combo.
             This method does not blacklist anything.
             It runs whatever self.inputstr is set to.
+            The CPU seconds used by the sandbox are saved in self.cputime.
+            Raises TimedOut or LimitExceeded when a limit is hit.
 
             Arguments:
-                pipesend    :  multiprocessing pipe to send output to.
                 stringmode  :  fixes newlines so that they can be used from
                                cmdline/irc-chat.
                                default: True
+                timeout     :  wall-clock timeout in seconds.
+                               default: self.timeout
+                cputimeout  :  CPU-time limit in seconds.
+                               default: self.cputimeout, or the timeout.
+                maxmemory   :  address space limit in bytes.
+                               default: self.maxmemory
+                heapsize    :  pypy GC heap limit in bytes.
+                               default: self.heapsize
+                steps       :  step budget for pyval_sandbox.
+                               default: self.steps
+                maxoutput   :  output limit (bytes) for pyval_sandbox.
+                               default: self.maxoutput
+                modules     :  module names for pyval_sandbox.
+                               default: self.modules
+                timeit      :  time the code instead of running it once.
+                               default: False
         """
         if not self.inputstr:
             self.error_return('No source.')
@@ -251,28 +318,92 @@ class ExecBox(object):
         parentdir = os.path.split(PYVAL_FILE)[0]
         sandboxdir = os.path.join(parentdir, 'pyval_sandbox')
         targetfile = '/tmp/pyval_sandbox.py'
+        timeout = timeout or self.timeout
+        cputimeout = cputimeout or self.cputimeout or timeout
+        maxmemory = self.maxmemory if maxmemory is None else maxmemory
+        heapsize = self.heapsize if heapsize is None else heapsize
         # Setup command args for Popen.
-        cmdargs = [PYPYSANDBOX_EXE,
-                   '--timeout={}'.format(timeout or self.timeout),
-                   '--tmp={}'.format(sandboxdir),
-                   targetfile]
+        cmdargs = [get_pypysandbox(), '--timeout={}'.format(timeout)]
+        if heapsize > 0:
+            cmdargs.append('--heapsize={}'.format(heapsize))
+        cmdargs.extend(('--tmp={}'.format(sandboxdir), targetfile))
+        steps = self.steps if steps is None else steps
+        if steps > 0:
+            # Options after the target file are for pyval_sandbox.
+            cmdargs.append('--steps={}'.format(steps))
+        maxoutput = self.maxoutput if maxoutput is None else maxoutput
+        if maxoutput > 0:
+            cmdargs.append('--maxoutput={}'.format(maxoutput))
+        modules = self.modules if modules is None else modules
+        if modules is not None:
+            cmdargs.append('--modules={}'.format(','.join(modules)))
+        if timeit:
+            cmdargs.append('--time={}'.format(timeit_budget(timeout)))
 
         self.printdebug('running sandbox: {}'.format(' '.join(cmdargs)))
 
         # Fill temp file with user input, send it to pyval_sandbox.
         self.printdebug('_exec({})'.format(self.parsed))
 
+        spawnstart = time.time()
         with TempInput(self.parsed) as stdinput:
-            proc = subprocess.Popen(cmdargs,
-                                    stdin=stdinput,
-                                    stdout=subprocess.PIPE,
-                                    stderr=subprocess.PIPE)
-
-        output = self.proc_output(proc)
-        if pipesend is not None:
-            pipesend.send(output)
+            proc = subprocess.Popen(
+                cmdargs,
+                stdin=stdinput,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                preexec_fn=ResourceLimits(cputimeout, maxmemory).apply)
+        runstart = time.time()
+        self.timings.append(('spawn', spawnstart, runstart))
+
+        # pypy-sandbox's --timeout is not enforced, the whole process group
+        # is killed when the wall-clock timeout is reached.
+        killed = []
+        timer = threading.Timer(timeout, kill_group, args=(proc, killed))
+        timer.start()
+        try:
+            output = self.proc_output(proc)
+        finally:
+            timer.cancel()
+        self.cputime = wait_cputime(proc)
+        self.timings.append(('run', runstart, time.time()))
+        self.killed = bool(killed)
+
+        if killed:
+            raise TimedOut('Operation timed out ({}s).'.format(timeout))
+        limitmsg = self.get_limit_msg(
+            output,
+            proc.returncode,
+            cputimeout=cputimeout,
+            memory=heapsize or maxmemory)
+        if limitmsg:
+            raise LimitExceeded(limitmsg)
         return output
 
+    def get_limit_msg(self, output, returncode, cputimeout=0, memory=0):
+        """ Return a message saying which limit the sandbox hit, if any.
+            Arguments:
+                output      : Output from proc_output().
+                returncode  : Return code for the pypy-sandbox process.
+                cputimeout  : CPU-time limit used, in seconds.
+                memory      : Memory limit used, in bytes.
+        """
+        if self.killed:
+            # Killed at the wall-clock timeout (SIGKILL), not a limit.
+            return None
+        lastline = output.rpartition('\n')[-1]
+        # SIGKILL alone doesn't mean much, the CPU time used decides it
+        # (the hard RLIMIT_CPU is only reached after the soft one).
+        if cputimeout and (
+                (returncode == -signal.SIGXCPU) or
+                ('SIGXCPU' in lastline) or
+                (self.cputime >= cputimeout)):
+            return 'CPU time limit exceeded ({}s).'.format(cputimeout)
+        if memory and lastline.startswith('MemoryError'):
+            return 'memory limit exceeded ({}MB).'.format(
+                memory // (1024 * 1024))
+        return None
+
     def error_return(self, s):
         """ Set output as error str and return it.
             self.lasterror and self.output will be set to the same thing.
@@ -288,16 +419,35 @@ class ExecBox(object):
             (self.maxlines and self.maxlength).
 
             Keyword Arguments:
+                cputimeout     : CPU-time limit in seconds.
+                                 Default: self.cputimeout (None, the
+                                 timeout is used)
                 evalstr        : String to evaluate.
                 maxlength      : Maximum length in characters for output.
                                  Default: self.maxlength (0, not used)
                 maxlines       : Maximum number of lines for output.
                                  Default: self.maxlines (0, not used)
+                maxmemory      : Address space limit in bytes.
+                                 Default: self.maxmemory
+                maxoutput      : Maximum bytes of output the sandbox will
+                                 send back before stopping the code.
+                                 Default: self.maxoutput
+                modules        : List of module names the code can use.
+                                 Default: self.modules (None, the
+                                 pyval_sandbox whitelist)
                 raw_output     : Use raw output instead of safe_output().
                                  Default: False
+                steps          : Step budget (traced calls/lines) for the
+                                 code. Stops runaway code after a fixed
+                                 amount of work, no matter the host load.
+                                 Default: self.steps (0, not used)
                 stringmode     : Fix newlines so they can be used with
                                  cmdline/irc-chat.
                                  Default: True
+                timeit         : Time the code like timeit instead of
+                                 running it once. Snippets separated by
+                                 TIMEIT_DELIMITER are compared.
+                                 Default: False
                 timeout        : Timeout for code execution in seconds.
                                  Default: self.timeout (5)
                 use_blacklist  : Enable the blacklist (forbidden strings).
@@ -309,13 +459,21 @@ class ExecBox(object):
         maxlines = kwargs.get('maxlines', self.maxlines) or 0
         raw_output = kwargs.get('raw_output', False)
         stringmode = kwargs.get('stringmode', True)
+        steps = int(kwargs.get('steps', self.steps) or 0)
+        maxoutput = int(kwargs.get('maxoutput', self.maxoutput) or 0)
+        modules = kwargs.get('modules', self.modules)
+        timeit = kwargs.get('timeit', False)
         timeout = kwargs.get('timeout', self.timeout)
         if timeout is None:
             timeout = 0
+        cputimeout = kwargs.get('cputimeout', self.cputimeout)
+        maxmemory = int(kwargs.get('maxmemory', self.maxmemory) or 0)
         use_blacklist = kwargs.get('use_blacklist', False)
 
         # Reset last error.
         self.lasterror = None
+        self.timings = []
+        self.killed = False
 
         if evalstr:
             # Option to set inputstr during execute().
@@ -332,24 +490,30 @@ class ExecBox(object):
 
         # Check blacklisted strings.
         if use_blacklist:
+            checkstart = time.time()
             badinputmsg = self.check_blacklist()
+            self.timings.append(('blacklist', checkstart, time.time()))
             if badinputmsg:
                 return self.error_return(badinputmsg)
 
         # Build kwargs for _exec.
-        # 'timeout' for pypy-sandbox is not being honored, but is included for
-        # debug messages
-        execargs = {'stringmode': stringmode, 'timeout': timeout}
+        execargs = {
+            'stringmode': stringmode,
+            'timeout': timeout,
+            'cputimeout': cputimeout,
+            'maxmemory': maxmemory,
+            'steps': steps,
+            'maxoutput': maxoutput,
+            'modules': modules,
+            'timeit': timeit,
+        }
 
         # Actually execute it with fingers crossed.
+        self.cputime = 0.0
         try:
-            result = self.timed_call(
-                self._exec,
-                kwargs=execargs,
-                timeout=timeout)
-            self.output = str(result)
-        except TimedOut:
-            return self.error_return('Error: Operation timed out.')
+            self.output = str(self._exec(**execargs))
+        except (LimitExceeded, TimedOut) as exlimit:
+            return self.error_return('Error: {}'.format(exlimit))
         except Exception as ex:
             # This is a PyVal error, not the evaluated code's.
             # Any errors in the user code will be returned normally.
@@ -396,7 +560,7 @@ class ExecBox(object):
 
     def proc_output(self, proc):
         """ Get process output, whether its on stdout or stderr.
-            Used with _exec/timed_call.
+            Used with _exec().
             Arguments:
                 proc  : a POpen() process to get output from.
         """
@@ -438,97 +602,33 @@ class ExecBox(object):
         return output.strip('\n')
 
     def safe_output(self, maxlines=None, maxlength=None):
-        """ Retrieves output safe for irc. """
+        """ Retrieves output safe for irc.
+            Newlines are escaped, and the output is cut at maxlines lines
+            and maxlength total characters (when they are > 0).
+        """
 
         maxlines = maxlines if maxlines is not None else self.maxlines
         maxlength = maxlength if maxlength is not None else self.maxlength
         if self.lasterror:
-            lines = self.lasterror.split('\n')
+            output = self.lasterror
             msg = 'error'
         elif self.output:
-            lines = self.output.split('\n')
+            output = self.output
             msg = None
         else:
             return 'No output.'
 
-        # truncate by line count first.
-        if (maxlines > 0) and (len(lines) > maxlines):
-            lines = lines[:maxlines]
-            lines.append('(...truncated at {} lines.)'.format(maxlines))
-            # Truncate each line if maxlength is set.
-            if maxlength > 0:
-                trimmedlines = []
-                for line in lines:
-                    if len(line) > maxlength:
-                        newline = '{} (..truncated)'.format(line[:maxlength])
-                        trimmedlines.append(newline)
-                    else:
-                        trimmedlines.append(line)
-                lines = trimmedlines
-
-            # Save edited lines as a one-line string.
-            oneliner = '\\n'.join(lines)
-        # truncate whole output length
-        elif (maxlength > 0) and (len(self.output) > maxlength):
-            # Save original output as a one-line string.
-            oneliner = '\\n'.join(lines)
-            # Truncate at maxlength.
-            oneliner = '{} (...truncated)'.format(oneliner[:maxlength])
-        else:
-            oneliner = '\\n'.join(lines)
+        oneliner = truncate_output(
+            output,
+            maxlines=maxlines,
+            maxlength=maxlength,
+            joiner='\\n')
         # Append error tag if any.
         if msg:
             oneliner = '{}: {}'.format(msg, oneliner)
 
         return oneliner
 
-    def timed_call(self, func, args=None, kwargs=None, timeout=4):
-        """ Calls a function in a separate process, joins that process
-            after 'timeout' seconds. If the process timed out, then
-            TimedOut is raised.
-
-            func needs a 'pipesend' kwarg to send its result.
-            timed_call() will receive the result and return it.
-            example:
-                def myfunc(x, pipesend=None):
-                    x = x * 5
-                    pipesend.send(x)
-
-                result = timed_call(myfunc, args=[5])
-                # result is now: 25
-
-            Arguments:
-                func     : Function to call in a timed thread.
-
-            Keyword Arguments:
-                args     : List of args for the function.
-                kwargs   : Dict of keyword args for the function.
-                timeout  : Seconds to wait before the function times out.
-                           Default: 4
-        """
-
-        args = args or []
-        kwargs = kwargs or {}
-        piperecv, pipesend = multiprocessing.Pipe()
-        kwargs.update({'pipesend': pipesend})
-        execproc = multiprocessing.Process(
-            target=func,
-            name='ExecutionProc',
-            args=args,
-            kwargs=kwargs)
-        execproc.start()
-        execproc.join(timeout=timeout)
-        if execproc.is_alive():
-            execproc.terminate()
-            # This is an ugly way to shutdown pypy-c-sandbox,
-            # but I can't seem to make anything else work.
-            # the --timeout option on pypy-sandbox isn't doing anything.
-            os.system('killall pypy-c-sandbox')
-            raise TimedOut('Operation timed out.')
-        # Return good result.
-        output = piperecv.recv()
-        return output
-
 
 class TempInput(object):
 
@@ -546,12 +646,162 @@ class TempInput(object):
         return False
 
 
+class LimitExceeded(Exception):
+
+    """ Raised when the sandbox hits its CPU-time or memory limit. """
+    pass
+
+
+class ResourceLimits(object):
+
+    """ Sets resource limits in a child process, for Popen's preexec_fn.
+        The child also starts a new session, so the whole process group
+        can be killed on timeout.
+
+        preexec_fn runs between fork() and exec() in a process with other
+        threads (evaluations run in the reactor's thread pool), where only
+        the forking thread exists. That's safe here because apply() only
+        makes the setsid() and setrlimit() system calls: the limits are
+        worked out beforehand, and nothing in the child imports, logs, or
+        takes a lock that another thread could have been holding.
+        Python 2.7's subprocess has no start_new_session, and pypy-sandbox
+        can't set its own limits, so it has to be done here.
+    """
+
+    def __init__(self, cputime=0, memory=0):
+        """ Arguments:
+                cputime  : RLIMIT_CPU in seconds, SIGXCPU is sent when it
+                           is reached. Disabled if < 1.
+                memory   : RLIMIT_AS in bytes. Disabled if < 1.
+        """
+        self.cputime = cputime
+        self.memory = memory
+        # [(resource, (soft, hard)), ...], set by apply() in the child.
+        self.limits = []
+        if cputime > 0:
+            # Whole seconds only, SIGKILL follows a second later.
+            cpusecs = int(math.ceil(cputime))
+            self.limits.append((resource.RLIMIT_CPU, (cpusecs, cpusecs + 1)))
+        if memory > 0:
+            memory = int(memory)
+            self.limits.append((resource.RLIMIT_AS, (memory, memory)))
+
+    def apply(self):
+        """ Set the limits for this process (and its children). """
+        os.setsid()
+        for limit, values in self.limits:
+            resource.setrlimit(limit, values)
+
+
 class TimedOut(Exception):
 
-    """ Raised on timed_call() timeout. """
+    """ Raised when the sandbox hits the wall-clock timeout. """
     pass
 
 
+def find_pypysandbox():
+    """ Look for pypy-sandbox in $PATH and a few known directories.
+        Returns the full path, or None if it can't be found.
+    """
+    for dirname in get_search_path():
+        pypypath = os.path.join(dirname, 'pypy-sandbox')
+        if os.path.exists(pypypath):
+            debug('Found pypy-sandbox: {}'.format(pypypath))
+            return pypypath
+    return None
+
+
+def get_pypysandbox():
+    """ Return the path to pypy-sandbox, searching for it on first use.
+        Raises SandboxNotFound if it can't be found.
+    """
+    global PYPYSANDBOX_EXE
+    if PYPYSANDBOX_EXE is None:
+        PYPYSANDBOX_EXE = find_pypysandbox()
+        if PYPYSANDBOX_EXE is None:
+            raise SandboxNotFound(
+                'Unable to find pypy-sandbox, looked in: {}'.format(
+                    ', '.join(get_search_path())))
+    return PYPYSANDBOX_EXE
+
+
+def get_search_path():
+    """ Return the list of directories searched for pypy-sandbox. """
+    searchpath = [
+        s.strip() for s in os.environ.get('PATH', '').split(':') if s
+    ]
+    if not searchpath:
+        debug('No $PATH variable set!\n..only defaults will be used.')
+    for knownpath in (
+            os.path.expanduser('~/bin'),
+            os.path.expanduser('~/.local/bin'),
+            os.path.expanduser('~/local/bin'),
+            '/usr/bin',
+            '/usr/local/bin'):
+        if knownpath not in searchpath:
+            searchpath.append(knownpath)
+    return searchpath
+
+
+def kill_group(proc, killed=None):
+    """ Kill a Popen process's group, started by ResourceLimits.
+        True is appended to `killed` (a list) if it is given.
+    """
+    if killed is not None:
+        killed.append(True)
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # Already gone.
+        pass
+
+
+def parse_names(s):
+    """ Parse a comma-separated string of names into a list.
+        Returns None if the string is empty/None.
+    """
+    if not s:
+        return None
+    return [name.strip() for name in s.split(',') if name.strip()]
+
+
+def set_pypysandbox(path):
+    """ Use a known pypy-sandbox executable instead of searching.
+        Raises SandboxNotFound if the path doesn't exist.
+    """
+    global PYPYSANDBOX_EXE
+    if not os.path.exists(path):
+        raise SandboxNotFound('pypy-sandbox not found: {}'.format(path))
+    PYPYSANDBOX_EXE = path
+    return PYPYSANDBOX_EXE
+
+
+def wait_cputime(proc):
+    """ Wait for a Popen process to finish.
+        Returns the CPU seconds (user + system) used by the process,
+        and any children it waited for.
+    """
+    try:
+        _, status, usage = os.wait4(proc.pid, 0)
+    except OSError:
+        # Already waited for.
+        proc.wait()
+        return 0.0
+    if os.WIFSIGNALED(status):
+        proc.returncode = -os.WTERMSIG(status)
+    else:
+        proc.returncode = os.WEXITSTATUS(status)
+    return usage.ru_utime + usage.ru_stime
+
+
+def timeit_budget(timeout):
+    """ Seconds pyval_sandbox may spend timing snippets for a timeout.
+        Half of the timeout is left for sandbox startup and the last
+        (unbounded) timing run.
+    """
+    return max(timeout, 0) / 2.0
+
+
 def print_blacklist():
     """ Prints the current black list for ExecBox """
 
@@ -576,6 +826,8 @@ def remove_items(lst, items):
 
 def main(args):
     """ Main entry point, expects args from sys. """
+    # docopt is only needed for the command line, not for importing.
+    from docopt import docopt
     # Parse args to return an arg dict like docopt.
     argd = docopt(USAGESTR, version=VERSION)
 
@@ -590,11 +842,47 @@ def main(args):
         print_status = lambda s: None
 
     try:
-        timeout = int(argd['--timeout'] or 5)
+        if argd['--sandbox']:
+            set_pypysandbox(argd['--sandbox'])
+        else:
+            get_pypysandbox()
+    except SandboxNotFound as exsandbox:
+        print('\n{}'.format(exsandbox))
+        return 1
+
+    try:
+        timeout = int(argd['--timeout'] or EXEC_TIMEOUT)
     except (TypeError, ValueError):
         print('\nInvalid number for --timeout: {}'.format(argd['--timeout']))
         return 1
 
+    try:
+        steps = int(argd['--steps'] or 0)
+    except (TypeError, ValueError):
+        print('\nInvalid number for --steps: {}'.format(argd['--steps']))
+        return 1
+
+    try:
+        maxoutput = int(argd['--maxoutput'] or EXEC_MAXOUTPUT)
+    except (TypeError, ValueError):
+        print('\nInvalid number for --maxoutput: {}'.format(
+            argd['--maxoutput']))
+        return 1
+
+    try:
+        cputimeout = int(argd['--cputimeout'] or 0) or None
+    except (TypeError, ValueError):
+        print('\nInvalid number for --cputimeout: {}'.format(
+            argd['--cputimeout']))
+        return 1
+
+    try:
+        maxmemory = int(argd['--maxmemory'] or EXEC_MAXMEMORY)
+    except (TypeError, ValueError):
+        print('\nInvalid number for --maxmemory: {}'.format(
+            argd['--maxmemory']))
+        return 1
+
     if argd['CODE']:
         evalstr = argd['CODE']
     else:
@@ -635,7 +923,13 @@ def main(args):
             raw_output=argd['--raw'],
             stringmode=stringmode,
             use_blacklist=argd['--blacklist'],
-            timeout=timeout)
+            steps=steps,
+            maxoutput=maxoutput,
+            modules=parse_names(argd['--modules']),
+            timeit=argd['--timeit'],
+            timeout=timeout,
+            cputimeout=cputimeout,
+            maxmemory=maxmemory)
     except TimedOut:
         print('\nOperation timed out. ({}s)'.format(e.timeout))
     except Exception as ex:
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Load Controller
+    Watches the request queue and evaluation worker use, and steps the bot
+    down through degraded states while it is overloaded.
+"""
+
+from collections import deque
+from datetime import datetime
+import time
+
+from twisted.python import log
+
+from pyval_util import EXEC_TIMEOUT
+
+
+class LoadController(object):
+
+    """ Decides the current load state for PyVal.
+        sample() is called periodically with the current queue depth,
+        evaluation time is reported with add_busy().
+
+        States, from least to most degraded:
+            normal    : Everything is allowed.
+            short     : Evaluations use a shorter timeout.
+            nopaste   : Short timeout, no paste uploads.
+            shedding  : Short timeout, no pastes, non-admin evaluations
+                        are refused.
+
+        The state moves up one step per sample while either limit is
+        exceeded. It only moves back down one step after the load has
+        stayed under recover_ratio of that state's limits for
+        recover_samples samples in a row.
+    """
+    states = ('normal', 'short', 'nopaste', 'shedding')
+
+    def __init__(self, workers=1, interval=1):
+        # Index into self.states.
+        self.level = 0
+        # Number of evaluation workers, and seconds between samples.
+        # Worker use is measured over the real time between samples.
+        self.workers = workers
+        self.interval = interval
+        # Queue depth (handling count) needed to enter each degraded state.
+        self.queue_limits = (2, 4, 6)
+        # Worker use (0.0-1.0) needed to enter each degraded state.
+        self.busy_limits = (0.5, 0.75, 0.9)
+        # Load must drop below this fraction of the current state's limits
+        # to count as a calm sample.
+        self.recover_ratio = 0.5
+        # Calm samples needed (in a row) before recovering one state.
+        self.recover_samples = 5
+        # Evaluation timeouts for the normal/degraded states.
+        self.timeout_normal = EXEC_TIMEOUT
+        self.timeout_short = 2
+
+        # Measurements from the last sample.
+        self.queued = 0
+        self.busy = 0.0
+        # Total seconds spent evaluating, and the total at the last sample.
+        self.busytime = 0.0
+        self.busylast = 0.0
+        # Time of the last sample.
+        self.sampletime = time.time()
+        # Calm samples seen so far in the current state.
+        self.calm = 0
+        # Recent state changes: (time, old state, new state, reason)
+        self.changes = deque(maxlen=10)
+        self.changecount = 0
+
+    def add_busy(self, secs):
+        """ Report seconds spent by a worker on an evaluation. """
+        self.busytime += max(secs, 0)
+
+    def allow_eval(self, is_admin=False):
+        """ Returns True if evaluations are allowed for this user. """
+        return is_admin or (self.state != 'shedding')
+
+    def allow_paste(self):
+        """ Returns True if paste uploads are allowed. """
+        return self.level < self.states.index('nopaste')
+
+    def get_timeout(self):
+        """ Return the evaluation timeout for the current state. """
+        if self.level == 0:
+            return self.timeout_normal
+        return self.timeout_short
+
+    def is_calm(self):
+        """ Returns True if the last sample was well under the limits for
+            the current state.
+        """
+        if self.level == 0:
+            return True
+        limitindex = self.level - 1
+        queuelimit = self.queue_limits[limitindex] * self.recover_ratio
+        busylimit = self.busy_limits[limitindex] * self.recover_ratio
+        return (self.queued < queuelimit) and (self.busy < busylimit)
+
+    def is_overloaded(self):
+        """ Returns True if the last sample exceeded the limits for the next
+            degraded state.
+        """
+        if self.level >= len(self.states) - 1:
+            return False
+        return (
+            (self.queued >= self.queue_limits[self.level]) or
+            (self.busy >= self.busy_limits[self.level])
+        )
+
+    def sample(self, queued, now=None):
+        """ Take a load sample, and change state if needed.
+            Returns the current state name.
+            Arguments:
+                queued  : Number of requests currently being handled.
+                now     : Time of this sample. Default: time.time()
+        """
+        self.queued = queued
+        if now is None:
+            now = time.time()
+        # Samples can be late or skipped while the reactor is busy, so use
+        # the real time since the last one.
+        elapsed = max(now - self.sampletime, 0.001)
+        self.sampletime = now
+        capacity = elapsed * max(self.workers, 1)
+        self.busy = min((self.busytime - self.busylast) / capacity, 1.0)
+        self.busylast = self.busytime
+
+        if self.is_overloaded():
+            self.calm = 0
+            self.set_level(self.level + 1)
+        elif self.is_calm():
+            self.calm += 1
+            if self.level and (self.calm >= self.recover_samples):
+                self.calm = 0
+                self.set_level(self.level - 1)
+        else:
+            # Between the recover and overload limits, hold this state.
+            self.calm = 0
+        return self.state
+
+    def set_level(self, level):
+        """ Switch to a new state level, logging the change. """
+        level = min(max(level, 0), len(self.states) - 1)
+        if level == self.level:
+            return None
+        oldstate = self.state
+        self.level = level
+        reason = 'queue: {}, busy: {:.0%}'.format(self.queued, self.busy)
+        self.changes.append((datetime.now(), oldstate, self.state, reason))
+        self.changecount += 1
+        log.msg('Load state changed: {} -> {} ({})'.format(
+            oldstate,
+            self.state,
+            reason))
+
+    @property
+    def state(self):
+        return self.states[self.level]
+
+    def status(self):
+        """ Return a short status string for chat. """
+        statuslst = [
+            'state: {}'.format(self.state),
+            'queue: {}'.format(self.queued),
+            'busy: {:.0%}'.format(self.busy),
+            'timeout: {}s'.format(self.get_timeout()),
+            'changes: {}'.format(self.changecount),
+        ]
+        if self.changes:
+            when, oldstate, newstate, reason = self.changes[-1]
+            statuslst.append('last: {} -> {} at {} ({})'.format(
+                oldstate,
+                newstate,
+                when.strftime('%H:%M:%S'),
+                reason))
+        return ', '.join(statuslst)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Log Pipeline
+    A Twisted log observer that keeps the reactor out of log I/O.
+    Log events are formatted and put in a bounded queue, and written in
+    batches from a thread. When the queue is full, new events are dropped
+    instead of blocking.
+
+    Noisy events can be sampled by category, passed to log.msg():
+        log.msg('Recv: ...', category='data')
+    Categories used by pyval:
+        data       : Every line sent/received (--data).
+        monitor    : Channel messages (--monitor).
+        heartbeat  : PING/PONG messages.
+
+    Log files are rotated by size and age (file.1, file.2, ...), and lines
+    can be plain text or json.
+"""
+
+from collections import deque
+from datetime import datetime
+import json
+import os
+import random
+import sys
+import time
+
+from twisted.internet import defer, task, threads
+from twisted.python import log
+
+LOG_CATEGORIES = ('data', 'monitor', 'heartbeat')
+
+
+def parse_rates(s):
+    """ Parse sampling rates from a string like 'data=0.1,heartbeat=0'.
+        Returns a dict of {category: rate}, bad rates are logged.
+    """
+    rates = {}
+    for item in (s or '').split(','):
+        if not item.strip():
+            continue
+        category, _, rate = item.partition('=')
+        category = category.strip()
+        try:
+            rate = float(rate)
+        except ValueError:
+            rate = -1
+        if (category not in LOG_CATEGORIES) or not (0 <= rate <= 1):
+            log.msg('Invalid log sample rate: {}'.format(item.strip()))
+            continue
+        rates[category] = rate
+    return rates
+
+
+class LogPipeline(object):
+
+    """ Buffered, sampled log observer, for log.startLoggingWithObserver().
+        start() begins writing in batches, stop() writes what's left.
+        Events are written right away until start() is called, and after
+        stop() is called (run_with() calls both with the reactor).
+    """
+
+    def __init__(self, filename=None, stream=None, rates=None,
+                 jsonlines=False, maxqueue=10000, interval=0.5,
+                 maxbytes=10 * 1024 * 1024, maxage=86400, backups=5):
+        """ Arguments:
+                filename   : Log file to write (appended to).
+                stream     : File-like object to write to, when there is
+                             no filename (like sys.stderr).
+                rates      : Sampling rates {category: 0.0 - 1.0},
+                             1.0 (keep everything) by default.
+                jsonlines  : Write json lines instead of text.
+                maxqueue   : Most events waiting to be written.
+                interval   : Seconds between batch writes.
+                maxbytes   : Rotate the log file at this size.
+                maxage     : Rotate the log file after this many seconds.
+                             0 disables it.
+                backups    : Number of rotated files to keep.
+        """
+        self.filename = filename
+        self.stream = stream or sys.stderr
+        self.rates = rates or {}
+        self.jsonlines = jsonlines
+        self.maxqueue = maxqueue
+        self.interval = interval
+        self.maxbytes = maxbytes
+        self.maxage = maxage
+        self.backups = backups
+        # Formatted lines waiting to be written.
+        self.queue = deque()
+        # Open log file, its size, and when it was started.
+        self.fileobj = None
+        self.filesize = 0
+        self.opened = None
+        # LoopingCall for batch writes (once started), and the running
+        # write, if any.
+        self.loop = None
+        self.threaded = False
+        self.writing = None
+        # Deferreds waiting for the running write (stop()).
+        self.waiting = []
+        # Counters.
+        self.written = 0
+        self.dropped = 0
+        self.sampled = 0
+        self.rotations = 0
+        # Replaceable for tests.
+        self.random = random.random
+        if self.filename:
+            self.open_file()
+
+    def __call__(self, eventdict):
+        """ Log observer, queues an event. """
+        rate = self.rates.get(eventdict.get('category', None), 1)
+        if (rate < 1) and (self.random() >= rate):
+            self.sampled += 1
+            return None
+        if len(self.queue) >= self.maxqueue:
+            self.dropped += 1
+            return None
+        line = self.format_event(eventdict)
+        if line is None:
+            return None
+        self.queue.append(line)
+        if (self.loop is None) or (not self.loop.running):
+            # Not started, or stopped. There may be no reactor to write
+            # it later, so write it now.
+            self.flush()
+
+    def _write_done(self, result):
+        """ Callback for a finished write. """
+        self.writing = None
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+        return None
+
+    def _write_failed(self, failureobj):
+        """ Errback for a failed write. It can't be logged, this is the
+            log, so it goes to stderr.
+        """
+        sys.stderr.write('Unable to write log: {}\n'.format(
+            failureobj.getErrorMessage()))
+        return None
+
+    def flush(self):
+        """ Write the queued lines, in a thread when started.
+            Does nothing if a write is running, the next flush writes them.
+        """
+        if (self.writing is not None) or (not self.queue):
+            return None
+        lines = []
+        while self.queue:
+            lines.append(self.queue.popleft())
+        if self.threaded:
+            d = threads.deferToThread(self.write_lines, lines)
+        else:
+            d = defer.maybeDeferred(self.write_lines, lines)
+        self.writing = d
+        d.addErrback(self._write_failed)
+        d.addBoth(self._write_done)
+        return d
+
+    def format_event(self, eventdict):
+        """ Format an event as a line of text or json.
+            Returns None for events with no text.
+        """
+        text = log.textFromEventDict(eventdict)
+        if text is None:
+            return None
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        eventtime = eventdict.get('time', None)
+        if eventtime is None:
+            eventtime = time.time()
+        system = eventdict.get('system', '-')
+        if self.jsonlines:
+            record = {
+                'time': eventtime,
+                'system': system,
+                'msg': text,
+            }
+            category = eventdict.get('category', None)
+            if category:
+                record['category'] = category
+            if eventdict.get('isError', False):
+                record['error'] = True
+            return '{}\n'.format(json.dumps(record))
+        timestr = datetime.fromtimestamp(eventtime).strftime(
+            '%Y-%m-%d %H:%M:%S')
+        return '{} [{}] {}\n'.format(
+            timestr,
+            system,
+            text.replace('\n', '\n\t'))
+
+    def open_file(self):
+        """ Open the log file for appending. """
+        self.fileobj = open(self.filename, 'a')
+        self.filesize = self.fileobj.tell()
+        self.opened = time.time()
+
+    def rotate(self):
+        """ Move the log file to file.1 (file.1 to file.2, ...),
+            and start a new one.
+        """
+        self.fileobj.close()
+        for num in range(self.backups - 1, 0, -1):
+            src = '{}.{}'.format(self.filename, num)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.filename, num + 1))
+        if self.backups > 0:
+            os.rename(self.filename, '{}.1'.format(self.filename))
+        else:
+            os.remove(self.filename)
+        self.rotations += 1
+        self.open_file()
+
+    def run_with(self, reactor):
+        """ Start batch writes once the reactor is running, and stop
+            them before it shuts down. Events logged before it runs (like
+            startup errors before an exit) are written right away.
+        """
+        reactor.callWhenRunning(self.start, clock=reactor)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def start(self, clock=None):
+        """ Start writing in batches, from a thread. """
+        self.threaded = True
+        self.loop = task.LoopingCall(self.flush)
+        if clock is not None:
+            self.loop.clock = clock
+        self.loop.start(self.interval, now=False)
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return ', '.join((
+            'queued: {}'.format(len(self.queue)),
+            'written: {}'.format(self.written),
+            'dropped: {}'.format(self.dropped),
+            'sampled out: {}'.format(self.sampled),
+            'rotations: {}'.format(self.rotations),
+        ))
+
+    def stop(self):
+        """ Stop batch writes, and write what's left (not in a thread).
+            Events logged after this are written right away.
+            Returns a Deferred that fires when it's written.
+        """
+        if (self.loop is not None) and self.loop.running:
+            self.loop.stop()
+        self.threaded = False
+        if self.writing is None:
+            self.flush()
+            return defer.succeed(None)
+        d = defer.Deferred()
+        self.waiting.append(d)
+        d.addCallback(lambda _: self.flush())
+        return d
+
+    def write_lines(self, lines):
+        """ Write lines to the log file (rotating it when needed),
+            or the stream.
+        """
+        content = ''.join(lines)
+        if self.fileobj is None:
+            self.stream.write(content)
+            self.stream.flush()
+        else:
+            tooold = self.maxage and (
+                (time.time() - self.opened) >= self.maxage)
+            toobig = (self.filesize + len(content)) > self.maxbytes
+            if self.filesize and (tooold or toobig):
+                self.rotate()
+            self.fileobj.write(content)
+            self.fileobj.flush()
+            self.filesize += len(content)
+        self.written += len(lines)
+        return True
@@ -0,0 +1,301 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Mask Registry
+    Holds nicks and nick!user@host masks (admins, bans), and matches users
+    against them. Exact nicks, exact masks, and *!*@host masks are kept in
+    sets, other wildcard masks are compiled into one regex.
+
+    Changes are appended to a journal file ('+mask' or '-mask' per line,
+    plain lines are old-style lists and count as '+'). The journal is
+    compacted when it gets too long. Writes are done in order, in a thread
+    when `threaded` is set.
+"""
+
+import os
+import re
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+# Characters that make a mask a wildcard mask.
+WILDCARDS = ('*', '?')
+
+
+def has_wildcard(s):
+    """ Returns True if a string has wildcard characters. """
+    return any(c in s for c in WILDCARDS)
+
+
+def normalize_mask(mask):
+    """ Lowercase a mask, and fill in missing nick/user/host parts.
+        Bare nicks are left alone ('nick', not 'nick!*@*').
+    """
+    mask = mask.strip().lower()
+    if ('!' not in mask) and ('@' not in mask):
+        return mask
+    if '@' in mask:
+        nickuser, _, host = mask.rpartition('@')
+    else:
+        # 'nick!user' without a host.
+        nickuser, host = mask, '*'
+    nick, _, user = nickuser.partition('!')
+    return '{}!{}@{}'.format(nick or '*', user or '*', host or '*')
+
+
+def translate_mask(mask):
+    """ Return a regex pattern (str) for a wildcard mask. """
+    parts = []
+    for c in mask:
+        if c == '*':
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts)
+
+
+class MaskRegistry(object):
+
+    """ A set of nicks/masks that users can be matched against.
+        `user in registry` works with a bare nick or nick!user@host.
+        Bare nicks only match entries that don't care about user@host
+        (like 'nick', 'nick*', or 'nick!*@*').
+    """
+
+    def __init__(self, filename=None, defaults=None):
+        """ Arguments:
+                filename  : Journal file, None for no persistence.
+                defaults  : Entries used when there is no journal file.
+        """
+        self.filename = filename
+        # Normalized entries, and the indexes built from them.
+        self.entries = set()
+        self.nicks_exact = set()
+        self.masks_exact = set()
+        self.hosts_exact = set()
+        # Wildcard entries, and their compiled regex (None when it needs
+        # to be rebuilt).
+        self.masks_wild = set()
+        self.masks_wild_pat = None
+        # Use a thread for writes (set once the reactor is running).
+        self.threaded = False
+        # Journal lines written since the last compaction, and the number
+        # of lines allowed before compacting (compact_ratio * entries,
+        # plus compact_min).
+        self.journal_lines = 0
+        self.compact_ratio = 2
+        self.compact_min = 100
+        # Writes waiting for the writer: [('+mask' or '-mask' lines)],
+        # or a full snapshot when compacting.
+        self.pending = []
+        self.pending_snapshot = None
+        self.writing = False
+        if not self.load():
+            for mask in (defaults or ()):
+                self._add(mask)
+
+    def __contains__(self, user):
+        return self.match(user)
+
+    def __iter__(self):
+        return iter(sorted(self.entries))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _add(self, mask):
+        """ Add a mask to the indexes, without saving it.
+            Returns True if it was new.
+        """
+        mask = normalize_mask(mask)
+        if (not mask) or (mask in self.entries):
+            return False
+        self.entries.add(mask)
+        index, key = self._index(mask)
+        index.add(key)
+        if index is self.masks_wild:
+            self.masks_wild_pat = None
+        return True
+
+    def _index(self, mask):
+        """ Return the set that indexes a normalized mask, and the key
+            for the mask in that set: (index, key)
+        """
+        if '!' not in mask:
+            if has_wildcard(mask):
+                return self.masks_wild, mask
+            return self.nicks_exact, mask
+        if not has_wildcard(mask):
+            return self.masks_exact, mask
+        nick, _, userhost = mask.partition('!')
+        user, _, host = userhost.partition('@')
+        if (nick == '*') and (user == '*') and (not has_wildcard(host)):
+            # *!*@host, keyed by host.
+            return self.hosts_exact, host
+        return self.masks_wild, mask
+
+    def _remove(self, mask):
+        """ Remove a mask from the indexes, without saving it.
+            Returns True if it was there.
+        """
+        mask = normalize_mask(mask)
+        if mask not in self.entries:
+            return False
+        self.entries.remove(mask)
+        index, key = self._index(mask)
+        index.discard(key)
+        if index is self.masks_wild:
+            self.masks_wild_pat = None
+        return True
+
+    def add(self, mask, save=True):
+        """ Add a nick or mask. Returns True if it was new. """
+        if not self._add(mask):
+            return False
+        if save:
+            self.journal('+{}'.format(normalize_mask(mask)))
+        return True
+
+    def compile_wild(self):
+        """ Compile the wildcard masks into one regex. """
+        if not self.masks_wild:
+            self.masks_wild_pat = False
+            return None
+        self.masks_wild_pat = re.compile('^(?:{})$'.format(
+            '|'.join(
+                translate_mask(
+                    mask if '!' in mask else '{}!*@*'.format(mask))
+                for mask in sorted(self.masks_wild))))
+
+    def flush(self):
+        """ Start writing pending changes, unless a write is running. """
+        if self.writing or (self.filename is None):
+            return None
+        if self.pending_snapshot is not None:
+            # Lines journaled after the snapshot are written next time.
+            lines, mode = self.pending_snapshot, 'w'
+            self.pending_snapshot = None
+        elif self.pending:
+            lines, mode = self.pending, 'a'
+            self.pending = []
+        else:
+            return None
+        self.writing = True
+        if self.threaded:
+            d = threads.deferToThread(self.write_lines, lines, mode)
+        else:
+            d = defer.maybeDeferred(self.write_lines, lines, mode)
+        d.addErrback(self.write_failed)
+        d.addBoth(self.write_done)
+        return d
+
+    def journal(self, line):
+        """ Queue a journal line, compacting the journal if it's long. """
+        if self.filename is None:
+            return None
+        self.journal_lines += 1
+        maxlines = (self.compact_ratio * len(self.entries)) + self.compact_min
+        if self.journal_lines > maxlines:
+            # Write everything over again, instead of the lines.
+            self.pending_snapshot = ['+{}'.format(m) for m in self]
+            self.pending = []
+            self.journal_lines = len(self.entries)
+        else:
+            self.pending.append(line)
+        self.flush()
+
+    def load(self):
+        """ Load entries from the journal file.
+            Returns False if there is no file, or it can't be read.
+        """
+        if (self.filename is None) or (not os.path.isfile(self.filename)):
+            return False
+        try:
+            with open(self.filename) as fread:
+                lines = [l.strip() for l in fread]
+        except EnvironmentError as ex:
+            log.msg('Unable to load mask list: {}\n{}'.format(
+                self.filename,
+                ex))
+            return False
+
+        self.journal_lines = 0
+        for line in lines:
+            if not line:
+                continue
+            self.journal_lines += 1
+            if line.startswith('-'):
+                self._remove(line[1:])
+            else:
+                self._add(line[1:] if line.startswith('+') else line)
+        return True
+
+    def match(self, user):
+        """ Returns True if a nick or nick!user@host matches an entry. """
+        if not user:
+            return False
+        user = user.strip().lower()
+        nick, _, userhost = user.partition('!')
+        if (nick in self.nicks_exact) or (user in self.masks_exact):
+            return True
+        if not userhost:
+            # Bare nick, only entries that match any user@host can match.
+            # The literal '*' parts only match wildcards in the entries.
+            user = '{}!*@*'.format(nick)
+        elif userhost.partition('@')[-1] in self.hosts_exact:
+            return True
+        if self.masks_wild_pat is None:
+            self.compile_wild()
+        if self.masks_wild_pat:
+            return self.masks_wild_pat.match(user) is not None
+        return False
+
+    def nicks(self):
+        """ Return the nicks that entries name directly (no wildcards in
+            the nick part), for sending messages to.
+        """
+        nicks = set(self.nicks_exact)
+        for mask in self.entries:
+            nick = mask.partition('!')[0]
+            if ('!' in mask) and (not has_wildcard(nick)):
+                nicks.add(nick)
+        return nicks
+
+    def remove(self, mask, save=True):
+        """ Remove a nick or mask. Returns True if it was there. """
+        if not self._remove(mask):
+            return False
+        if save:
+            self.journal('-{}'.format(normalize_mask(mask)))
+        return True
+
+    def write_done(self, result):
+        """ Callback for a finished write, starts the next one. """
+        self.writing = False
+        self.flush()
+        return result
+
+    def write_failed(self, failureobj):
+        """ Errback for a failed write, logs it. """
+        log.msg('Unable to save mask list: {}\n{}'.format(
+            self.filename,
+            failureobj.getErrorMessage()))
+        return False
+
+    def write_lines(self, lines, mode='a'):
+        """ Write journal lines, appending or replacing the file.
+            Replacing writes a temp file first, so the journal is never
+            half-written.
+        """
+        content = ''.join('{}\n'.format(line) for line in lines)
+        if mode == 'a':
+            with open(self.filename, 'a') as f:
+                f.write(content)
+            return True
+        tmpname = '{}.tmp'.format(self.filename)
+        with open(tmpname, 'w') as f:
+            f.write(content)
+        os.rename(tmpname, self.filename)
+        return True
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Metrics
+    Counters, gauges, and histograms, served in the Prometheus text format
+    by an optional HTTP listener on the bot's reactor (--metricsport).
+
+    PyVal's metrics are all defined here, and updated where they happen.
+    Metrics can have labels, passed as keyword arguments:
+        EVAL_SECONDS.observe(0.25, stage='run')
+"""
+
+import threading
+
+from twisted.internet import task
+from twisted.web import resource, server
+
+# Default histogram buckets, in seconds.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def format_labels(labelnames, labelvalues, extra=None):
+    """ Format labels for a metric line: '{name="value",...}' """
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"'))
+        for name, value in pairs))
+
+
+def format_value(value):
+    """ Format a metric value, ints without a decimal point. """
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric(object):
+
+    """ Base for metrics, values are kept per set of label values. """
+
+    kind = None
+
+    def __init__(self, name, desc, labels=None):
+        self.name = name
+        self.desc = desc
+        self.labels = tuple(labels or ())
+        self.lock = threading.Lock()
+        # {(label values): value}
+        self.values = {}
+
+    def get_key(self, labels):
+        """ Return the label values for keyword labels, as a tuple. """
+        if set(labels) != set(self.labels):
+            raise ValueError('Labels for {} must be: {}'.format(
+                self.name,
+                ', '.join(self.labels) or 'none'))
+        return tuple(labels[name] for name in self.labels)
+
+    def render(self):
+        """ Return the exposition lines for this metric. """
+        lines = [
+            '# HELP {} {}'.format(self.name, self.desc),
+            '# TYPE {} {}'.format(self.name, self.kind),
+        ]
+        lines.extend(self.render_values())
+        return lines
+
+    def render_values(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return [
+            '{}{} {}'.format(
+                self.name,
+                format_labels(self.labels, key),
+                format_value(value))
+            for key, value in items
+        ]
+
+
+class Counter(Metric):
+
+    """ A value that only goes up. """
+
+    kind = 'counter'
+
+    def get(self, **labels):
+        return self.values.get(self.get_key(labels), 0)
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+    """ A value that goes up and down. It can be read from a function
+        when the metrics are rendered, with set_function().
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, desc, labels=None):
+        Metric.__init__(self, name, desc, labels=labels)
+        self.func = None
+
+    def get(self, **labels):
+        if self.func is not None:
+            return self.func()
+        return self.values.get(self.get_key(labels), 0)
+
+    def render_values(self):
+        if self.func is not None:
+            return ['{} {}'.format(self.name, format_value(self.func()))]
+        return Metric.render_values(self)
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, func):
+        """ Read the gauge from func() (no labels), None to stop. """
+        self.func = func
+
+
+class Histogram(Metric):
+
+    """ Counts observed values in buckets, with their sum and count. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, desc, labels=None, buckets=BUCKETS):
+        Metric.__init__(self, name, desc, labels=labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def get_count(self, **labels):
+        """ Return the number of observed values. """
+        entry = self.values.get(self.get_key(labels), None)
+        return 0 if entry is None else entry[2]
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            entry = self.values.get(key, None)
+            if entry is None:
+                # [bucket counts, sum, count]
+                entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def render_values(self):
+        with self.lock:
+            items = sorted(
+                (key, (list(counts), total, count))
+                for key, (counts, total, count) in self.values.items())
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucketcount in zip(self.buckets, counts):
+                cumulative += bucketcount
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(
+                        self.labels,
+                        key,
+                        extra=('le', format_value(bound))),
+                    cumulative))
+            labelstr = format_labels(self.labels, key)
+            lines.append('{}_sum{} {}'.format(
+                self.name,
+                labelstr,
+                format_value(total)))
+            lines.append('{}_count{} {}'.format(self.name, labelstr, count))
+        return lines
+
+
+class MetricsRegistry(object):
+
+    """ Holds metrics by name, and renders them all. """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError('Duplicate metric: {}'.format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, desc, labels=None):
+        return self.add(Counter(name, desc, labels=labels))
+
+    def gauge(self, name, desc, labels=None):
+        return self.add(Gauge(name, desc, labels=labels))
+
+    def histogram(self, name, desc, labels=None, buckets=BUCKETS):
+        return self.add(Histogram(name, desc, labels=labels, buckets=buckets))
+
+    def render(self):
+        """ Return all metrics in the Prometheus text format. """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        return '{}\n'.format('\n'.join(lines))
+
+
+class MetricsResource(resource.Resource):
+
+    """ Serves a MetricsRegistry at /metrics. """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        if request.path not in (b'/metrics', b'/'):
+            request.setResponseCode(404)
+            return b'Not found.'
+        request.setHeader(b'Content-Type', b'text/plain; version=0.0.4')
+        return self.registry.render()
+
+
+class ReactorLag(object):
+
+    """ Measures how late the reactor runs a timed call (REACTOR_LAG). """
+
+    def __init__(self, clock, interval=1):
+        self.clock = clock
+        self.interval = interval
+        self.expected = None
+        self.loop = None
+
+    def check(self):
+        now = self.clock.seconds()
+        if self.expected is not None:
+            lag = max(now - self.expected, 0)
+            REACTOR_LAG.set(lag)
+            REACTOR_LAG_SECONDS.observe(lag)
+        self.expected = now + self.interval
+
+    def start(self):
+        self.loop = task.LoopingCall(self.check)
+        self.loop.clock = self.clock
+        self.loop.start(self.interval)
+
+    def stop(self):
+        if (self.loop is not None) and self.loop.running:
+            self.loop.stop()
+
+
+def listen_metrics(reactor, port, interface='127.0.0.1', registry=None):
+    """ Serve metrics on localhost (by default).
+        Returns the listening port.
+    """
+    site = server.Site(MetricsResource(registry or REGISTRY))
+    # Don't log every scrape.
+    site.noisy = False
+    site.log = lambda request: None
+    return reactor.listenTCP(port, site, interface=interface)
+
+
+REGISTRY = MetricsRegistry()
+
+# Evaluations.
+EVAL_SECONDS = REGISTRY.histogram(
+    'pyval_eval_seconds',
+    'Evaluation latency by stage (queue, blacklist, spawn, run, format).',
+    labels=('stage',))
+SANDBOX_SPAWNS = REGISTRY.counter(
+    'pyval_sandbox_spawns_total',
+    'Sandbox processes started.')
+SANDBOX_KILLS = REGISTRY.counter(
+    'pyval_sandbox_kills_total',
+    'Sandbox processes killed at the timeout.')
+# Commands waiting in the admission scheduler.
+ADMISSION_QUEUED = REGISTRY.gauge(
+    'pyval_admission_queued',
+    'Commands waiting to run.')
+# Pastes.
+PASTE_SECONDS = REGISTRY.histogram(
+    'pyval_paste_seconds',
+    'Paste upload latency.')
+PASTE_FAILURES = REGISTRY.counter(
+    'pyval_paste_failures_total',
+    'Pastes that gave no url.')
+PASTE_CACHE = REGISTRY.counter(
+    'pyval_paste_cache_total',
+    'Paste cache lookups by result (hit, miss).',
+    labels=('result',))
+# Connection.
+SENDQ_DEPTH = REGISTRY.gauge(
+    'pyval_sendq_depth',
+    'Replies waiting in the outgoing queue.')
+HANDLING = REGISTRY.gauge(
+    'pyval_handling',
+    'Commands being handled (handlingcount).')
+REACTOR_LAG = REGISTRY.gauge(
+    'pyval_reactor_lag',
+    'Seconds the last timed call ran late.')
+REACTOR_LAG_SECONDS = REGISTRY.histogram(
+    'pyval_reactor_lag_seconds',
+    'How late timed calls run.',
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Paste Client
+    Uploads pastes to welbornprod.com/paste without blocking the reactor.
+    Requests go through a Twisted Agent with a persistent connection pool,
+    with connect/read timeouts and a few retries (with jitter) when the
+    paste site can't be reached.
+    A circuit breaker skips pasting while the paste site is failing, so
+    callers fall back to truncated chat output right away.
+"""
+
+import json
+import random
+from io import BytesIO
+from urlparse import urlparse
+
+from twisted.internet import defer, task
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.python import log
+from twisted.web.client import (
+    Agent,
+    FileBodyProducer,
+    HTTPConnectionPool,
+    readBody)
+from twisted.web.http_headers import Headers
+
+from pyval_util import NAME, VERSION
+
+PASTE_URL = 'https://welbornprod.com/paste/api/submit'
+# Errors from before the request is sent. Only these are retried, a request
+# that was sent may have made a paste already.
+RETRY_ERRORS = (ConnectError, DNSLookupError)
+
+
+class PasteError(Exception):
+
+    """ Raised when the paste site gives a bad response. """
+    pass
+
+
+def encode_paste(data):
+    """ Encode paste data (a dict, see pasteit()) for the paste api.
+        Returns None if it can't be encoded.
+    """
+    try:
+        return json.dumps(data).encode('utf-8')
+    except Exception as exenc:
+        log.msg('Unable to encode paste data: {}\n{}'.format(data, exenc))
+        return None
+
+
+def parse_response(resp, url=PASTE_URL, testing=False):
+    """ Get the paste url from a paste api response (json).
+        Returns None if there is no url.
+
+        Arguments:
+            resp     : Response body from the paste api.
+            url      : Paste api url, for the host of the paste url.
+            testing  : Return error messages as 'TESTERROR: msg', so the
+                       unit tests can print them.
+    """
+    try:
+        respdata = json.loads(resp)
+    except Exception as exjson:
+        log.msg('Unable to decode JSON from {}\n{}'.format(url, exjson))
+        return None
+
+    status = respdata.get('status', 'error')
+    if status == 'error':
+        # Server responded with json error response.
+        errmsg = respdata.get('message', '<no msg>')
+        log.msg('Paste site responded with error: {}'.format(errmsg))
+        # The error is most likely 'too many pastes in a row'.
+        if testing:
+            return 'TESTERROR: {}'.format(errmsg)
+        # Paste site errored, no url given to the chat user.
+        return None
+
+    # Good response.
+    suburl = respdata.get('url', None)
+    if suburl:
+        urlinfo = urlparse(url)
+        return '{}://{}{}'.format(urlinfo.scheme, urlinfo.netloc, suburl)
+
+    # No url found to respond with.
+    return None
+
+
+class CircuitBreaker(object):
+
+    """ Stops calls to a failing service for a while.
+        After `threshold` failures in a row the circuit opens, and
+        allow() returns False for `reset` seconds. Then one trial call is
+        allowed (half-open), which closes the circuit if it works, or
+        opens it again if it fails.
+    """
+
+    closed = 'closed'
+    opened = 'open'
+    half_open = 'half-open'
+
+    def __init__(self, clock, threshold=3, reset=60):
+        """ Arguments:
+                clock      : Provides seconds(), like the reactor.
+                threshold  : Failures in a row that open the circuit.
+                reset      : Seconds to wait before a trial call.
+        """
+        self.clock = clock
+        self.threshold = threshold
+        self.reset = reset
+        self.state = self.closed
+        self.failures = 0
+        # When the circuit was last opened, and how many times it was.
+        self.opened_time = None
+        self.opens = 0
+        # Set while the half-open trial call is running.
+        self.trying = False
+
+    def allow(self):
+        """ Returns True if a call may be made now. """
+        if self.state == self.opened:
+            if (self.clock.seconds() - self.opened_time) < self.reset:
+                return False
+            self.state = self.half_open
+            self.trying = False
+        if self.state == self.half_open:
+            if self.trying:
+                return False
+            self.trying = True
+        return True
+
+    def failure(self):
+        """ Record a failed call. """
+        self.failures += 1
+        self.trying = False
+        if (self.state == self.half_open) or (
+                self.failures >= self.threshold):
+            if self.state != self.opened:
+                self.opens += 1
+            self.state = self.opened
+            self.opened_time = self.clock.seconds()
+
+    def retry_after(self):
+        """ Seconds until a trial call is allowed (0 if it is now). """
+        if self.state != self.opened:
+            return 0
+        elapsed = self.clock.seconds() - self.opened_time
+        return max(int(self.reset - elapsed), 0)
+
+    def status(self):
+        """ Return a short status string for chat. """
+        if self.state == self.opened:
+            return '{} (retry in {}s)'.format(self.state, self.retry_after())
+        return self.state
+
+    def success(self):
+        """ Record a call that worked, closing the circuit. """
+        self.state = self.closed
+        self.failures = 0
+        self.trying = False
+
+
+class PasteClient(object):
+
+    """ Non-blocking client for the paste api.
+        paste() returns a Deferred that fires with the paste url, or with
+        None when pasting failed (or was skipped). It never errbacks.
+    """
+
+    def __init__(self, clock, url=PASTE_URL, connect_timeout=5,
+                 read_timeout=15, retries=2, retry_delay=1):
+        """ Arguments:
+                clock            : The reactor.
+                url              : Paste api url.
+                connect_timeout  : Seconds to wait for a connection.
+                read_timeout     : Seconds to wait for the response
+                                   headers, and then for the body.
+                retries          : Retries for a request that couldn't
+                                   connect.
+                retry_delay      : Base delay before retrying, doubled
+                                   for each retry, with jitter.
+        """
+        self.clock = clock
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        # Connections are kept open between pastes, a couple at most
+        # (the admission scheduler limits concurrent network commands).
+        self.pool = HTTPConnectionPool(clock, persistent=True)
+        self.pool.maxPersistentPerHost = 2
+        self.pool.cachedConnectionTimeout = 240
+        self.agent = Agent(
+            clock,
+            connectTimeout=connect_timeout,
+            pool=self.pool)
+        self.breaker = CircuitBreaker(clock)
+        self.headers = Headers({
+            'User-Agent': ['{} v. {}'.format(NAME, VERSION)],
+            'Content-Type': ['application/json; charset=utf-8'],
+            'Content-Encoding': ['utf-8'],
+        })
+        # Counters: pastes sent, failed (after retries), skipped (circuit
+        # open), and retries made.
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.retried = 0
+
+    def _attempt(self, body, attempt=0):
+        """ Make a request, retrying when it couldn't connect.
+            Returns a Deferred that fires with the response body.
+        """
+        def retry(failureobj):
+            if (attempt >= self.retries) or (not failureobj.check(
+                    *RETRY_ERRORS)):
+                return failureobj
+            self.retried += 1
+            delay = self.get_retry_delay(attempt)
+            log.msg('Paste request failed, retrying in {:.2f}s: {}'.format(
+                delay,
+                failureobj.getErrorMessage()))
+            return task.deferLater(
+                self.clock,
+                delay,
+                self._attempt,
+                body,
+                attempt=attempt + 1)
+
+        d = self.request(body)
+        d.addErrback(retry)
+        return d
+
+    def close(self):
+        """ Close pooled connections. Returns a Deferred. """
+        return self.pool.closeCachedConnections()
+
+    def get_retry_delay(self, attempt):
+        """ Delay before retry number `attempt + 1`, with jitter so
+            retries from several commands don't line up.
+        """
+        return self.retry_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def paste(self, data):
+        """ Submit a paste. data is a dict like pasteit() uses.
+            Returns a Deferred that fires with the url, or None.
+        """
+        if not self.breaker.allow():
+            self.skipped += 1
+            log.msg('Paste site is failing, skipping paste '
+                    '(retry in {}s).'.format(self.breaker.retry_after()))
+            return defer.succeed(None)
+        body = encode_paste(data)
+        if body is None:
+            self.breaker.success()
+            return defer.succeed(None)
+
+        def paste_done(resp):
+            self.breaker.success()
+            return parse_response(
+                resp,
+                url=self.url,
+                testing=data.get('author', '').startswith('<pyvaltest>'))
+
+        def paste_failed(failureobj):
+            self.breaker.failure()
+            self.failed += 1
+            log.msg('Unable to paste to {}: {}'.format(
+                self.url,
+                failureobj.getErrorMessage()))
+            return None
+
+        self.sent += 1
+        d = self._attempt(body)
+        d.addCallbacks(paste_done, paste_failed)
+        return d
+
+    def request(self, body):
+        """ Make one request to the paste api.
+            Returns a Deferred that fires with the response body.
+        """
+        def check_code(body, code):
+            if code >= 500:
+                raise PasteError('Paste site error: HTTP {}'.format(code))
+            return body
+
+        def read_response(response):
+            # The body is read either way, so the connection goes back
+            # to the pool.
+            bodyd = readBody(response)
+            bodyd.addTimeout(self.read_timeout, self.clock)
+            bodyd.addCallback(check_code, response.code)
+            return bodyd
+
+        d = self.agent.request(
+            b'POST',
+            self.url,
+            self.headers,
+            FileBodyProducer(BytesIO(body)))
+        d.addTimeout(self.read_timeout, self.clock)
+        d.addCallback(read_response)
+        return d
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return ', '.join((
+            'sent: {}'.format(self.sent),
+            'failed: {}'.format(self.failed),
+            'skipped: {}'.format(self.skipped),
+            'retried: {}'.format(self.retried),
+            'circuit: {}'.format(self.breaker.status()),
+        ))
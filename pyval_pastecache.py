@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Paste Cache
+    Remembers paste urls by a hash of the paste, so the same output (like
+    `import this`) isn't pasted again every time someone evaluates it.
+    Entries expire after `ttl` seconds, and the least recently used
+    entries are dropped when there are too many.
+
+    The cache is saved to a json file (written whole, to a temp file
+    first), in a thread when `threaded` is set.
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+from pyval_metrics import PASTE_CACHE
+
+
+def paste_key(content):
+    """ Return the cache key for paste content. """
+    if not isinstance(content, bytes):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
+
+
+class PasteCache(object):
+
+    """ LRU cache of paste urls {key: url} with expiring entries. """
+
+    def __init__(self, filename=None, maxsize=500, ttl=86400):
+        """ Arguments:
+                filename  : Json file to save to, None for no persistence.
+                maxsize   : Most urls to remember.
+                ttl       : Seconds a url is used for.
+        """
+        self.filename = filename
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # {key: (url, expire time)}, least recently used first.
+        self.entries = OrderedDict()
+        # Save in a thread (set once the reactor is running).
+        self.threaded = False
+        # Set while saving, and when another save is needed after it.
+        self.saving = False
+        self.dirty = False
+        # Lookups that found a url, and lookups that didn't.
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def __contains__(self, key):
+        return self.get(key, count=False) is not None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def expire(self, now=None):
+        """ Drop expired entries. Returns the number dropped. """
+        if now is None:
+            now = time.time()
+        expired = [
+            key for key, (_, expires) in self.entries.items()
+            if expires <= now
+        ]
+        for key in expired:
+            self.entries.pop(key)
+        return len(expired)
+
+    def get(self, key, now=None, count=True):
+        """ Return the url for a key, or None if there isn't one. """
+        if now is None:
+            now = time.time()
+        entry = self.entries.pop(key, None)
+        if (entry is None) or (entry[1] <= now):
+            if count:
+                self.misses += 1
+                PASTE_CACHE.inc(result='miss')
+            return None
+        # Most recently used now.
+        self.entries[key] = entry
+        if count:
+            self.hits += 1
+            PASTE_CACHE.inc(result='hit')
+        return entry[0]
+
+    def load(self):
+        """ Load entries from the cache file, dropping expired ones.
+            Returns False if there is no file, or it can't be read.
+        """
+        if (self.filename is None) or (not os.path.isfile(self.filename)):
+            return False
+        try:
+            with open(self.filename) as fread:
+                entries = json.load(fread)
+        except (EnvironmentError, ValueError) as ex:
+            log.msg('Unable to load paste cache: {}\n{}'.format(
+                self.filename,
+                ex))
+            return False
+
+        now = time.time()
+        for key, url, expires in entries[-self.maxsize:]:
+            if expires > now:
+                self.entries[key] = (url, expires)
+        return True
+
+    def put(self, key, url, now=None):
+        """ Remember the url for a key, and save the cache. """
+        if now is None:
+            now = time.time()
+        self.entries.pop(key, None)
+        self.entries[key] = (url, now + self.ttl)
+        while len(self.entries) > self.maxsize:
+            self.entries.pop(next(iter(self.entries)))
+        self.save()
+
+    def save(self):
+        """ Save the cache, unless a save is running (it saves again when
+            it's done).
+        """
+        if self.filename is None:
+            return None
+        if self.saving:
+            self.dirty = True
+            return None
+        self.saving = True
+        self.dirty = False
+        self.expire()
+        entries = [
+            [key, url, expires]
+            for key, (url, expires) in self.entries.items()
+        ]
+        if self.threaded:
+            d = threads.deferToThread(self.write, entries)
+        else:
+            d = defer.maybeDeferred(self.write, entries)
+        d.addErrback(self.save_failed)
+        d.addBoth(self.save_done)
+        return d
+
+    def save_done(self, result):
+        """ Callback for a finished save, saves again if needed. """
+        self.saving = False
+        if self.dirty:
+            self.save()
+        return result
+
+    def save_failed(self, failureobj):
+        """ Errback for a failed save, logs it. """
+        log.msg('Unable to save paste cache: {}\n{}'.format(
+            self.filename,
+            failureobj.getErrorMessage()))
+        return False
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return 'cached: {}/{}, hits: {}, misses: {}'.format(
+            len(self.entries),
+            self.maxsize,
+            self.hits,
+            self.misses)
+
+    def write(self, entries):
+        """ Write entries to the cache file, through a temp file. """
+        tmpname = '{}.tmp'.format(self.filename)
+        with open(tmpname, 'w') as f:
+            json.dump(entries, f)
+        os.rename(tmpname, self.filename)
+        return True
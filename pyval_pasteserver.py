@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Paste Server
+    A local paste backend, so long results don't depend on an outside
+    paste site. Pastes are stored in a directory, named by a hash of
+    their content (the same content is stored once), and served as plain
+    text by a small Twisted web resource: http://<host>:<port>/<key>
+
+    Pastes expire after `ttl` seconds, pastes over `maxsize` bytes are
+    refused, and the oldest pastes are removed when the store is over
+    `maxbytes`.
+"""
+
+from collections import OrderedDict
+import os
+import re
+import time
+
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.web import resource, server
+
+from pyval_pastecache import paste_key
+
+# Length of paste keys (hex digits of the content hash).
+KEY_LENGTH = 16
+keypat = re.compile('^[0-9a-f]{{{}}}$'.format(KEY_LENGTH))
+
+
+class PasteStore(object):
+
+    """ Content-addressed paste files in a directory. """
+
+    def __init__(self, directory, maxbytes=50 * 1024 * 1024,
+                 maxsize=512 * 1024, ttl=7 * 86400):
+        """ Arguments:
+                directory  : Directory for the paste files.
+                maxbytes   : Most bytes to keep, oldest pastes go first.
+                maxsize    : Largest paste (bytes).
+                ttl        : Seconds a paste is kept.
+        """
+        self.directory = directory
+        self.maxbytes = maxbytes
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # {key: (size, time added)}, oldest first.
+        self.index = OrderedDict()
+        self.totalbytes = 0
+        # Write files in a thread (set once the reactor is running).
+        self.threaded = False
+        # Pastes stored, refused (too big), and removed (expired/quota).
+        self.stored = 0
+        self.refused = 0
+        self.removed = 0
+        self.load()
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def _added(self, result, key, size, now):
+        """ Callback for a written paste, adds it to the index. """
+        self._remove_index(key)
+        self.index[key] = (size, now)
+        self.totalbytes += size
+        self.stored += 1
+        self.expire(now=now)
+        return key
+
+    def _remove_index(self, key):
+        """ Remove a key from the index, without removing its file. """
+        entry = self.index.pop(key, None)
+        if entry is not None:
+            self.totalbytes -= entry[0]
+        return entry
+
+    def add(self, content, now=None):
+        """ Store a paste. Returns a Deferred that fires with its key,
+            or None if it was refused.
+        """
+        if now is None:
+            now = time.time()
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        if len(content) > self.maxsize:
+            self.refused += 1
+            return defer.succeed(None)
+        key = paste_key(content)[:KEY_LENGTH]
+        if key in self.index:
+            # Already stored, it's new again.
+            size, _ = self._remove_index(key)
+            self.index[key] = (size, now)
+            self.totalbytes += size
+            try:
+                os.utime(self.get_path(key), None)
+            except EnvironmentError as ex:
+                log.msg('Unable to touch paste: {}\n{}'.format(key, ex))
+            return defer.succeed(key)
+        if self.threaded:
+            d = threads.deferToThread(self.write, key, content)
+        else:
+            d = defer.maybeDeferred(self.write, key, content)
+        d.addCallback(self._added, key, len(content), now)
+        return d
+
+    def expire(self, now=None):
+        """ Remove expired pastes, and the oldest pastes while the store
+            is over its size limit.
+        """
+        if now is None:
+            now = time.time()
+        oldest = now - self.ttl
+        while self.index:
+            key = next(iter(self.index))
+            size, added = self.index[key]
+            if (added > oldest) and (self.totalbytes <= self.maxbytes):
+                break
+            self.remove(key)
+
+    def get(self, key, now=None):
+        """ Return the content for a key (bytes), or None. """
+        if (not keypat.match(key or '')) or (key not in self.index):
+            return None
+        if now is None:
+            now = time.time()
+        if self.index[key][1] <= (now - self.ttl):
+            self.remove(key)
+            return None
+        try:
+            with open(self.get_path(key), 'rb') as f:
+                return f.read()
+        except EnvironmentError as ex:
+            log.msg('Unable to read paste: {}\n{}'.format(key, ex))
+            self._remove_index(key)
+            return None
+
+    def get_path(self, key):
+        """ Return the file path for a key. """
+        return os.path.join(self.directory, '{}.txt'.format(key))
+
+    def load(self):
+        """ Index the paste files already in the directory, creating the
+            directory if needed.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            return None
+        entries = []
+        for filename in os.listdir(self.directory):
+            key, ext = os.path.splitext(filename)
+            if (ext != '.txt') or (not keypat.match(key)):
+                continue
+            stat = os.stat(os.path.join(self.directory, filename))
+            entries.append((stat.st_mtime, key, stat.st_size))
+        for added, key, size in sorted(entries):
+            self.index[key] = (size, added)
+            self.totalbytes += size
+        self.expire()
+
+    def remove(self, key):
+        """ Remove a paste. """
+        if self._remove_index(key) is None:
+            return None
+        self.removed += 1
+        try:
+            os.remove(self.get_path(key))
+        except EnvironmentError as ex:
+            log.msg('Unable to remove paste: {}\n{}'.format(key, ex))
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return 'pastes: {}, bytes: {}/{}, refused: {}, removed: {}'.format(
+            len(self.index),
+            self.totalbytes,
+            self.maxbytes,
+            self.refused,
+            self.removed)
+
+    def write(self, key, content):
+        """ Write a paste file, through a temp file. """
+        path = self.get_path(key)
+        tmpname = '{}.tmp'.format(path)
+        with open(tmpname, 'wb') as f:
+            f.write(content)
+        os.rename(tmpname, path)
+        return True
+
+
+class PasteResource(resource.Resource):
+
+    """ Serves pastes from a PasteStore as plain text: /<key> """
+
+    isLeaf = True
+
+    def __init__(self, store):
+        resource.Resource.__init__(self)
+        self.store = store
+
+    def render_GET(self, request):
+        key = request.postpath[0] if request.postpath else ''
+        content = self.store.get(key)
+        if content is None:
+            request.setResponseCode(404)
+            request.setHeader(b'Content-Type', b'text/plain')
+            return b'No paste found.'
+        request.setHeader(b'Content-Type', b'text/plain; charset=utf-8')
+        request.setHeader(b'X-Content-Type-Options', b'nosniff')
+        return content
+
+
+class LocalPaster(object):
+
+    """ Paste backend for a PasteStore, with the same paste()/status()
+        as pyval_paste.PasteClient. There is no network round trip.
+    """
+
+    def __init__(self, store, baseurl):
+        """ Arguments:
+                store    : PasteStore to add pastes to.
+                baseurl  : Public url for the paste server,
+                           like 'http://example.com:8000'.
+        """
+        self.store = store
+        self.baseurl = baseurl.rstrip('/')
+
+    def close(self):
+        return defer.succeed(None)
+
+    def paste(self, data):
+        """ Store a paste. data is a dict like pasteit() uses.
+            Returns a Deferred that fires with the url, or None.
+        """
+        def paste_done(key):
+            if key is None:
+                return None
+            return '{}/{}'.format(self.baseurl, key)
+
+        def paste_failed(failureobj):
+            log.msg('Unable to store paste: {}'.format(
+                failureobj.getErrorMessage()))
+            return None
+
+        d = self.store.add(data.get('content', ''))
+        d.addCallbacks(paste_done, paste_failed)
+        return d
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return 'local {}'.format(self.store.status())
+
+
+def listen_pastes(reactor, store, port, interface=''):
+    """ Serve pastes from a PasteStore. Returns the listening port. """
+    site = server.Site(PasteResource(store))
+    # Don't log every request.
+    site.noisy = False
+    site.log = lambda request: None
+    return reactor.listenTCP(port, site, interface=interface)
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal CPU Quotas
+    Tracks CPU seconds used by evaluations per nick/channel over a rolling
+    window, so one user can't keep a worker to themselves.
+"""
+
+from collections import deque
+import time
+
+
+class CPUQuota(object):
+
+    """ CPU-time budget for a kind of key (nicks or channels).
+        Usage is recorded with add(), and expires after `window` seconds.
+        Keys with no usage in the window are forgotten.
+    """
+
+    def __init__(self, limit=30, window=300):
+        """ Arguments:
+                limit   : CPU seconds allowed per key in the window.
+                          0 disables the limit (usage is still tracked).
+                window  : Length of the rolling window in seconds.
+        """
+        self.limit = limit
+        self.window = window
+        # {key: deque([(time, cpu seconds), ...])}
+        self.usage = {}
+
+    def add(self, key, secs, now=None):
+        """ Record CPU seconds used by a key. """
+        if (not key) or (secs <= 0):
+            return None
+        if now is None:
+            now = time.time()
+        self.usage.setdefault(key, deque()).append((now, secs))
+        self.expire(key, now=now)
+
+    def expire(self, key, now=None):
+        """ Drop usage older than the window for a key. """
+        entries = self.usage.get(key, None)
+        if entries is None:
+            return None
+        if now is None:
+            now = time.time()
+        oldest = now - self.window
+        while entries and (entries[0][0] <= oldest):
+            entries.popleft()
+        if not entries:
+            self.usage.pop(key)
+
+    def is_over(self, key, now=None):
+        """ Returns True if a key has used up its budget. """
+        return (self.limit > 0) and (self.used(key, now=now) >= self.limit)
+
+    def prune(self, now=None):
+        """ Expire usage for every key, forgetting idle keys. """
+        if now is None:
+            now = time.time()
+        for key in list(self.usage):
+            self.expire(key, now=now)
+
+    def remaining(self, key, now=None):
+        """ CPU seconds left for a key, or None when there is no limit. """
+        if self.limit <= 0:
+            return None
+        return max(self.limit - self.used(key, now=now), 0)
+
+    def retry_after(self, key, now=None):
+        """ Seconds until enough usage expires to get back under the limit.
+            Returns 0 if the key is not over its budget.
+        """
+        if now is None:
+            now = time.time()
+        if not self.is_over(key, now=now):
+            return 0
+        total = self.used(key, now=now)
+        for when, secs in self.usage.get(key, ()):
+            total -= secs
+            if total < self.limit:
+                return max(int((when + self.window) - now + 1), 1)
+        return self.window
+
+    def status(self, key, now=None):
+        """ Return a short status string for a key. """
+        used = self.used(key, now=now)
+        remaining = self.remaining(key, now=now)
+        if remaining is None:
+            return '{}: used {:.2f}s (no limit)'.format(key, used)
+        return '{}: used {:.2f}s of {}s, {:.2f}s left ({}s window)'.format(
+            key,
+            used,
+            self.limit,
+            remaining,
+            self.window)
+
+    def top(self, count=5, now=None):
+        """ Return the biggest users as a list of (key, cpu seconds). """
+        self.prune(now=now)
+        totals = [(key, self.used(key, now=now)) for key in self.usage]
+        totals.sort(key=lambda item: item[1], reverse=True)
+        return totals[:count]
+
+    def used(self, key, now=None):
+        """ CPU seconds used by a key in the current window. """
+        self.expire(key, now=now)
+        return sum(secs for _, secs in self.usage.get(key, ()))
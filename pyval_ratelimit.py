@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Rate Limiter
+    Per-nick command rate limiting with GCRA (the generic cell rate
+    algorithm), which behaves like a token bucket but only needs one
+    timestamp per nick. Nicks that have been quiet long enough are
+    forgotten, so memory stays bounded by the number of recent nicks.
+"""
+
+from collections import OrderedDict
+import time
+
+
+class RateLimiter(object):
+
+    """ Allows `burst` commands at once per key, then one command every
+        `interval` seconds.
+        allow() and the expiring of idle keys are O(1) (amortized).
+    """
+
+    def __init__(self, interval=3, burst=2):
+        """ Arguments:
+                interval  : Seconds per command, once the burst is used.
+                burst     : Commands that can be sent at once.
+        """
+        self.interval = interval
+        self.burst = burst
+        # {key: theoretical arrival time}, least recently updated first.
+        # A key is idle (same as a new key) once its time has passed.
+        self.tats = OrderedDict()
+
+    def __len__(self):
+        return len(self.tats)
+
+    def allow(self, key, now=None):
+        """ Returns True if the key may send a command now, and counts it.
+            Commands that are refused aren't counted.
+        """
+        if now is None:
+            now = time.time()
+        self.expire(now=now)
+        tat = max(self.tats.get(key, now), now)
+        if tat - now > self.interval * (self.burst - 1):
+            return False
+        # Move the key to the end, it is the most recently updated now.
+        self.tats.pop(key, None)
+        self.tats[key] = tat + self.interval
+        return True
+
+    def expire(self, now=None):
+        """ Forget idle keys, starting with the least recently updated.
+            Stops at the first key that isn't idle. Every key updated
+            before it is gone, so the keys left were all updated in the
+            last `interval * burst` seconds.
+        """
+        if now is None:
+            now = time.time()
+        while self.tats:
+            key = next(iter(self.tats))
+            if self.tats[key] > now:
+                break
+            self.tats.pop(key)
+
+    def retry_after(self, key, now=None):
+        """ Seconds until the key may send another command (0 if it can
+            send one now).
+        """
+        if now is None:
+            now = time.time()
+        tat = self.tats.get(key, now)
+        return max((tat + self.interval) - (self.interval * self.burst) - now,
+                   0)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Command Registry
+    Commands are CommandFuncs methods named admin_<name> or cmd_<name>.
+    Each one declares its help, aliases, flags, and cost class with the
+    @command() decorator, and the registry is built from them once.
+
+    Cost classes decide how commands are admitted (see pyval_admission):
+        instant     : Quick commands, they always run right away.
+        evaluation  : Sandboxed evaluations, limited to the worker count.
+        network     : Commands that wait on other servers.
+"""
+
+COST_INSTANT = 'instant'
+COST_EVALUATION = 'evaluation'
+COST_NETWORK = 'network'
+COST_CLASSES = (COST_INSTANT, COST_EVALUATION, COST_NETWORK)
+
+# Method name prefixes for each role.
+ROLE_PREFIXES = (('admin', 'admin_'), ('user', 'cmd_'))
+
+# Flags a command can have:
+#   hidden  : Not listed in the help command lists.
+#   traced  : Takes a `trace` keyword argument (pyval_trace.Trace), to add
+#             spans for its own stages.
+#   caller  : Takes `is_admin` and `channel` keyword arguments, whether the
+#             message's nick!user@host is an admin, and the channel it came
+#             from (None for private messages). Both are from when the
+#             message was received, not when the command runs.
+FLAG_CALLER = 'caller'
+FLAG_HIDDEN = 'hidden'
+FLAG_TRACED = 'traced'
+
+
+def command(args=None, desc=None, aliases=None, cost=COST_INSTANT,
+            flags=None):
+    """ Decorator for command methods, declares how the command is listed,
+        documented, and admitted.
+
+        Arguments:
+            args     : Argument usage string for help, like '<nick>'.
+            desc     : Help description.
+            aliases  : Other names for the command.
+            cost     : Cost class, one of COST_CLASSES.
+            flags    : Flags for the command, like (FLAG_HIDDEN,).
+    """
+    if cost not in COST_CLASSES:
+        raise ValueError('Invalid cost class: {}'.format(cost))
+
+    def decorator(func):
+        func.command_info = {
+            'args': args,
+            'desc': desc,
+            'aliases': tuple(aliases or ()),
+            'cost': cost,
+            'flags': frozenset(flags or ()),
+        }
+        return func
+    return decorator
+
+
+class Command(object):
+
+    """ A registered command, calling it calls the command's method. """
+
+    def __init__(self, name, role, func, args=None, desc=None, aliases=None,
+                 cost=COST_INSTANT, flags=None):
+        self.name = name
+        self.role = role
+        self.func = func
+        self.args = args
+        self.desc = desc
+        self.aliases = tuple(aliases or ())
+        self.cost = cost
+        self.flags = frozenset(flags or ())
+
+    def __call__(self, *args, **kwargs):
+        return self.func(*args, **kwargs)
+
+    def __repr__(self):
+        return 'Command({!r}, role={!r}, cost={!r})'.format(
+            self.name,
+            self.role,
+            self.cost)
+
+    def help(self, cmdchar='!'):
+        """ Return a help string for this command. """
+        usage = '{}{}'.format(cmdchar, self.name)
+        if self.args:
+            usage = '{} {}'.format(usage, self.args)
+        helpstr = '{}: {}'.format(usage, self.desc or 'no help available.')
+        if self.aliases:
+            helpstr = '{} (also: {})'.format(
+                helpstr,
+                ', '.join(self.aliases))
+        return helpstr
+
+
+class CommandRegistry(object):
+
+    """ Commands for each role, found once on a CommandFuncs instance. """
+
+    def __init__(self, funcs):
+        """ Arguments:
+                funcs  : Object with admin_/cmd_ command methods.
+        """
+        # {role: {name or alias: Command}}
+        self.commands = dict((role, {}) for role, _ in ROLE_PREFIXES)
+        # {role: [sorted listed command names]}
+        self.listed = {}
+        for attr in dir(funcs):
+            for role, prefix in ROLE_PREFIXES:
+                if attr.startswith(prefix):
+                    self.register(
+                        attr[len(prefix):],
+                        role,
+                        getattr(funcs, attr))
+        for role, commands in self.commands.items():
+            self.listed[role] = sorted(
+                name for name, cmd in commands.items()
+                if (name == cmd.name) and (FLAG_HIDDEN not in cmd.flags))
+
+    def get(self, name, role='user'):
+        """ Return the Command for a name or alias, or None. """
+        return self.commands[role].get(name.lower(), None)
+
+    def names(self, role='user'):
+        """ Return a sorted list of listed command names for a role. """
+        return list(self.listed[role])
+
+    def register(self, name, role, func):
+        """ Register a command method under its name and aliases. """
+        info = getattr(func, 'command_info', {})
+        cmd = Command(name, role, func, **info)
+        for cmdname in (name, ) + cmd.aliases:
+            if cmdname in self.commands[role]:
+                raise ValueError('Duplicate {} command: {}'.format(
+                    role,
+                    cmdname))
+            self.commands[role][cmdname] = cmd
+        return cmd
@@ -20,7 +20,15 @@
 """
 
 from code import InteractiveInterpreter
+from itertools import islice, repeat
+import os
 import sys
+from timeit import default_timer
+try:
+    from repr import Repr
+except ImportError:
+    # Python 3.
+    from reprlib import Repr
 
 
 NAME = 'pyval_sandbox.py'
@@ -28,23 +36,100 @@ VERSION = '1.0.1'
 VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
 
 
-# Provide user with a couple builtin modules.
-whitelist_modules = ['math', 're']
-# Function that returns white listed modules
-modules = lambda: 'modules are: {}'.format(', '.join(whitelist_modules))
-# Fixed globals()/locals() for Interpreter.
-dumblocals = {'__builtins__': None,
-              'modules': modules,
-              # quick way to test if code is running in the sandbox.
-              # if __name__ == '__pyval__'
-              '__name__': '__pyval__',
-              }
-for okmodule in whitelist_modules:
-    dumblocals[okmodule] = __import__(okmodule)
+# Modules available to evaluated code, unless pyval_exec sends a different
+# list with --modules=name,name.
+whitelist_modules = [
+    'collections',
+    'functools',
+    'itertools',
+    'json',
+    'math',
+    're',
+    'string',
+]
+
+
+def build_locals(modulenames):
+    """ Build the fixed globals()/locals() for the Interpreter.
+        Modules are lazy, they are not imported until they are used.
+    """
+    names = sorted(modulenames)
+    # Function that returns white listed modules
+    modules = lambda: 'modules are: {}'.format(', '.join(names))
+    newlocals = {
+        '__builtins__': None,
+        'modules': modules,
+        # quick way to test if code is running in the sandbox.
+        # if __name__ == '__pyval__'
+        '__name__': '__pyval__',
+    }
+    for name in names:
+        newlocals[name] = lazy_module(name)
+    return newlocals
+
+
+def lazy_module(name):
+    """ Return a stand-in for a module that imports it on first use.
+        The module name is kept in a closure, so evaluated code can't
+        point the stand-in at a different module.
+    """
+    loaded = []
+
+    def load():
+        if not loaded:
+            loaded.append(__import__(name))
+        return loaded[0]
+
+    class LazyModule(object):
+        __slots__ = ()
+
+        def __getattribute__(self, attr):
+            return getattr(load(), attr)
+
+        def __setattr__(self, attr, value):
+            setattr(load(), attr, value)
+
+        def __repr__(self):
+            return repr(load())
+
+    return LazyModule()
+
+
+dumblocals = build_locals(whitelist_modules)
 
 
 class Compiler(InteractiveInterpreter):
 
+    def __init__(self, locals=None, steps=0):
+        """ Arguments:
+                locals  : Globals/locals for the interpreter.
+                steps   : Maximum number of traced steps (calls, lines,
+                          returns) the code may use. 0 means no limit.
+        """
+        InteractiveInterpreter.__init__(self, locals=locals)
+        self.steps = steps
+        self.stepcount = 0
+
+    def runcode(self, code):
+        """ Execute a code object, enforcing the step budget if set.
+            Time spent inside builtin functions is not counted, the
+            wall-clock timeout still applies to that.
+        """
+        self.stepcount = 0
+        if self.steps:
+            sys.settrace(self.trace_steps)
+        try:
+            exec(code, self.locals)
+        except SystemExit:
+            raise
+        except OutputLimitExceeded:
+            # main() reports the truncation.
+            pass
+        except:
+            self.showtraceback()
+        finally:
+            sys.settrace(None)
+
     def runsource(self, source, filename="<input>", symbol="single"):
         """ Compile and run some source in the interpreter.
             Arguments are as for compile_command().
@@ -69,15 +154,393 @@ class Compiler(InteractiveInterpreter):
         return False
 
     def send_error(self, exception):
-        """ Send basic error msg to stdout. """
-        sys.stdout.write('{}'.format(exception))
+        """ Send basic error msg to stdout.
+            This skips the output limit on sys.stdout, if any.
+        """
+        sys.__stdout__.write('{}'.format(exception))
+
+    def steps_exceeded(self):
+        """ Stop the sandbox because the step budget is used up.
+            The process exits right away instead of raising, because the
+            evaluated code could catch an exception (and CPython/PyPy stop
+            tracing once a trace function raises).
+        """
+        self.send_error(
+            '\nstep budget exceeded ({} steps).'.format(self.steps))
+        sys.stdout.flush()
+        sys.__stdout__.flush()
+        os._exit(0)
+
+    def trace_steps(self, frame, event, arg):
+        """ Trace function for sys.settrace(), counts every event. """
+        self.stepcount += 1
+        if self.stepcount > self.steps:
+            self.steps_exceeded()
+        return self.trace_steps
+
+
+class BoundedRepr(Repr):
+
+    """ A reprlib-style Repr that stops building once a size budget is
+        reached. Small results look exactly like repr() (no sorting, no
+        shortening), only large or deeply nested ones are cut with '...'.
+        Use the displayhook() method as sys.displayhook.
+    """
+
+    def __init__(self, maxchars, maxitems=10000, maxlevel=20):
+        """ Arguments:
+                maxchars  : Total size budget, also the limit for strings
+                            and other single values.
+                maxitems  : Maximum items shown for each container.
+                maxlevel  : Maximum nesting depth.
+        """
+        Repr.__init__(self)
+        self.maxchars = maxchars
+        self.maxlevel = maxlevel
+        self.maxtuple = self.maxlist = self.maxarray = maxitems
+        self.maxdict = self.maxset = self.maxfrozenset = maxitems
+        self.maxdeque = maxitems
+        self.maxstring = self.maxlong = self.maxother = maxchars
+
+    def _repr_iterable(self, x, level, left, right, maxiter, trail=''):
+        """ Like Repr._repr_iterable, but stops at the size budget. """
+        n = len(x)
+        if level <= 0 and n:
+            return '{}...{}'.format(left, right)
+        pieces = self._repr_pieces(
+            (self.repr1(elem, level - 1) for elem in islice(x, maxiter)),
+            len(left) + len(right))
+        if len(pieces) < n:
+            pieces.append('...')
+        if n == 1 and trail:
+            right = trail + right
+        return ''.join((left, ', '.join(pieces), right))
+
+    def _repr_pieces(self, pieces, size):
+        """ Collect item reprs until the size budget is used up.
+            Room is left for the ', ...' that marks cut containers.
+        """
+        collected = []
+        for piece in pieces:
+            size += len(piece) + 2
+            if size + 5 > self.maxchars:
+                break
+            collected.append(piece)
+        return collected
+
+    def displayhook(self, value):
+        """ sys.displayhook replacement, for 'single' mode results. """
+        if value is None:
+            return None
+        sys.stdout.write('{}\n'.format(self.repr(value)))
+
+    def repr_dict(self, x, level):
+        n = len(x)
+        if n == 0:
+            return '{}'
+        if level <= 0:
+            return '{...}'
+        pieces = self._repr_pieces(
+            (
+                '{}: {}'.format(
+                    self.repr1(key, level - 1),
+                    self.repr1(x[key], level - 1))
+                for key in islice(x, self.maxdict)
+            ),
+            2)
+        if len(pieces) < n:
+            pieces.append('...')
+        return '{{{}}}'.format(', '.join(pieces))
+
+    def repr_frozenset(self, x, level):
+        # Repr sorts sets, repr() doesn't.
+        return self._repr_iterable(
+            x,
+            level,
+            'frozenset([',
+            '])',
+            self.maxfrozenset)
+
+    def repr_set(self, x, level):
+        return self._repr_iterable(x, level, 'set([', '])', self.maxset)
+
+    def repr_unicode(self, x, level):
+        return self.repr_str(x, level)
+
+
+class BoundedWriter(object):
+
+    """ Replacement for sys.stdout that stops writing after maxbytes.
+        When the limit is hit, the output up to the limit is written,
+        self.truncated is set, and OutputLimitExceeded is raised to stop
+        the evaluated code. Any later write raises it again, so huge output
+        is never sent through the pipe.
+    """
+
+    def __init__(self, stream, maxbytes):
+        self.stream = stream
+        self.maxbytes = maxbytes
+        self.written = 0
+        self.truncated = False
+        # Used by the print statement.
+        self.softspace = 0
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def flush(self):
+        self.stream.flush()
+
+    def write(self, s):
+        if self.truncated:
+            raise OutputLimitExceeded(self.maxbytes)
+        remaining = self.maxbytes - self.written
+        if len(s) > remaining:
+            self.stream.write(s[:remaining])
+            self.written = self.maxbytes
+            self.truncated = True
+            raise OutputLimitExceeded(self.maxbytes)
+        self.stream.write(s)
+        self.written += len(s)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+
+class OutputLimitExceeded(BaseException):
+
+    """ Raised by BoundedWriter when the output limit is reached.
+        This is not an Exception subclass, so 'except Exception' in the
+        evaluated code won't catch it.
+    """
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        BaseException.__init__(
+            self,
+            '(...output truncated at {} bytes.)'.format(maxbytes))
+
+
+class SnippetTimer(object):
+
+    """ Times snippets of code like timeit, inside a total time budget.
+        The loop count for each snippet is picked adaptively, doubling
+        until one repeat takes a fair share of the budget, so slow code
+        runs a few times and fast code runs many times.
+    """
+    # Separates snippets to compare, like: a = 1 + 1 ;; a = 1 * 2
+    # (must match TIMEIT_DELIMITER in pyval_util)
+    delimiter = ' ;; '
+    # Template for the timing loop, the snippet is indented into it.
+    template = '\n'.join((
+        'def inner(_it, _timer):',
+        '    _t0 = _timer()',
+        '    for _i in _it:',
+        '        {stmt}',
+        '        pass',
+        '    return _timer() - _t0',
+    ))
+
+    def __init__(self, locals=None, budget=2.5, repeats=5, tracer=None):
+        """ Arguments:
+                locals   : Globals for the snippets.
+                budget   : Total seconds allowed for all snippets.
+                repeats  : Maximum number of timing samples per snippet.
+                tracer   : Trace function installed while the snippets
+                           run (like Compiler.trace_steps for the step
+                           budget), or None.
+        """
+        self.locals = locals if locals is not None else {}
+        self.budget = budget
+        self.repeats = repeats
+        self.tracer = tracer
+
+    @staticmethod
+    def get_unit(secs):
+        """ Pick the best unit for some seconds, like timeit.
+            Returns (unit name, scale).
+        """
+        for unit, scale in (('sec', 1.0), ('msec', 1e3), ('usec', 1e6)):
+            if secs >= (1.0 / scale):
+                return unit, scale
+        return 'nsec', 1e9
+
+    def make_inner(self, source):
+        """ Compile a snippet into a timing function. """
+        stmt = source.strip().replace('\n', '\n        ')
+        code = compile(
+            self.template.format(stmt=stmt),
+            '<timeit>',
+            'exec')
+        namespace = {}
+        exec(code, self.locals, namespace)
+        return namespace['inner']
+
+    def run(self, source):
+        """ Time all snippets in the source, returns a report string. """
+        snippets = [
+            snippet for snippet in source.split(self.delimiter)
+            if snippet.strip()
+        ]
+        if not snippets:
+            return 'nothing to time.'
+        results = []
+        budget = self.budget / len(snippets)
+        for index, snippet in enumerate(snippets):
+            if self.tracer is not None:
+                sys.settrace(self.tracer)
+            try:
+                inner = self.make_inner(snippet)
+                number, times = self.time_inner(inner, budget)
+            except OutputLimitExceeded:
+                raise
+            except Exception as ex:
+                return 'snippet {}: {}: {}'.format(
+                    index + 1,
+                    type(ex).__name__,
+                    ex)
+            finally:
+                sys.settrace(None)
+            results.append((number, times))
+
+        lines = [
+            self.format_result(
+                number,
+                times,
+                label='[{}] '.format(i + 1) if len(results) > 1 else '')
+            for i, (number, times) in enumerate(results)
+        ]
+        if len(results) > 1:
+            basemin = min(results[0][1])
+            for i, (_, times) in enumerate(results[1:]):
+                ratio = min(times) / basemin if basemin else 0
+                if ratio >= 1:
+                    desc = '{:.3g}x slower'.format(ratio)
+                else:
+                    desc = '{:.3g}x faster'.format(
+                        (1 / ratio) if ratio else float('inf'))
+                lines.append('[{}] is {}'.format(i + 2, desc))
+        return '\n'.join(lines)
+
+    def format_result(self, number, times, label=''):
+        """ Format min/median/stddev per loop for one snippet. """
+        times = sorted(times)
+        count = len(times)
+        mid = count // 2
+        if count % 2:
+            median = times[mid]
+        else:
+            median = (times[mid - 1] + times[mid]) / 2
+        mean = sum(times) / count
+        stddev = (sum((t - mean) ** 2 for t in times) / count) ** 0.5
+        unit, scale = self.get_unit(times[0])
+        return (
+            '{}{} loop{} x {}: min {:.3g}, median {:.3g}, stddev {:.3g} {}'
+        ).format(
+            label,
+            number,
+            '' if number == 1 else 's',
+            count,
+            times[0] * scale,
+            median * scale,
+            stddev * scale,
+            unit)
+
+    def time_inner(self, inner, budget):
+        """ Run a timing function inside a budget.
+            Returns (loops per repeat, [seconds per loop, ...])
+        """
+        deadline = default_timer() + budget
+        # Aim for `repeats` samples, with room left for calibration.
+        target = budget / (self.repeats * 2)
+        number = 1
+        while True:
+            elapsed = inner(repeat(None, number), default_timer)
+            remaining = deadline - default_timer()
+            if (elapsed >= target) or ((elapsed * 3) > remaining):
+                break
+            number *= 2
+        times = [elapsed / number]
+        while len(times) < self.repeats:
+            if (deadline - default_timer()) < elapsed:
+                # Another repeat would go over the budget.
+                break
+            times.append(inner(repeat(None, number), default_timer) / number)
+        return number, times
+
+
+def parse_args(args):
+    """ Parse '--name=value' options sent by pyval_exec.
+        Returns a dict of {name: value}.
+    """
+    argd = {}
+    for arg in args:
+        name, _, value = arg.partition('=')
+        argd[name.lstrip('-')] = value
+    return argd
+
+
+def parse_int(s, default=0):
+    """ Parse an int from a string, returns default on failure. """
+    try:
+        return int(s)
+    except (TypeError, ValueError):
+        return default
+
+
+def parse_float(s, default=0.0):
+    """ Parse a float from a string, returns default on failure. """
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return default
 
 
 def main(args):
     """ Main entry point, expects args from sys. """
+    argd = parse_args(args)
     # Read python source from stdin.
     source = sys.stdin.read()
-    compiler = Compiler(locals=dumblocals)
+    # Stop output at the source when it gets too big.
+    maxoutput = parse_int(argd.get('maxoutput', None))
+    if maxoutput > 0:
+        sys.stdout = BoundedWriter(sys.stdout, maxoutput)
+        # Don't build reprs bigger than the output limit.
+        # (leaving room for the newline)
+        sys.displayhook = BoundedRepr(maxoutput - 1).displayhook
+    if argd.get('modules', None) is not None:
+        evallocals = build_locals(
+            name.strip() for name in argd['modules'].split(',') if name.strip()
+        )
+    else:
+        evallocals = dumblocals
+    compiler = Compiler(
+        locals=evallocals,
+        steps=parse_int(argd.get('steps', None)))
+    timebudget = parse_float(argd.get('time', None))
+    if timebudget > 0:
+        # Timing mode. The time budget keeps the total inside the
+        # evaluation timeout, and the step budget still applies (tracing
+        # makes the loops slower, but they are timed the same way).
+        timer = SnippetTimer(
+            locals=evallocals,
+            budget=timebudget,
+            tracer=compiler.trace_steps if compiler.steps else None)
+        try:
+            print(timer.run(source))
+        except OutputLimitExceeded:
+            pass
+    else:
+        run_source(compiler, source)
+
+    if getattr(sys.stdout, 'truncated', False):
+        sys.stdout.flush()
+        compiler.send_error('\n{}'.format(OutputLimitExceeded(maxoutput)))
+
+
+def run_source(compiler, source):
+    """ Compile and run source with the Compiler, sending errors. """
     try:
         if '\n' in source:
             # multiline, must use print() to get output.
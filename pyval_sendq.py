@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Send Queue
+    Paces outgoing replies with a token bucket, so bursts go out right away
+    but the server never sees more than it allows. Replies wait in
+    per-target queues, served round-robin, and short replies waiting for
+    the same target are merged into one line.
+"""
+
+from collections import deque
+
+from twisted.python import log
+
+# Server numerics that mean we are sending too fast.
+# RPL_TRYAGAIN (263), ERR_TOOMANYTARGETS (407), ERR_TARGETTOOFAST (439),
+# and ERR_TARGCHANGE (707). Twisted passes the known ones by name.
+FLOOD_NUMERICS = ('RPL_TRYAGAIN', 'ERR_TOOMANYTARGETS', '439', '707')
+
+
+class SendQueue(object):
+
+    """ Outgoing message queue for one connection.
+        add() queues a message, and it is sent with `send(target, msg)`
+        as soon as the token bucket allows it.
+        backoff() is called when the server complains about flooding.
+    """
+
+    def __init__(self, send, clock, rate=0.5, burst=5, maxlength=300):
+        """ Arguments:
+                send       : Function to send a message, send(target, msg).
+                clock      : Provides seconds() and callLater(),
+                             like the reactor.
+                rate       : Messages per second, once the burst is used.
+                burst      : Messages that can be sent at once
+                             (size of the bucket).
+                maxlength  : Longest line that merged messages can make.
+        """
+        self.send = send
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.maxlength = maxlength
+        # Separator for merged messages.
+        self.joiner = ' | '
+        # Tokens available now, and when they were last refilled.
+        self.tokens = float(burst)
+        self.refilled = clock.seconds()
+        # {target: deque([(time added, msg, sent callback), ...])}
+        self.queues = {}
+        # Targets with waiting messages, in the order they are served.
+        self.order = deque()
+        # Pending callLater for the next send, if any.
+        self.pending = None
+        # Nothing is sent before this time (server feedback backoff).
+        self.paused_until = 0
+        # Backoff doubles when the server complains again within
+        # backoff_reset seconds.
+        self.backoff_min = 2
+        self.backoff_max = 60
+        self.backoff_reset = 60
+        self.backoff_secs = 0
+        self.backoff_last = None
+        # Counters, and recent send latencies (seconds in the queue).
+        self.added = 0
+        self.sent = 0
+        self.merged = 0
+        self.backoffs = 0
+        self.latencies = deque(maxlen=100)
+
+    def _refill(self, now):
+        """ Add tokens for the time since the last refill.
+            Nothing is added before the end of a backoff pause.
+        """
+        if now <= self.refilled:
+            return None
+        elapsed = now - self.refilled
+        self.tokens = min(self.tokens + (elapsed * self.rate), self.burst)
+        self.refilled = now
+
+    def _schedule(self, delay):
+        """ Make sure _pump() runs within `delay` seconds. """
+        if self.pending is not None:
+            if self.pending.getTime() <= self.clock.seconds() + delay:
+                return None
+            self.pending.cancel()
+        self.pending = self.clock.callLater(delay, self._pump)
+
+    def _pump(self):
+        """ Send waiting messages while there are tokens. """
+        self.pending = None
+        now = self.clock.seconds()
+        self._refill(now)
+        while self.order:
+            if now < self.paused_until:
+                self._schedule(self.paused_until - now)
+                return None
+            if self.tokens < 1:
+                self._schedule((1 - self.tokens) / self.rate)
+                return None
+            target = self.order.popleft()
+            queue = self.queues[target]
+            msg, oldest, count, callbacks = self.pop_merged(queue)
+            if queue:
+                self.order.append(target)
+            else:
+                self.queues.pop(target)
+            self.tokens -= 1
+            self.sent += 1
+            self.merged += count - 1
+            self.latencies.append(now - oldest)
+            self.send(target, msg)
+            for sent in callbacks:
+                sent(now)
+
+    def add(self, target, msg, sent=None):
+        """ Queue a message for a target (nick or channel).
+            sent(time) is called when the message is sent, if given.
+        """
+        if not msg:
+            return None
+        self.added += 1
+        queue = self.queues.get(target, None)
+        if queue is None:
+            queue = self.queues[target] = deque()
+            self.order.append(target)
+        queue.append((self.clock.seconds(), msg, sent))
+        self._pump()
+
+    def backoff(self, reason=None):
+        """ Stop sending for a while, the server says we're too fast.
+            Each complaint within backoff_reset seconds of the last one
+            doubles the wait.
+        """
+        now = self.clock.seconds()
+        recent = (
+            (self.backoff_last is not None) and
+            (now - self.backoff_last < self.backoff_reset))
+        if recent:
+            self.backoff_secs = min(self.backoff_secs * 2, self.backoff_max)
+        else:
+            self.backoff_secs = self.backoff_min
+        self.backoff_last = now
+        self.backoffs += 1
+        self.paused_until = now + self.backoff_secs
+        # Start over with an empty bucket after the pause.
+        self.tokens = 0
+        self.refilled = self.paused_until
+        log.msg('Send queue backing off for {}s: {}'.format(
+            self.backoff_secs,
+            reason or 'flood warning'))
+        if self.order:
+            self._schedule(self.backoff_secs)
+
+    def depth(self):
+        """ Number of messages waiting to be sent. """
+        return sum(len(queue) for queue in self.queues.values())
+
+    def pop_merged(self, queue):
+        """ Pop the next message from a target's queue, merged with the
+            messages after it while they fit in maxlength.
+            Returns (msg, time the first message was added, count,
+            [sent callbacks]).
+        """
+        added, msg, sent = queue.popleft()
+        count = 1
+        callbacks = [sent] if sent else []
+        while queue:
+            merged = self.joiner.join((msg, queue[0][1]))
+            if len(merged) > self.maxlength:
+                break
+            sent = queue.popleft()[2]
+            if sent:
+                callbacks.append(sent)
+            msg = merged
+            count += 1
+        return msg, added, count, callbacks
+
+    def stats(self):
+        """ Return a dict of queue metrics. """
+        latencies = sorted(self.latencies)
+        if latencies:
+            latency_avg = sum(latencies) / len(latencies)
+            latency_max = latencies[-1]
+        else:
+            latency_avg = latency_max = 0.0
+        return {
+            'depth': self.depth(),
+            'targets': len(self.queues),
+            'added': self.added,
+            'sent': self.sent,
+            'merged': self.merged,
+            'backoffs': self.backoffs,
+            'latency_avg': latency_avg,
+            'latency_max': latency_max,
+        }
+
+    def status(self):
+        """ Return a short status string for chat. """
+        return ', '.join((
+            'queued: {depth} ({targets} targets)',
+            'sent: {sent} ({merged} merged)',
+            'backoffs: {backoffs}',
+            'latency: {latency_avg:.2f}s avg, {latency_max:.2f}s max',
+        )).format(**self.stats())
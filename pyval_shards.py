@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Channel Sharding
+    Each IRC connection can only send so fast, so one network's channels
+    can be spread across several connections (pyval, pyval1, ...).
+    Channels are assigned with consistent hashing, so when a connection
+    drops only its channels move to the others, and they move back when
+    it returns. At startup, channels wait for the connection that owns
+    them instead of moving around while the connections sign on.
+"""
+
+from bisect import bisect
+import hashlib
+
+
+def hash_point(key):
+    """ Return a point on the hash ring for a string. """
+    if not isinstance(key, bytes):
+        key = key.encode('utf-8')
+    return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+
+class HashRing(object):
+
+    """ Consistent hash ring, maps keys to nodes.
+        Each node has `replicas` points on the ring, to spread keys evenly.
+    """
+
+    def __init__(self, nodes=None, replicas=100):
+        self.replicas = replicas
+        # Sorted points, and {point: node}.
+        self.points = []
+        self.nodes = {}
+        for node in nodes or ():
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in set(self.nodes.values())
+
+    def __len__(self):
+        return len(set(self.nodes.values()))
+
+    def add(self, node):
+        """ Add a node to the ring. """
+        for i in range(self.replicas):
+            point = hash_point('{}:{}'.format(node, i))
+            if point not in self.nodes:
+                self.nodes[point] = node
+        self.points = sorted(self.nodes)
+
+    def get(self, key):
+        """ Return the node for a key, or None if the ring is empty. """
+        if not self.points:
+            return None
+        index = bisect(self.points, hash_point(key)) % len(self.points)
+        return self.nodes[self.points[index]]
+
+    def remove(self, node):
+        """ Remove a node from the ring. """
+        self.nodes = dict(
+            (point, pointnode)
+            for point, pointnode in self.nodes.items()
+            if pointnode != node)
+        self.points = sorted(self.nodes)
+
+
+class ShardGroup(object):
+
+    """ One network's channels, spread across its connected clients.
+        Clients need join(channel) and leave(channel) (like IRCClient),
+        and are added once they are signed on.
+    """
+
+    def __init__(self, names, replicas=100):
+        """ Arguments:
+                names     : Shard names for the network's connections.
+                replicas  : Points on the hash ring for each connection.
+        """
+        self.names = list(names)
+        # Channels to be in, in the order they were added.
+        self.channels = []
+        # Shards that haven't dropped, even if they haven't signed on yet.
+        self.ring = HashRing(self.names, replicas=replicas)
+        # {shard name: client}
+        self.clients = {}
+        # {shard name: set(channels)}, channels each client was told to be
+        # in.
+        self.joined = {}
+        # Admin/ban lists shared by the connections, set by the first one.
+        self.admins = None
+        self.banned = None
+        # {channel: shard name} from the last rebalance, and the number of
+        # channels that moved to another client.
+        self.owners = {}
+        self.moved = 0
+
+    def add(self, name, client):
+        """ Add a signed on client, it joins the channels it owns. """
+        self.clients[name] = client
+        self.joined[name] = set()
+        if name not in self.ring:
+            self.ring.add(name)
+        self.rebalance()
+
+    def add_channels(self, channels):
+        """ Add channels to be in, joined by the clients that own them. """
+        for channel in channels:
+            if channel not in self.channels:
+                self.channels.append(channel)
+        self.rebalance()
+
+    def owner(self, channel):
+        """ Return the name of the client that owns a channel, or None. """
+        return self.ring.get(channel.lower())
+
+    def rebalance(self):
+        """ Make each client join the channels it owns, and leave the
+            ones it doesn't. Channels owned by a shard that hasn't signed
+            on yet wait for it.
+        """
+        owned = dict((name, set()) for name in self.clients)
+        owners = {}
+        for channel in self.channels:
+            owner = self.owner(channel)
+            if owner not in self.clients:
+                continue
+            owned[owner].add(channel)
+            owners[channel] = owner
+            if self.owners.get(channel, owner) != owner:
+                self.moved += 1
+        self.owners = owners
+        for name in sorted(self.clients):
+            client = self.clients[name]
+            joined = self.joined[name]
+            for channel in sorted(joined - owned[name]):
+                client.leave(channel)
+            for channel in sorted(owned[name] - joined):
+                client.join(channel)
+            self.joined[name] = owned[name]
+
+    def remove(self, name):
+        """ Remove a shard (disconnected, or unable to connect),
+            its channels go to the others.
+        """
+        self.clients.pop(name, None)
+        self.joined.pop(name, None)
+        self.ring.remove(name)
+        self.rebalance()
+
+    def remove_channels(self, channels):
+        """ Stop being in channels, the clients in them leave. """
+        for channel in channels:
+            if channel in self.channels:
+                self.channels.remove(channel)
+        self.rebalance()
+
+    def status(self):
+        """ Return a short status string for chat. """
+        counts = ', '.join(
+            '{}: {}'.format(name, len(self.joined[name]))
+            for name in sorted(self.clients))
+        return 'connections: {}/{}, channels: {} ({}), moved: {}'.format(
+            len(self.clients),
+            len(self.names),
+            len(self.channels),
+            counts or 'none connected',
+            self.moved)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal Request Tracing
+    Each command request carries a Trace, with timestamped spans for the
+    stages it goes through:
+        ratelimit  : Rate limit/auto-ban check (privmsg).
+        parse      : Parsing the message (parse_data).
+        queue      : Waiting in the admission scheduler.
+        command    : The command function, until its reply is ready.
+        blacklist  : ExecBox blacklist check.
+        spawn      : Starting the sandbox.
+        run        : Running the sandbox.
+        format     : Building chat output from the results.
+        send       : Waiting in the send queue.
+        paste      : Paste upload for the follow-up message.
+        total      : From the message to the reply being sent.
+
+    Finished traces are kept in a ring buffer (Tracer), for latency
+    percentiles per stage and Chrome trace-event dumps
+    (load them in chrome://tracing or https://ui.perfetto.dev).
+"""
+
+from collections import deque
+from contextlib import contextmanager
+import json
+import os
+import time
+
+from twisted.internet import defer, threads
+
+STAGES = (
+    'ratelimit',
+    'parse',
+    'queue',
+    'command',
+    'blacklist',
+    'spawn',
+    'run',
+    'format',
+    'send',
+    'paste',
+    'total',
+)
+
+
+def percentile(values, pct):
+    """ Return the pct percentile (0-100) of sorted values
+        (nearest rank), or None if there are none.
+    """
+    if not values:
+        return None
+    rank = int(round((pct / 100.0) * (len(values) - 1)))
+    return values[rank]
+
+
+class Trace(object):
+
+    """ Timestamped spans for one command request. """
+
+    def __init__(self, traceid, name, nick=None, now=None):
+        """ Arguments:
+                traceid  : Number for this trace (from the Tracer).
+                name     : Command name.
+                nick     : Nick that sent the command.
+        """
+        self.traceid = traceid
+        self.name = name
+        self.nick = nick
+        self.started = time.time() if now is None else now
+        # Finished spans: [(stage, start time, end time), ...]
+        self.spans = []
+        # Open spans: {stage: start time}
+        self.opened = {}
+
+    def __repr__(self):
+        return 'Trace({!r}, {!r}, nick={!r}, spans={})'.format(
+            self.traceid,
+            self.name,
+            self.nick,
+            len(self.spans))
+
+    def add(self, stage, start, end):
+        """ Add a finished span. """
+        self.spans.append((stage, start, end))
+
+    def durations(self):
+        """ Return {stage: seconds} for finished spans. """
+        totals = {}
+        for stage, start, end in self.spans:
+            totals[stage] = totals.get(stage, 0) + (end - start)
+        return totals
+
+    def end(self, stage, now=None):
+        """ End an open span. Returns its duration,
+            or None if it wasn't started.
+        """
+        start = self.opened.pop(stage, None)
+        if start is None:
+            return None
+        if now is None:
+            now = time.time()
+        self.add(stage, start, now)
+        return now - start
+
+    def end_callback(self, result, stage):
+        """ Callback that ends a span, and passes the result through. """
+        self.end(stage)
+        return result
+
+    def events(self):
+        """ Return Chrome trace events for the spans.
+            Each trace is a thread, so requests show up side by side.
+        """
+        return [
+            {
+                'name': stage,
+                'cat': self.name,
+                'ph': 'X',
+                'ts': int(start * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': self.traceid,
+                'args': {'nick': self.nick},
+            }
+            for stage, start, end in self.spans
+        ]
+
+    @contextmanager
+    def span(self, stage):
+        """ Record the `with` block as a span. """
+        self.start(stage)
+        try:
+            yield self
+        finally:
+            self.end(stage)
+
+    def start(self, stage, now=None):
+        """ Start a span, ended with end(stage). """
+        self.opened[stage] = time.time() if now is None else now
+
+    def wrap(self, func, stage, waited=None):
+        """ Wrap a function so its run is a span, ending when its result
+            (or deferred result) is ready. The `waited` span is ended when
+            it starts.
+        """
+        def traced(*args, **kwargs):
+            if waited is not None:
+                self.end(waited)
+            self.start(stage)
+            d = defer.maybeDeferred(func, *args, **kwargs)
+            d.addBoth(self.end_callback, stage)
+            return d
+        return traced
+
+
+class Tracer(object):
+
+    """ Creates traces, and keeps the most recent finished ones. """
+
+    def __init__(self, maxtraces=500):
+        """ Arguments:
+                maxtraces  : Number of finished traces to keep.
+        """
+        self.traces = deque(maxlen=maxtraces)
+        # Number of traces started (trace ids).
+        self.started = 0
+        # Write dumps in a thread (set once the reactor is running).
+        self.threaded = False
+
+    def __len__(self):
+        return len(self.traces)
+
+    def chrome_trace(self):
+        """ Return the kept traces in Chrome trace-event format. """
+        events = []
+        for trace in self.traces:
+            events.extend(trace.events())
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def dump(self, filename):
+        """ Write the kept traces to a json file (Chrome trace-event
+            format). Returns a Deferred that fires with the filename.
+        """
+        content = json.dumps(self.chrome_trace())
+        if self.threaded:
+            d = threads.deferToThread(self.write, filename, content)
+        else:
+            d = defer.maybeDeferred(self.write, filename, content)
+        d.addCallback(lambda _: filename)
+        return d
+
+    def finish(self, trace, now=None):
+        """ End a trace's 'total' span, and keep it. Spans can still be
+            added after this (like a paste for a follow-up message).
+        """
+        trace.add('total', trace.started, time.time() if now is None else now)
+        self.traces.append(trace)
+
+    def new(self, name, nick=None, now=None):
+        """ Start a new trace for a command. """
+        self.started += 1
+        return Trace(self.started, name, nick=nick, now=now)
+
+    def percentiles(self, stage, pcts=(50, 95, 99)):
+        """ Return [(pct, seconds), ...] for a stage over the kept traces,
+            and the number of traces that have the stage.
+        """
+        values = sorted(
+            trace.durations()[stage]
+            for trace in self.traces
+            if any(span[0] == stage for span in trace.spans))
+        return [(pct, percentile(values, pct)) for pct in pcts], len(values)
+
+    def latency(self):
+        """ Return a short latency breakdown for chat:
+            p50/p95/p99 (ms) for each stage seen in the kept traces.
+        """
+        stagestrs = []
+        for stage in STAGES:
+            pcts, count = self.percentiles(stage)
+            if not count:
+                continue
+            stagestrs.append('{}: {} (n={})'.format(
+                stage,
+                '/'.join('{:.0f}'.format(secs * 1000) for _, secs in pcts),
+                count))
+        if not stagestrs:
+            return 'no traces yet.'
+        return 'p50/p95/p99 ms: {}'.format(', '.join(stagestrs))
+
+    def write(self, filename, content):
+        """ Write a dump file, through a temp file. """
+        tmpname = '{}.tmp'.format(filename)
+        with open(tmpname, 'w') as f:
+            f.write(content)
+        os.rename(tmpname, filename)
+        return True
@@ -10,6 +10,17 @@ import re
 NAME = 'PyVal'
 VERSION = '1.2.1'
 VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
+# Default timeout, in seconds, for code evaluation.
+EXEC_TIMEOUT = 5
+# Default limit, in bytes, for output sent back from the sandbox.
+EXEC_MAXOUTPUT = 128 * 1024
+# Default address space limit, in bytes, for the sandbox processes.
+EXEC_MAXMEMORY = 512 * 1024 * 1024
+# Default GC heap limit, in bytes, for pypy inside the sandbox.
+EXEC_HEAPSIZE = 128 * 1024 * 1024
+# Separates snippets to compare in timing mode.
+# (must match SnippetTimer.delimiter in pyval_sandbox)
+TIMEIT_DELIMITER = ' ;; '
 
 
 def humantime(d, short=False):
@@ -133,3 +144,86 @@ def get_args(s, arglist):
         # Try another match.
         flagmatch = argpat.match(s)
     return argdict, s
+
+
+def truncate_output(
+        s, maxlines=0, maxlinelength=0, maxlength=0, sep='\n', joiner='\n',
+        line_marker=' (..truncated)',
+        lines_marker='(...truncated at {maxlines} lines.)',
+        length_marker=' (...truncated)'):
+    """ Format output with limits on the number of lines, the length of
+        each line, and the total length, in a single pass.
+        Reading stops as soon as a limit is hit, so huge outputs are not
+        split or copied as a whole.
+
+        Arguments:
+            s              : Output string to format.
+            maxlines       : Maximum number of lines. 0 disables it.
+            maxlinelength  : Maximum length for each line. 0 disables it.
+            maxlength      : Maximum total length, not counting markers.
+                             0 disables it.
+            sep            : Line separator to read lines with.
+            joiner         : String to join the lines with, like '\\\\n' to
+                             escape newlines for chat.
+            line_marker    : Added to lines cut by maxlinelength,
+                             formatted with {maxlinelength}.
+            lines_marker   : Added as the last line when lines are cut by
+                             maxlines, formatted with {maxlines}.
+            length_marker  : Added when the output is cut by maxlength.
+    """
+    if not s:
+        return s
+    end = len(s)
+    seplen = len(sep)
+    lines = []
+    used = 0
+    start = 0
+    while True:
+        if maxlines and (len(lines) == maxlines):
+            # There is always another line after a separator.
+            lines.append(lines_marker.format(maxlines=maxlines))
+            break
+        joinlen = len(joiner) if lines else 0
+        room = None
+        if maxlength > 0:
+            room = max(maxlength - used - joinlen, 0)
+            if room <= 0:
+                # No room for another line (or its joiner), even an empty
+                # one from consecutive separators.
+                if start < end:
+                    lines[-1] = ''.join((lines[-1], length_marker))
+                break
+        limit = maxlinelength if maxlinelength > 0 else None
+        if (room is not None) and ((limit is None) or (room < limit)):
+            limit = room
+
+        if limit is None:
+            sepindex = s.find(sep, start)
+        else:
+            # Don't look past the limit for the end of this line.
+            sepindex = s.find(sep, start, start + limit + seplen)
+        if sepindex != -1:
+            lines.append(s[start:sepindex])
+            used += joinlen + (sepindex - start)
+            start = sepindex + seplen
+            continue
+        if (limit is None) or ((end - start) <= limit):
+            # Last line, and it fits.
+            lines.append(s[start:])
+            break
+
+        # This line goes over a limit.
+        lines.append(s[start:start + limit])
+        used += joinlen + limit
+        if limit == room:
+            lines[-1] = ''.join((lines[-1], length_marker))
+            break
+        lines[-1] = ''.join((
+            lines[-1],
+            line_marker.format(maxlinelength=maxlinelength)))
+        # Skip the rest of this line.
+        sepindex = s.find(sep, start + limit)
+        if sepindex == -1:
+            break
+        start = sepindex + seplen
+    return joiner.join(lines)
@@ -57,6 +57,10 @@
                               wherever the original command came from.
                               Either a channel, or a user. Functions may
                               return None if no response is needed.
+                              Each function declares its help, aliases,
+                              and cost class with @command()
+                              (pyval_registry), and the CommandHandler
+                              builds a CommandRegistry from them once.
 
     Original Twisted basic bot code borrowed from habnabit.
         Original ircbot.py from habnabit:
@@ -75,11 +79,11 @@
 
 
 # System/General stuff
-from datetime import datetime
 from getpass import getpass, GetPassWarning
 from hashlib import md5
 from os import getpid
 import os.path
+import signal
 import sys
 
 # Arg parsing
@@ -88,19 +92,24 @@ from docopt import docopt
 # TODO: Switch to local json_settings module.
 from easysettings import EasySettings
 
-# Irc stuff
-from twisted.internet import defer, endpoints, protocol, reactor, task
-from twisted.python import failure, log  # noqa
-from twisted.words.protocols import irc
-
-
-# Local stuff (Command Handler)
-from pyval_commands import AdminHandler, CommandHandler
+# Local stuff
 from pyval_util import NAME, VERSION, VERSIONSTR
 
 SCRIPT = os.path.split(sys.argv[0])[1]
 
 BANFILE = '{}_banned.lst'.format(NAME.lower().replace(' ', '-'))
+# Directory for the local paste server's pastes.
+PASTEDIR = '{}_pastes'.format(NAME.lower().replace(' ', '-'))
+# Paste backend, shared by all connections (see get_paster()).
+PASTER = None
+# Admission scheduler and paste cache, shared by all networks
+# (see get_shared()).
+SCHEDULER = None
+PASTECACHE = None
+# Connected protocols, {(network name, nick): PyValIRCProtocol}.
+CONNECTIONS = {}
+# Log pipeline (pyval_logging.LogPipeline), set when logging starts.
+LOGGER = None
 DEFAULT_CONFIGFILE = '{}.conf'.format(NAME.lower().replace(' ', '_'))
 DEFAULT_CONFIGFILE = os.path.join(sys.path[0], DEFAULT_CONFIGFILE)
 # Config file is loaded after checking args in main().
@@ -108,6 +117,27 @@ DEFAULT_CONFIGFILE = os.path.join(sys.path[0], DEFAULT_CONFIGFILE)
 CONFIG = EasySettings()
 CONFIG.name = NAME
 CONFIG.version = VERSION
+# Read-only snapshot of the cmdline args and CONFIG (see get_snapshot()),
+# rebuilt when the config is reloaded.
+CONFIGSNAP = None
+# Settings that are applied when the config is reloaded,
+# the others need a restart.
+LIVE_OPTIONS = (
+    'channels',
+    'commandchar',
+    'data',
+    'evalmodules',
+    'evalsteps',
+    'ips',
+    'logsample',
+    'monitor',
+    'noheartbeat',
+    'quotachan',
+    'quotanick',
+    'quotawindow',
+    'sandbox',
+    'workers',
+)
 USAGESTR = """{versionstr}
 
     Usage:
@@ -120,12 +150,19 @@ USAGESTR = """{versionstr}
                                      (passwords are stored in plain text!)
         -b,--noheartbeat           : Don't log the heartbeat pongs.
         -c chans,--channels chans  : Comma-separated list of channels to join.
+        --connections num          : Number of connections to the server,
+                                     named <nick>, <nick>1, ...
+                                     Channels are spread across them.
+                                     Defaults to: 1
         -C chr,--commandchar chr   : Character that marks a msg as a command.
                                      Messages that start with this character
                                      are considered commands by {name}.
                                      Defaults to: !
         -D,--dumpconfig            : Print current config file settings.
         -d,--data                  : Log all sent/received data.
+        -e num,--evalsteps num     : Step budget (traced calls/lines) for
+                                     each evaluation. 0 disables it.
+                                     Defaults to: 0
         -f file,--config file      : Use the specified config file for this
                                      session. (Disables autosave.)
         -h,--help                  : Show this message.
@@ -134,7 +171,17 @@ USAGESTR = """{versionstr}
         -L,--loginpw               : Prompt for the IRC server password before
                                      connecting, sent with /PASS <pw>.
         -l,--logfile               : Use log file instead of stderr/stdout.
+                                     It is rotated at 10MB, or daily.
+        --logjson                  : Write log lines as json.
+        --logsample rates          : Sampling rates for noisy log messages,
+                                     like: data=0.1,monitor=0.5,heartbeat=0
+        -M mods,--evalmodules mods : Comma-separated list of modules that
+                                     evaluated code can use.
+                                     Defaults to: pyval_sandbox's whitelist
         -m,--monitor               : Print all messages to log.
+        --metricsport port         : Serve metrics for Prometheus on
+                                     localhost:<port>/metrics.
+                                     Disabled by default.
         -n <nick>,--nick <nick>    : Choose what NICK to use for this bot.
         -P,--password              : Prompt for NickServ password before
                                      connecting.
@@ -142,24 +189,157 @@ USAGESTR = """{versionstr}
                                      connection.
         -p port,--port port        : Port number for the irc server.
                                      Defaults to: 6667
+        --pastebackend name        : Where long results are pasted,
+                                     'welbornprod' or 'local' (a paste
+                                     server run by {name}).
+                                     Defaults to: welbornprod
+        --pasteport port           : Port for the local paste server.
+                                     Defaults to: 8000
+        --pasteurl url             : Public url for the local paste server.
+                                     Defaults to: http://localhost:<port>
+        -S path,--sandbox path     : pypy-sandbox executable to use.
+                                     Defaults to: search $PATH
         -s server,--server server  : Name/Domain for the irc server.
                                      Defaults to: irc.freenode.net
         -U name,--username name    : Username for server login.
         -v,--version               : Show {name} version.
+        -w num,--workers num       : Number of evaluations that may run at
+                                     once.
+                                     Defaults to: 2
+
+    Several networks can be served by one {name} process, sharing its
+    evaluation workers, admission scheduler, and paste cache, with the
+    'networks' config option (instead of --server/--port):
+        [{{'name': 'freenode', 'server': 'irc.freenode.net', 'port': 6667}},
+         {{'name': 'other', 'server': 'irc.example.com', 'nick': 'pyval2',
+          'channels': '#python'}}]
+    Other keys (like nick, channels, commandchar) override the normal
+    settings for that network. Each network keeps its own admins and
+    bans, in files named after it (like pyval_admins.freenode.lst).
+
+    The config file can be reloaded without restarting, with SIGHUP
+    (kill -HUP `cat pyval_pid`) or the configreload admin command.
+    Changed channels, limits, and monitoring settings are applied live.
 
 """.format(name=NAME, versionstr=VERSIONSTR, script=SCRIPT)
 
 
+def dump_config():
+    """ Print current config options to console. """
+    print('\nCurrent configuration for {}:\n'.format(VERSIONSTR))
+    width = 80
+    cols = width / 4
+    colhalf = width / 2
+    # print header labels...
+    configlbl = 'Config File:'.ljust(colhalf)
+    arglbl = 'Command Line:'.ljust(colhalf)
+    print('{}{}'.format(configlbl, arglbl))
+
+    # Print all setting set in config first.
+    handled = []
+    for configopt, configval in CONFIG.settings.items():
+        argopt = '--{}'.format(configopt)
+        handled.append(argopt)
+        argval = MAIN_ARGD.get(argopt, configval)
+        fmtargs = [
+            str(configopt).rjust(cols),
+            str(configval).ljust(cols),
+            argopt.rjust(cols),
+            str(argval).ljust(cols),
+        ]
+        print('{}:{}{}:{}'.format(*fmtargs))
+
+    # Do unset command line args.
+    for argopt, argval in MAIN_ARGD.items():
+        if argopt in handled:
+            continue
+        configopt = argopt.strip('-')
+        configval = ''
+        fmtargs = [
+            str(configopt).rjust(cols),
+            str(configval).ljust(cols),
+            argopt.rjust(cols),
+            str(argval).ljust(cols),
+        ]
+        print('{}:{}{}:{}'.format(*fmtargs))
+
+    print('    Command-line settings override config-file settings when '
+          'both are set (not None or False).')
+
+    return True
+
+
+if __name__ == '__main__':
+    # Parse args before the heavy imports below (Twisted, pyval_commands),
+    # so --help, --version, and --dumpconfig return right away.
+    MAIN_ARGD = docopt(USAGESTR, version=VERSIONSTR)
+
+    # Some args don't need to run the bot.
+    if MAIN_ARGD['--dumpconfig']:
+        # Exit 0 when the config was dumped, 1 on a bad config dump.
+        sys.exit(0 if dump_config() else 1)
+
+# Irc stuff
+from twisted.internet import defer, endpoints, protocol, reactor, task  # noqa
+from twisted.internet.error import CannotListenError  # noqa
+from twisted.python import failure, log  # noqa
+from twisted.words.protocols import irc  # noqa
+
+# Local stuff (Command Handler)
+from pyval_admission import AdmissionScheduler  # noqa
+from pyval_commands import (  # noqa
+    AdminHandler,
+    CommandHandler,
+    PASTECACHEFILE,
+    QUOTA_OPTIONS,
+)
+from pyval_config import (  # noqa
+    ConfigSnapshot,
+    format_value,
+    is_secret,
+    load_settings,
+)
+from pyval_exec import SandboxNotFound, set_pypysandbox  # noqa
+from pyval_logging import LogPipeline, parse_rates  # noqa
+from pyval_metrics import (  # noqa
+    ADMISSION_QUEUED,
+    HANDLING,
+    SENDQ_DEPTH,
+    ReactorLag,
+    listen_metrics,
+)
+from pyval_paste import PasteClient  # noqa
+from pyval_pastecache import PasteCache  # noqa
+from pyval_pasteserver import LocalPaster, PasteStore, listen_pastes  # noqa
+from pyval_registry import FLAG_CALLER, FLAG_TRACED  # noqa
+from pyval_shards import ShardGroup  # noqa
+from pyval_sendq import FLOOD_NUMERICS, SendQueue  # noqa
+
+
 class PyValIRCProtocol(irc.IRCClient):
 
-    def __init__(self):
+    def __init__(self, network=None, shards=None):
+        """ Arguments:
+                network  : Network settings (see get_networks()).
+                shards   : ShardGroup for the network, when its channels
+                           are spread across several connections.
+        """
         self.argd = MAIN_ARGD
+        self.network = network or {}
+        self.shards = shards
+        self.hostname = self.network.get('server', 'Unknown')
+        self.portnum = self.network.get('port', 'Unknown')
         # Main deferred, fired on fatal error or final disconnect.
         self.deferred = defer.Deferred()
 
         # Class to handle admin stuff. Needs to be accessed here and in
-        # CommandHandler.
-        self.admin = AdminHandler()
+        # CommandHandler. Each network has its own, but they share one
+        # scheduler (and evaluation workers) and paste cache.
+        scheduler, pastecache = get_shared()
+        self.admin = AdminHandler(
+            network=self.network.get('name', None),
+            scheduler=scheduler,
+            pastecache=pastecache)
         # Admin should have the EasySettings config options.
         self.admin.config = CONFIG
         self.admin.argd = self.argd
@@ -169,12 +349,46 @@ class PyValIRCProtocol(irc.IRCClient):
         self.admin.nickname = self.get_config('nick', 'pyval')
         self.admin.cmdchar = self.get_config('commandchar', '!')
         self.admin.noheartbeatlog = self.get_config('noheartbeat', False)
+        self.admin.eval_steps = self.get_config_int('evalsteps', 0)
+        evalmodules = self.get_config('evalmodules', None)
+        if evalmodules:
+            self.admin.eval_modules = self.parse_comma_args(evalmodules)
+        self.admin.apply_quota_config()
+        # Evaluations run in the reactor's thread pool, one per worker.
+        self.admin.set_workers(self.get_config_int('workers', 2))
+        reactor.suggestThreadPoolSize(self.admin.workers)
+        # pypy-sandbox is found on the first evaluation, unless it is set.
+        sandbox = self.get_config('sandbox', None)
+        if sandbox:
+            try:
+                set_pypysandbox(sandbox)
+            except SandboxNotFound as exsandbox:
+                log.msg('{}, searching $PATH instead.'.format(exsandbox))
         # Give admin access to certain functions.
         self.admin.quit = self.quit
+        self.admin.reload_config = reload_config
+        self.admin.refresh_config = refresh_config
         self.admin.sendLine = self.sendLine
         self.admin.ctcpMakeQuery = self.ctcpMakeQuery
         self.admin.do_action = self.me
         self.admin.handlinglock = defer.DeferredLock()
+        if self.shards is not None:
+            # Connections to the same network share their admins and bans.
+            if self.shards.admins is None:
+                self.shards.admins = self.admin.admins
+                self.shards.banned = self.admin.banned
+            self.admin.admins = self.shards.admins
+            self.admin.banned = self.shards.banned
+            self.admin.shards = self.shards
+        # Admin/ban lists are saved in a thread from now on.
+        self.admin.admins.threaded = True
+        self.admin.banned.threaded = True
+        self.admin.tracer.threaded = True
+        # Replies are paced by the send queue, instead of fixed delays.
+        self.admin.sendq = SendQueue(self.msg, reactor)
+        # Pastes are uploaded without blocking, or stored locally.
+        self.admin.paster = get_paster()
+        self.admin.logger = LOGGER
         # For setting the topic for our own channel if possible.
         self.admin.topicfmt = ''.join([
             'Python Evaluation Bot (pyval) | ',
@@ -223,6 +437,15 @@ class PyValIRCProtocol(irc.IRCClient):
         # parse cmdline args to set attributes.
         # self.channels depends on self.nickname for the default channel.
         self.channels = self.parse_join_channels(self.get_config('channels'))
+        # Sharded connections are named by their configured nick.
+        self.shardname = self.nickname
+        if self.shards is not None:
+            self.shards.add_channels(self.channels)
+
+        # Periodic load sampling, started on connection.
+        self.loadloop = None
+        # Channels are joined once the server has acknowledged us.
+        self.signedon = False
 
         # Class to handle messages and commands.
         self.commandhandler = CommandHandler(
@@ -259,6 +482,8 @@ class PyValIRCProtocol(irc.IRCClient):
             except Exception as ex:
                 log.msg('Failed to kill config setting in '
                         '{}: {}\n{}'.format(configset, option, ex))
+        # The config snapshot has it too.
+        refresh_config()
 
         if not attr:
             # No attribute value will be killed.
@@ -294,6 +519,48 @@ class PyValIRCProtocol(irc.IRCClient):
             log.msg('Error setting attribute: {}\n{}'.format(attr, exset))
             return False
 
+    def apply_config(self, options):
+        """ Apply changed config settings to this connection, after a
+            reload. Settings for this network (see get_networks()) are
+            kept.
+
+            Arguments:
+                options  : Names of the settings that changed.
+        """
+        options = [o for o in options if o not in self.network]
+        flags = {
+            'monitor': 'monitor',
+            'data': 'monitordata',
+            'ips': 'monitorips',
+            'noheartbeat': 'noheartbeatlog',
+        }
+        for option in options:
+            if option in flags:
+                setattr(
+                    self.admin,
+                    flags[option],
+                    self.get_config(option, False))
+            elif option == 'commandchar':
+                self.admin.cmdchar = self.get_config('commandchar', '!')
+                self.admin.topicmsg = self.admin.topicfmt.format(
+                    cc=self.admin.cmdchar,
+                    nick=self.admin.nickname)
+            elif option == 'evalsteps':
+                self.admin.eval_steps = self.get_config_int('evalsteps', 0)
+            elif option == 'evalmodules':
+                evalmodules = self.get_config('evalmodules', None)
+                self.admin.eval_modules = (
+                    self.parse_comma_args(evalmodules)
+                    if evalmodules else None)
+            elif option == 'workers':
+                self.admin.set_workers(self.get_config_int('workers', 2))
+                reactor.suggestThreadPoolSize(self.admin.workers)
+            elif option == 'channels':
+                self.set_channels(
+                    self.parse_join_channels(self.get_config('channels')))
+        if any(option in QUOTA_OPTIONS for option in options):
+            self.admin.apply_quota_config()
+
     def connectionMade(self):
         """ Initial connection was made, no 'welcome' message yet. """
         # Take care of some internal stuff.
@@ -312,8 +579,13 @@ class PyValIRCProtocol(irc.IRCClient):
         log.msg('    Channels: {}'.format(', '.join(self.channels)))
         log.msg('Command Char: {}'.format(self.admin.cmdchar))
 
-        # Reset the delay counts on the global factory.
-        factory.resetDelay()
+        # Reset the delay counts on this network's factory.
+        self.factory.resetDelay()
+        CONNECTIONS[(self.admin.network, self.shardname)] = self
+
+        # Start sampling the load, to shed work when overloaded.
+        self.loadloop = task.LoopingCall(self.sample_load)
+        self.loadloop.start(self.admin.load.interval, now=False)
 
     def connectionLost(self, reason=protocol.connectionDone):
         """ Connection to the server was lost.
@@ -324,6 +596,16 @@ class PyValIRCProtocol(irc.IRCClient):
         reasonmsg = ': {}'.format(reason.getErrorMessage()) if reason else '.'
         log.msg('Connection Lost{}'.format(reasonmsg))
 
+        if self.loadloop and self.loadloop.running:
+            self.loadloop.stop()
+        self.signedon = False
+        key = (self.admin.network, self.shardname)
+        if CONNECTIONS.get(key, None) is self:
+            CONNECTIONS.pop(key)
+        if self.shards is not None:
+            # This connection's channels go to the others.
+            self.shards.remove(self.shardname)
+
         # Fire the main deferred with an error (the disconnect reason).
         self.deferred.errback(reason)
 
@@ -344,8 +626,9 @@ class PyValIRCProtocol(irc.IRCClient):
 
     def get_config(self, option, default=None):
         """ Retrieve setting for PyVal.
-            Tries cmdline args first, then admin.config.
-            Default value is returned if neither is found.
+            Tries network settings first, then the config snapshot
+            (cmdline args, then the config file).
+            Default value is returned if none are found.
 
             Arguments:
                 option   : Command line option ('option').
@@ -356,16 +639,26 @@ class PyValIRCProtocol(irc.IRCClient):
 
         if not option:
             return default
-        if option.startswith('--'):
-            argopt = option
-            option = option.strip('-')
-        else:
-            argopt = '--{}'.format(option)
+        option = option.strip('-')
 
-        val = self.get_argd(argopt, None)
-        if not val:
-            val = self.admin.config.get(option, default=default)
-        return val
+        # Network settings come first.
+        if option in self.network:
+            return self.network[option]
+        return get_snapshot().get(option, default)
+
+    def get_config_int(self, option, default=0):
+        """ Retrieve an integer setting for PyVal, like get_config().
+            Bad values are logged, and the default is used instead.
+        """
+        val = self.get_config(option, default=default)
+        try:
+            return int(val)
+        except (TypeError, ValueError):
+            log.msg('Invalid number for {}: {!r}, using: {}'.format(
+                option,
+                val,
+                default))
+            return default
 
     def get_password(self, pwtype=None):
         """ Get a password using getpass. """
@@ -389,7 +682,17 @@ class PyValIRCProtocol(irc.IRCClient):
         """
         self.sendLine('PONG {}'.format(params[-1]))
         if not self.admin.monitordata:
-            log.msg('Sent PONG reply: {}'.format(params[-1]))
+            log.msg(
+                'Sent PONG reply: {}'.format(params[-1]),
+                category='heartbeat')
+
+    def irc_unknown(self, prefix, command, params):
+        """ Handle commands/numerics that IRCClient doesn't.
+            Flood warnings from the server slow down the send queue.
+        """
+        if command in FLOOD_NUMERICS:
+            self.admin.sendq.backoff(
+                reason='{} {}'.format(command, ' '.join(params[1:])))
 
     def is_command(self, s):
         """ Return true if this string/message is considered a command.
@@ -427,7 +730,7 @@ class PyValIRCProtocol(irc.IRCClient):
         """ Receive line, catch what is being received for logs. """
         irc.IRCClient.lineReceived(self, line)
         if self.admin.monitordata:
-            log.msg('Recv: {}'.format(line))
+            log.msg('Recv: {}'.format(line), category='data')
 
         if 'PONG' in line:
             try:
@@ -440,9 +743,15 @@ class PyValIRCProtocol(irc.IRCClient):
     def logPrefix(self):
         """ Retrieve the name used for logging.
             Usually self.__class__.__name__, but a shorter name is used
-            instead for PyVal.
+            instead for PyVal (with the network name, when it's set,
+            and the nick for sharded connections).
         """
-        return self.versionName
+        names = [self.versionName]
+        if self.admin.network:
+            names.append(self.admin.network)
+        if self.shards is not None:
+            names.append(self.shardname)
+        return '-'.join(names)
 
     def md5(self, s):
         """ md5 some bytes, strings are encoded in utf-8 if passed. """
@@ -557,7 +866,9 @@ class PyValIRCProtocol(irc.IRCClient):
                 log.msg('This will affect the default channel!')
 
             # Default channel to join when none are supplied
-            chans = ['##{}'.format(self.nickname)]
+            # (the same one for all connections to the network).
+            chans = ['##{}'.format(
+                self.network.get('basenick', self.nickname))]
 
         return chans
 
@@ -575,12 +886,16 @@ class PyValIRCProtocol(irc.IRCClient):
         # Only print a pong reply if secs is given, or monitordata is False.
         if secs:
             # seconds is known, print it whether monitordata is set or not.
-            log.msg('PONG from: {} ({}s)'.format(user, secs))
+            log.msg(
+                'PONG from: {} ({}s)'.format(user, secs),
+                category='heartbeat')
         elif not self.admin.monitordata:
             # no data monitoring, but seconds is unknown.
             # log it if --noheartbeat isn't being used.
             if not self.admin.noheartbeatlog:
-                log.msg('PONG from: {} (heartbeat response)'.format(user))
+                log.msg(
+                    'PONG from: {} (heartbeat response)'.format(user),
+                    category='heartbeat')
 
     def privmsg(self, user, channel, message):
         """ Handles personal and channel messages.
@@ -590,37 +905,31 @@ class PyValIRCProtocol(irc.IRCClient):
         """
         nick, _, host = user.partition('!')
         message = message.strip()
-        is_admin = (nick in self.admin.admins)
+        is_admin = (user in self.admin.admins)
 
         if (nick.lower() == 'nickserv'):
             log.msg('NickServ: {}'.format(message))
 
-        # Disallow banned nicks.
-        if nick in self.admin.banned:
+        # Disallow banned nicks/masks. Admins are never locked out, even
+        # by a wildcard ban that covers them.
+        if (user in self.admin.banned) and (not is_admin):
             return None
 
+        # Commands carry a trace, with spans for each stage they go through.
+        trace = None
+        if self.is_command(message):
+            trace = self.admin.tracer.new(
+                message.lstrip(self.admin.cmdchar).partition(' ')[0],
+                nick=nick)
+
         # Handle auto-bans for command msgs.
+        # Nicks sending commands faster than the rate limit get a warning
+        # (and are eventually banned) instead of a response.
         ban_msg = None
-        if (self.admin.last_handle and
-                self.admin.last_nick and self.is_command(message)):
-            # save seconds since last response.
-            respondtime = (datetime.now() - self.admin.last_handle)
-            respondsecs = respondtime.total_seconds()
-            # If this user has been ban warned, check their last response time
-            if nick in self.admin.banned_warned.keys():
-                lasttime = self.admin.banned_warned[nick]['last']
-                usersecs = (datetime.now() - lasttime).total_seconds()
-                if usersecs < self.admin.msg_timelimit:
-                    # User is sending too many msgs too fast.
+        if (not is_admin) and (trace is not None):
+            with trace.span('ratelimit'):
+                if not self.admin.ratelimit.allow(nick):
                     ban_msg = self.admin.ban_add(nick)
-                else:
-                    # Time on last command is okay,
-                    # update this warned-user's last msg time.
-                    self.admin.banned_warned[nick]['last'] = datetime.now()
-
-            elif (nick == self.admin.last_nick) and (respondsecs < 3):
-                # first time offender
-                ban_msg = self.admin.ban_add(nick)
 
         if ban_msg:
             # Send ban msg instead of usual command response if available.
@@ -632,32 +941,49 @@ class PyValIRCProtocol(irc.IRCClient):
                 return None
 
             # Handle message parsing and commands.
-            # If the message triggers a command, then a function is returned
-            # to handle it. If there is no function, then just return.
-            func = self.commandhandler.parse_data(user, channel, message)
+            # If the message triggers a command, then a Command is returned
+            # to handle it. If there is no Command, then just return.
+            if trace is not None:
+                trace.start('parse')
+            cmd = self.commandhandler.parse_data(user, channel, message)
+            if trace is not None:
+                trace.end('parse')
 
             # Nothing returned from commandhandler, no response is needed.
-            if not func:
+            if not cmd:
                 return None
 
             # Get '!cmd rest' to send to func args...
-            cmd, sep, rest = message.lstrip(self.admin.cmdchar).partition(' ')
+            _, sep, rest = message.lstrip(self.admin.cmdchar).partition(' ')
 
             # Save this message, and build deferred with these args.
             self.admin.last_command = message
             # If the function returns a deferred, it will be handled
             # the same as non-deferred-returning functions.
-            d = defer.maybeDeferred(func, rest.strip(), nick=nick)
-
-        if self.admin.limit_rate:
-            # Disallow backup of requests. If handlingcount is too much
-            # just ignore this one.
-            if ((not is_admin) and
-                    (self.admin.handlingcount > self.admin.banwarn_limit)):
-                log.msg('Too busy, ignoring command: {}'.format(message))
-                return None
-            # Keep track of how many requests are unanswered (handling).
-            self.admin.handling_increase()
+            # The scheduler queues it fairly with other nicks' commands
+            # (based on its cost class), admin commands run right away.
+            kwargs = {'nick': nick}
+            if FLAG_CALLER in cmd.flags:
+                # Commands like cmd_python charge their channel for CPU
+                # time, it's passed along in case it is queued.
+                kwargs['is_admin'] = is_admin
+                kwargs['channel'] = (
+                    None if channel == self.admin.nickname else channel)
+            if FLAG_TRACED in cmd.flags:
+                kwargs['trace'] = trace
+            trace.start('queue')
+            d = self.admin.scheduler.submit(
+                nick,
+                trace.wrap(cmd, 'command', waited='queue'),
+                args=[rest.strip()],
+                kwargs=kwargs,
+                is_admin=(cmd.role == 'admin'),
+                cost=cmd.cost,
+                group=self.admin.network)
+
+        # Keep track of how many requests are unanswered (handling).
+        # The load controller sheds work based on this when it's too much.
+        self.admin.handling_increase()
 
         # Add error callbackfor func, the _show_error callback will turn the
         # error into a terse message first:
@@ -666,14 +992,10 @@ class PyValIRCProtocol(irc.IRCClient):
         # This will fire off our send function
         if channel == self.admin.nickname:
             # Send private response.
-            d.addCallback(self._sendMessage, nick)
+            d.addCallback(self._sendMessage, nick, trace=trace)
         else:
             # Send channel response.
-            d.addCallback(self._sendMessage, channel, nick)
-
-        # Save the last command-handled time for next time.
-        self.admin.last_handle = datetime.now()
-        self.admin.last_nick = nick
+            d.addCallback(self._sendMessage, channel, nick, trace=trace)
 
     def respond_znc_challenge(self, user, msg):
         """ Respond to a ZNC auth challenge.
@@ -699,6 +1021,15 @@ class PyValIRCProtocol(irc.IRCClient):
         # No user/message was provided.
         return None
 
+    def sample_load(self):
+        """ Sample the current load for the load controller,
+            and forget idle CPU quota users/old ban warnings.
+        """
+        self.admin.load.sample(self.admin.handlingcount)
+        self.admin.quota_nick.prune()
+        self.admin.quota_chan.prune()
+        self.admin.ban_expire_warnings()
+
     def sendLine(self, line):
         """ Send line, catch what is being sent for logs. """
         # call the original sendline (handles default actions).
@@ -708,14 +1039,18 @@ class PyValIRCProtocol(irc.IRCClient):
             if ':IDENTIFY' in line:
                 # don't log the users nick pw.
                 idline = ' '.join(line.split()[:-1])
-                log.msg('Sent: {} {}'.format(idline, '******'))
+                log.msg(
+                    'Sent: {} {}'.format(idline, '******'),
+                    category='data')
             elif ':PASS' in line:
                 # password line. don't log the pw.
                 pwline = ' '.join(line.split()[:-1])
-                log.msg('Sent: {} {}'.format(pwline, '******'))
+                log.msg(
+                    'Sent: {} {}'.format(pwline, '******'),
+                    category='data')
             else:
                 # normal, probably safe line. log it.
-                log.msg('Sent: {}'.format(line))
+                log.msg('Sent: {}'.format(line), category='data')
 
     def setArg(self, argname, argval):
         """ Function to call from other places, to set argd args. """
@@ -723,6 +1058,29 @@ class PyValIRCProtocol(irc.IRCClient):
         if self.argd:
             self.argd[argname] = argval
             log.msg('Set arg: {} = {}'.format(argname, argval))
+            refresh_config()
+
+    def set_channels(self, channels):
+        """ Change the channels to be in, joining new ones and leaving
+            the ones that were removed (once signed on).
+        """
+        added = [c for c in channels if c not in self.channels]
+        removed = [c for c in self.channels if c not in channels]
+        self.channels = channels
+        if self.shards is not None:
+            # The connections that own them join/leave.
+            self.shards.remove_channels(removed)
+            self.shards.add_channels(added)
+            return None
+        if not self.signedon:
+            # They are joined on sign on.
+            return None
+        for channel in removed:
+            log.msg('Leaving :{}'.format(channel))
+            self.leave(channel)
+        for channel in added:
+            log.msg('Joining :{}'.format(channel))
+            self.join(channel)
 
     def signedOn(self):
         """ This is called once the server has acknowledged that we sent
@@ -736,20 +1094,52 @@ class PyValIRCProtocol(irc.IRCClient):
             if not self._kill_setting('password', attr='nickservpw'):
                 log.msg('Failed to remove nickserv password!')
 
+        self.signedon = True
+        if self.shards is not None:
+            # Join the channels this connection owns, they are moved here
+            # from the other connections.
+            self.shards.add(self.shardname, self)
+            return None
+
         # Join channels.
         for channel in self.channels:
             log.msg('Joining :{}'.format(channel))
             self.join(channel)
 
-    def _handleMessage(self, msg, target, nick=None):
-        """ Actually send the message,
+    def _sendFollowup(self, msg, target, nick=None):
+        """ Queue a command's follow-up message (like a paste url),
+            sent to the same place as the command's response.
+        """
+        if msg:
+            if nick:
+                msg = '{}, {}'.format(nick, msg)
+            self.admin.sendq.add(target, msg)
+
+    def _sendMessage(self, msg, target, nick=None, trace=None):
+        """ Queue a command's response to be sent,
             decrease the handling count,
             increase the handled count.
+            A Reply's follow-up message is sent when it is ready.
+            The command's trace is finished when the response is sent.
         """
+        def sent(when):
+            trace.end('send', now=when)
+            self.admin.tracer.finish(trace, now=when)
+
+        followup = getattr(msg, 'followup', None)
+        if followup is not None:
+            followup.addCallback(self._sendFollowup, target, nick=nick)
+            followup.addErrback(self._logFollowupError)
         if msg:
             if nick:
                 msg = '{}, {}'.format(nick, msg)
-            self.msg(target, msg)
+            if trace is None:
+                self.admin.sendq.add(target, msg)
+            else:
+                trace.start('send')
+                self.admin.sendq.add(target, msg, sent=sent)
+        elif trace is not None:
+            self.admin.tracer.finish(trace)
 
         # admin cmds have no msg sometimes, but still count as 'handling'.
         self.admin.handling_decrease()
@@ -757,23 +1147,9 @@ class PyValIRCProtocol(irc.IRCClient):
         # increase the 'handled' count.
         self.admin.handled += 1
 
-    def _sendMessage(self, msg, target, nick=None):
-        # Default handling delay for non-msg handling or low-load times.
-        timeout = 0.25
-        if self.admin.handlingcount > 1:
-            # Calculate delay needed based on current handling count.
-            # Ends up being around 2 seconds per response.
-            # Schedule message handling for later.
-            if msg:
-                timeout = 2 * self.admin.handlingcount
-                log.msg('Delaying msg response for later: {}'.format(timeout))
-
-        # Call the handle message function later-ish.
-        reactor.callLater(timeout,
-                          self._handleMessage,
-                          msg,
-                          target,
-                          nick)
+    def _logFollowupError(self, failureobj):
+        log.msg('Unable to send follow-up message: {}'.format(
+            failureobj.getErrorMessage()))
 
     def _showError(self, failureobj):
         return 'PyVal Error: {}'.format(failureobj.getErrorMessage())
@@ -785,14 +1161,19 @@ class PyValIRCFactory(protocol.ReconnectingClientFactory):
         should reconnect all client instances on disconnect.
     """
 
-    def __init__(self, argd=None, serverstr=None):
+    def __init__(self, argd=None, network=None, shards=None):
         self.protocol = PyValIRCProtocol
-        # Set the hostname and portnum on the protocol for this connection.
-        try:
-            serverinfo = serverstr.split(':')[1:]
-        except ValueError:
-            serverinfo = 'Unknown', 'Unknown'
-        self.protocol.hostname, self.protocol.portnum = serverinfo
+        self.argd = argd
+        # Network settings for this connection (see get_networks()),
+        # and the network's ShardGroup if it has several connections.
+        self.network = network
+        self.shards = shards
+
+    def buildProtocol(self, addr):
+        """ Build a protocol for this factory's network. """
+        p = self.protocol(network=self.network, shards=self.shards)
+        p.factory = self
+        return p
 
     def logPrefix(self):
         """ Returns the label for logging msgs coming from the factory.
@@ -801,71 +1182,200 @@ class PyValIRCFactory(protocol.ReconnectingClientFactory):
         return '{}-Factory'.format(NAME)
 
 
-def dump_config():
-    """ Print current config options to console. """
-    print('\nCurrent configuration for {}:\n'.format(VERSIONSTR))
-    width = 80
-    cols = width / 4
-    colhalf = width / 2
-    # print header labels...
-    configlbl = 'Config File:'.ljust(colhalf)
-    arglbl = 'Command Line:'.ljust(colhalf)
-    print('{}{}'.format(configlbl, arglbl))
-
-    # Print all setting set in config first.
-    handled = []
-    for configopt, configval in CONFIG.settings.items():
-        argopt = '--{}'.format(configopt)
-        handled.append(argopt)
-        argval = MAIN_ARGD.get(argopt, configval)
-        fmtargs = [
-            str(configopt).rjust(cols),
-            str(configval).ljust(cols),
-            argopt.rjust(cols),
-            str(argval).ljust(cols),
-        ]
-        print('{}:{}{}:{}'.format(*fmtargs))
-
-    # Do unset command line args.
-    for argopt, argval in MAIN_ARGD.items():
-        if argopt in handled:
-            continue
-        configopt = argopt.strip('-')
-        configval = ''
-        fmtargs = [
-            str(configopt).rjust(cols),
-            str(configval).ljust(cols),
-            argopt.rjust(cols),
-            str(argval).ljust(cols),
-        ]
-        print('{}:{}{}:{}'.format(*fmtargs))
-
-    print('    Command-line settings override config-file settings when '
-          'both are set (not None or False).')
-
-    return True
-
-
 def get_config(option, default=None):
-    """ Get global config setting.
+    """ Get global config setting, from the config snapshot.
         Tries cmdline args first, then config file.
         Returns default value is neither is found.
         Arguments:
             option   : option to retrieve (without '--')
             default  : default value if not found (defaults to None)
     """
-    if not option:
-        return default
-    if option.startswith('--'):
-        argopt = option
-        option = option.strip('-')
-    else:
-        argopt = '--{}'.format(option)
+    return get_snapshot().get(option, default)
 
-    val = MAIN_ARGD.get(argopt, None)
-    if not val:
-        val = CONFIG.get(option, default=default)
-    return val
+
+def get_snapshot():
+    """ Return the config snapshot (pyval_config.ConfigSnapshot).
+        It is built from the cmdline args and CONFIG the first time,
+        and rebuilt by refresh_config().
+    """
+    global CONFIGSNAP
+    if CONFIGSNAP is None:
+        CONFIGSNAP = ConfigSnapshot.build(MAIN_ARGD, CONFIG.settings)
+    return CONFIGSNAP
+
+
+def get_networks():
+    """ Return settings for the networks to connect to, as a list of dicts
+        with at least 'name', 'server', and 'port'.
+        They come from the 'networks' config option, or --server/--port
+        for a single network (named None).
+        Bad network settings are logged and skipped.
+    """
+    networks = get_config('networks', default=None)
+    if not networks:
+        return [{
+            'name': None,
+            'server': get_config('server', default='irc.freenode.net'),
+            'port': get_config('port', default='6667'),
+            'connections': get_config('connections', default='1'),
+        }]
+
+    goodnetworks = []
+    names = set()
+    for network in networks:
+        if (not isinstance(network, dict)) or (not network.get('server')):
+            log.msg('Invalid network settings, no server: {!r}'.format(
+                network))
+            continue
+        network = dict(network)
+        network.setdefault('name', network['server'])
+        network.setdefault('port', '6667')
+        network.setdefault(
+            'connections',
+            get_config('connections', default='1'))
+        if network['name'] in names:
+            log.msg('Duplicate network name: {}'.format(network['name']))
+            continue
+        names.add(network['name'])
+        goodnetworks.append(network)
+    return goodnetworks
+
+
+def get_shard_networks(network):
+    """ Return settings for each connection to a network.
+        Connections after the first are named <nick>1, <nick>2, ...
+    """
+    count = int(network['connections'])
+    if count < 2:
+        return [network]
+    basenick = network.get('nick', None) or get_config('nick', 'pyval')
+    shardnetworks = []
+    for num in range(count):
+        shardnetworks.append(dict(
+            network,
+            basenick=basenick,
+            nick='{}{}'.format(basenick, num or '')))
+    return shardnetworks
+
+
+def get_paster():
+    """ Return the paste backend chosen with --pastebackend.
+        It is created once (starting the local paste server if it's used),
+        and shared by all connections.
+    """
+    global PASTER
+    if PASTER is not None:
+        return PASTER
+    backend = get_config('pastebackend', default='welbornprod')
+    if backend == 'local':
+        port = get_config('pasteport', default='8000')
+        try:
+            port = int(port)
+            store = PasteStore(PASTEDIR)
+            listen_pastes(reactor, store, port)
+        except (ValueError, EnvironmentError, CannotListenError) as ex:
+            log.msg('Unable to start the local paste server: {}'.format(ex))
+        else:
+            store.threaded = True
+            pasteurl = get_config(
+                'pasteurl',
+                default='http://localhost:{}'.format(port))
+            log.msg('Serving pastes at: {}'.format(pasteurl))
+            PASTER = LocalPaster(store, pasteurl)
+            return PASTER
+    elif backend != 'welbornprod':
+        log.msg('Unknown paste backend: {}'.format(backend))
+    log.msg('Using the welbornprod.com paste site.')
+    PASTER = PasteClient(reactor)
+    return PASTER
+
+
+def start_metrics():
+    """ Serve metrics on localhost, and measure the reactor lag,
+        if --metricsport was given.
+    """
+    port = get_config('metricsport', default=None)
+    if not port:
+        return None
+    try:
+        listen_metrics(reactor, int(port))
+    except (ValueError, CannotListenError) as ex:
+        log.msg('Unable to serve metrics: {}'.format(ex))
+        return None
+    log.msg('Serving metrics at: http://localhost:{}/metrics'.format(port))
+    ReactorLag(reactor).start()
+
+
+def get_shared():
+    """ Return the (scheduler, pastecache) shared by all networks.
+        They are created once, the scheduler's workers are set by the
+        first connection (--workers).
+    """
+    global SCHEDULER, PASTECACHE
+    if SCHEDULER is None:
+        SCHEDULER = AdmissionScheduler()
+        PASTECACHE = PasteCache(PASTECACHEFILE)
+        PASTECACHE.threaded = True
+    return SCHEDULER, PASTECACHE
+
+
+def refresh_config():
+    """ Build a new config snapshot from the cmdline args and CONFIG,
+        swap it in, and apply the changed settings to each connection.
+        Changes are logged (passwords are hidden).
+        Returns the changes, as [(option, old value, new value), ...].
+    """
+    global CONFIGSNAP
+    oldsnap = get_snapshot()
+    CONFIGSNAP = ConfigSnapshot.build(MAIN_ARGD, CONFIG.settings)
+    changes = oldsnap.diff(CONFIGSNAP)
+    for option, oldval, newval in changes:
+        log.msg('Config changed: {}: {} -> {}'.format(
+            option,
+            format_value(option, oldval),
+            format_value(option, newval)))
+    options = [change[0] for change in changes]
+    # Passwords are only used when connecting, they aren't mentioned.
+    restart = [
+        o for o in options
+        if (o not in LIVE_OPTIONS) and not is_secret(o)
+    ]
+    if restart:
+        log.msg('Config changes that need a restart: {}'.format(
+            ', '.join(restart)))
+    if ('logsample' in options) and (LOGGER is not None):
+        LOGGER.rates = parse_rates(get_config('logsample', default=''))
+    if 'sandbox' in options:
+        sandbox = get_config('sandbox', None)
+        if sandbox:
+            try:
+                set_pypysandbox(sandbox)
+            except SandboxNotFound as exsandbox:
+                log.msg('{}, keeping the current one.'.format(exsandbox))
+    for client in list(CONNECTIONS.values()):
+        client.apply_config(options)
+    return changes
+
+
+def reload_config():
+    """ Load the config file again, and apply the changed settings
+        (see refresh_config()). The current settings are kept when the
+        file can't be loaded. Returns a short status string for chat.
+    """
+    configfile = CONFIG.configfile or DEFAULT_CONFIGFILE
+    try:
+        settings = load_settings(configfile)
+    except EnvironmentError as ex:
+        log.msg('Unable to reload config: {}'.format(ex))
+        return 'unable to reload config: {}'.format(ex)
+    log.msg('Reloaded config file: {}'.format(configfile))
+    # One assignment, so readers of CONFIG never see a partly loaded file.
+    CONFIG.settings = settings.settings
+    changes = refresh_config()
+    if not changes:
+        return 'config reloaded, nothing changed.'
+    return 'config reloaded, changed: {}'.format(
+        ', '.join(change[0] for change in changes))
 
 
 def save_config():
@@ -910,35 +1420,66 @@ def write_pidfile():
         return False
 
 
-def main(reactor, serverstr, argd):
-    """ main-entry point for ircbot. """
-    global factory
-
-    try:
-        endpoint = endpoints.clientFromString(reactor, serverstr)
-        # Global factory for creating client instances, and reconnecting.
-        factory = PyValIRCFactory(argd=argd, serverstr=serverstr)
-        # Connect the factory to the specified host/port.
-        d = endpoint.connect(factory)
-        # Add protocol's main deferred, which can be fired on fatal errors.
-        d.addCallback(lambda protocol: protocol.deferred)
-        return d
-    except Exception as ex:
-        log.msg('Error in main():\n{}'.format(ex))
+def main(reactor, networks, argd):
+    """ main-entry point for ircbot.
+        Connects to each network, and returns a deferred that fires when
+        they are all disconnected.
+    """
+    # Metrics for all connections.
+    ADMISSION_QUEUED.set_function(lambda: get_shared()[0].queued())
+    HANDLING.set_function(lambda: sum(
+        p.admin.handlingcount for p in CONNECTIONS.values()))
+    SENDQ_DEPTH.set_function(lambda: sum(
+        p.admin.sendq.depth() for p in CONNECTIONS.values()))
+
+    def shard_failed(failureobj, shards, name):
+        log.msg('Unable to connect as: {}'.format(name))
+        shards.remove(name)
+        return failureobj
+
+    deferreds = []
+    for network in networks:
+        # Final server string for endpoints.clientFromString()
+        serverstr = 'tcp:{}:{}'.format(network['server'], network['port'])
+        shardnetworks = get_shard_networks(network)
+        shards = None
+        if len(shardnetworks) > 1:
+            shards = ShardGroup([n['nick'] for n in shardnetworks])
+        for shardnetwork in shardnetworks:
+            log.msg('Connecting to: {}, port: {}{}'.format(
+                network['server'],
+                network['port'],
+                ', as: {}'.format(shardnetwork['nick']) if shards else ''))
+            try:
+                endpoint = endpoints.clientFromString(reactor, serverstr)
+                # Factory for creating client instances, and reconnecting.
+                factory = PyValIRCFactory(
+                    argd=argd,
+                    network=shardnetwork,
+                    shards=shards)
+                # Connect the factory to the specified host/port.
+                d = endpoint.connect(factory)
+            except Exception as ex:
+                log.msg('Error in main():\n{}'.format(ex))
+                continue
+            if shards is not None:
+                # Channels for a connection that can't be made go to the
+                # others.
+                d.addErrback(shard_failed, shards, shardnetwork['nick'])
+            # Add protocol's main deferred, which can be fired on fatal
+            # errors.
+            d.addCallback(lambda protocol: protocol.deferred)
+            deferreds.append(d)
+    if not deferreds:
         return None
+    if len(deferreds) == 1:
+        return deferreds[0]
+    # One connection going down doesn't stop the others.
+    return defer.DeferredList(deferreds)
 
 
 if __name__ == '__main__':
-    # Get docopt args
-    MAIN_ARGD = docopt(USAGESTR, version=VERSIONSTR)
-
-    # Some args don't need to run the bot.
-    if MAIN_ARGD['--dumpconfig']:
-        if dump_config():
-            # Config dumped, exit on success.
-            sys.exit(0)
-        # Bad config dump.
-        sys.exit(1)
+    # MAIN_ARGD was parsed before the heavy imports, near the top.
 
     # Load config file, either default or user-specified.
     CONFIGFILE = MAIN_ARGD['--config'] or DEFAULT_CONFIGFILE
@@ -952,41 +1493,55 @@ if __name__ == '__main__':
 
     # Start logging as soon as possible.
     # Open log file if --logfile is passed, (fallback to stderr on error)
+    logjson = bool(get_config('logjson', default=False))
     if get_config('logfile', default=False):
         logfilename = '{}.log'.format(NAME.lower().replace(' ', '-'))
         try:
-            logfile = open(logfilename, 'w')
-            log.startLogging(logfile)
+            LOGGER = LogPipeline(filename=logfilename, jsonlines=logjson)
         except (IOError, OSError) as exio:
             print('\nUnable to open logfile!: '
                   '{}\nstderr will be used instead.\n'.format(logfilename))
-            log.startLogging(sys.stderr)
-    else:
+    if LOGGER is None:
         # normal stderr logging
-        log.startLogging(sys.stderr)
+        LOGGER = LogPipeline(stream=sys.stderr, jsonlines=logjson)
+    log.startLoggingWithObserver(LOGGER)
+    LOGGER.rates = parse_rates(get_config('logsample', default=''))
+    # Write logs in batches from a thread once the reactor is running,
+    # and everything that's left when it stops.
+    LOGGER.run_with(reactor)
     # Fixup the main log prefix, should only affect msgs at the main level.
     log.logPrefix = lambda self: '{}-Main'.format(NAME)
 
     # Write pid file.
     write_pidfile()
-
-    # Parse server/port settings from cmdline, or set defaults.
-    servername = get_config('server', default='irc.freenode.net')
-    portnum = get_config('port', default='6667')
-
-    try:
-        # validate user's port number (redundant when no --port was given)
-        int(portnum)
-    except (ValueError, TypeError):
-        log.msg('Invalid port number given!: {}'.format(portnum))
+    start_metrics()
+    # Reload the config file on SIGHUP, in the reactor's thread.
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(
+            signal.SIGHUP,
+            lambda signum, frame: reactor.callFromThread(reload_config))
+
+    # Parse network/server/port settings from config/cmdline, or set
+    # defaults.
+    NETWORKS = get_networks()
+    if not NETWORKS:
+        log.msg('No valid networks to connect to!')
         sys.exit(1)
-
-    # Final server string for endpoints.clientFromString()
-    serverstr = 'tcp:{}:{}'.format(servername, portnum)
-
-    # Global factory instance, clients need to call 'resetDelay' on connect.
-    # main() creates the instance.
-    factory = None
-    # Start irc client.
-    log.msg('Connecting to: {}, port: {}'.format(servername, portnum))
-    task.react(main, [serverstr, MAIN_ARGD])
+    for network in NETWORKS:
+        try:
+            # validate user's port number
+            # (redundant when no --port was given)
+            int(network['port'])
+        except (ValueError, TypeError):
+            log.msg('Invalid port number given!: {}'.format(network['port']))
+            sys.exit(1)
+        try:
+            if int(network['connections']) < 1:
+                raise ValueError('Must be at least 1.')
+        except (ValueError, TypeError):
+            log.msg('Invalid number of connections given!: {}'.format(
+                network['connections']))
+            sys.exit(1)
+
+    # Start irc clients.
+    task.react(main, [NETWORKS, MAIN_ARGD])
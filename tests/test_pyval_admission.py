@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Admission Scheduler
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+from collections import deque
+import unittest
+
+from twisted.internet import defer
+
+from pyval_admission import AdmissionScheduler
+from pyval_registry import COST_EVALUATION, COST_INSTANT, COST_NETWORK
+
+
+class TestAdmissionScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = AdmissionScheduler(workers=1, maxqueue=2)
+        # Commands that have started: [(name, deferred), ...]
+        self.started = []
+        # Results that were delivered, in order.
+        self.results = []
+
+    def finish(self, name):
+        """ Finish a started command, it returns its own name. """
+        for startname, d in self.started:
+            if startname == name:
+                self.started.remove((startname, d))
+                d.callback(name)
+                return None
+        self.fail('Command was not started: {}'.format(name))
+
+    def submit(self, nick, name, is_admin=False, cost=COST_EVALUATION,
+               group=None):
+        """ Submit a command that waits until finish(name) is called. """
+        def func():
+            d = defer.Deferred()
+            self.started.append((name, d))
+            return d
+
+        d = self.scheduler.submit(
+            nick,
+            func,
+            is_admin=is_admin,
+            cost=cost,
+            group=group)
+        d.addCallback(self.results.append)
+        return d
+
+    def started_names(self):
+        return [name for name, _ in self.started]
+
+    def test_concurrency_limit(self):
+        """ only `workers` commands run at once """
+        self.scheduler.set_workers(2)
+        for name in ('a1', 'b1', 'c1'):
+            self.submit(name[0], name)
+        self.assertEqual(self.started_names(), ['a1', 'b1'])
+        self.assertEqual(self.scheduler.queued(), 1)
+
+        self.finish('a1')
+        self.assertEqual(self.results, ['a1'])
+        self.assertEqual(self.started_names(), ['b1', 'c1'])
+        self.assertEqual(self.scheduler.running[COST_EVALUATION], 2)
+
+        # Commands that finish right away free their slot right away.
+        self.finish('b1')
+        self.finish('c1')
+        results = []
+        for _ in range(5):
+            self.scheduler.submit('a', lambda: 'now').addCallback(
+                results.append)
+        self.assertEqual(results, ['now'] * 5)
+        self.assertEqual(self.scheduler.running[COST_EVALUATION], 0)
+
+    def test_round_robin(self):
+        """ waiting nicks take turns """
+        self.submit('busy', 'busy1')
+        self.submit('busy', 'busy2')
+        self.submit('busy', 'busy3')
+        self.submit('calm', 'calm1')
+        self.submit('other', 'other1')
+        expected = ['busy1', 'busy2', 'calm1', 'other1', 'busy3']
+        for name in expected:
+            self.assertEqual(self.started_names(), [name])
+            self.finish(name)
+        self.assertEqual(self.results, expected)
+        self.assertEqual(self.scheduler.queued(), 0)
+        self.assertEqual(self.scheduler.queues, {})
+
+    def test_queue_full(self):
+        """ nicks with a full queue get a message instead """
+        self.submit('nick', 'run')
+        self.submit('nick', 'wait1')
+        self.submit('nick', 'wait2')
+        self.submit('nick', 'toomany')
+        self.assertEqual(self.scheduler.queued('nick'), 2)
+        self.assertEqual(self.scheduler.rejected, 1)
+        self.assertEqual(
+            self.results,
+            [self.scheduler.full_msg.format(queued=2)])
+        # Other nicks can still queue.
+        self.submit('other', 'other1')
+        self.assertEqual(self.scheduler.queued(), 3)
+        self.assertIn('queued: 3 (2 nicks)', self.scheduler.status())
+
+    def test_group_fairness(self):
+        """ groups (networks) take turns before their nicks do """
+        self.submit('nick', 'run')
+        for name in ('a1', 'a2'):
+            self.submit(name[0], name, group='net1')
+        self.submit('b', 'b1', group='net1')
+        self.submit('c', 'c1', group='net2')
+        # The same nick on another network has its own queue.
+        self.submit('a', 'other-a1', group='net2')
+        self.assertEqual(self.scheduler.queued('a', group='net1'), 2)
+        self.assertEqual(self.scheduler.queued('a', group='net2'), 1)
+
+        for expected in ('a1', 'c1', 'b1', 'other-a1', 'a2'):
+            self.finish(self.started_names()[0])
+            self.assertEqual(self.started_names(), [expected])
+        self.assertEqual(self.scheduler.order, deque())
+        self.assertEqual(self.scheduler.nickorder, {})
+
+    def test_admin_lane(self):
+        """ admin commands are never blocked by evaluations """
+        self.submit('nick', 'eval1')
+        self.submit('nick', 'eval2')
+        self.submit('admin', 'adminload', is_admin=True)
+        self.assertEqual(self.started_names(), ['eval1', 'adminload'])
+        self.finish('adminload')
+        self.assertEqual(self.results, ['adminload'])
+        # Admin commands don't take a slot.
+        self.assertEqual(self.scheduler.running[COST_EVALUATION], 1)
+        self.assertEqual(self.scheduler.queued(), 1)
+
+    def test_cost_classes(self):
+        """ each cost class has its own limit """
+        self.scheduler.limits[COST_NETWORK] = 1
+        self.submit('a', 'eval1')
+        self.submit('a', 'eval2')
+        self.submit('b', 'net1', cost=COST_NETWORK)
+        self.submit('b', 'net2', cost=COST_NETWORK)
+        self.submit('c', 'uptime', cost=COST_INSTANT)
+        # Waiting evaluations don't hold up other classes, and instant
+        # commands always run.
+        self.assertEqual(self.started_names(), ['eval1', 'net1', 'uptime'])
+        self.finish('uptime')
+        self.finish('net1')
+        self.assertEqual(self.started_names(), ['eval1', 'net2'])
+        self.finish('eval1')
+        self.assertEqual(self.started_names(), ['net2', 'eval2'])
+        self.assertIn('network: 1/1', self.scheduler.status())
+
+    def test_errors(self):
+        """ errors are passed on, and free the slot """
+        def broken():
+            raise ValueError('broken')
+
+        errors = []
+        d = self.scheduler.submit('nick', broken)
+        d.addErrback(lambda failureobj: errors.append(failureobj.value))
+        self.assertIsInstance(errors[0], ValueError)
+        self.assertEqual(self.scheduler.running[COST_EVALUATION], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
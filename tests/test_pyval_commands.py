@@ -11,11 +11,24 @@
 
 import unittest
 import random
-from pyval_commands import AdminHandler, CommandHandler
 
+from twisted.internet import defer
 
-# Only load admin help once, and save it here.
-ADMINHELP = None
+from pyval_commands import (
+    ADMINFILE,
+    BANFILE,
+    AdminHandler,
+    CommandHandler,
+    Reply,
+    network_file)
+from pyval_exec import ExecBox, find_pypysandbox
+from pyval_masks import MaskRegistry
+from pyval_pastecache import PasteCache
+from pyval_registry import COST_NETWORK
+from pyval_trace import Tracer
+
+PYPYSANDBOX_EXISTS = find_pypysandbox() is not None
+NOSANDBOX_MSG = 'no pypy-sandbox executable found.'
 
 
 class NoCommand(object):
@@ -94,14 +107,11 @@ class TestCommandFuncs(unittest.TestCase):
 
     def setUp(self):
         """ Setup each test with an admin/command handler """
-        global ADMINHELP
-        if ADMINHELP:
-            self.adminhandler = AdminHandler(help_info=ADMINHELP)
-        else:
-            self.adminhandler = AdminHandler()
-            ADMINHELP = self.adminhandler.help_info
+        self.adminhandler = AdminHandler()
         self.adminhandler.nickname = 'testnick'
-        self.adminhandler.admins.add('testadmin')
+        self.adminhandler.admins.add('testadmin', save=False)
+        # Don't use (or save) the bot's paste cache file.
+        self.adminhandler.pastecache = PasteCache()
         self.cmdhandler = CommandHandler(adminhandler=self.adminhandler)
 
     def test_admin_getattr(self):
@@ -140,6 +150,277 @@ class TestCommandFuncs(unittest.TestCase):
             True,
             msg='Failed to set attribute')
 
+    def test_admin_load(self):
+        """ admin command load works """
+        cmdresult = self.get_usercmd_result(
+            self.cmdhandler,
+            self.cmd_str('load'),
+            asadmin=True)
+        if isinstance(cmdresult, NoCommand):
+            self.fail_nocmd(cmdresult)
+        self.assertTrue(
+            cmdresult.startswith('state: normal'),
+            msg='Bad load status: {}'.format(cmdresult))
+
+    def test_admin_configreload(self):
+        """ admin command configreload uses the bot's reload """
+        cmdresult = self.get_usercmd_result(
+            self.cmdhandler,
+            self.cmd_str('configreload'),
+            asadmin=True)
+        if isinstance(cmdresult, NoCommand):
+            self.fail_nocmd(cmdresult)
+        self.assertIn('not available', cmdresult)
+
+        self.adminhandler.reload_config = lambda: 'config reloaded.'
+        cmdresult = self.get_usercmd_result(
+            self.cmdhandler,
+            self.cmd_str('configreload'),
+            asadmin=True)
+        self.assertEqual(cmdresult, 'config reloaded.')
+
+    def test_ban_admins(self):
+        """ bans that would cover an admin are refused """
+        admin = self.adminhandler
+        # Don't use (or save) the bot's ban list.
+        admin.banned = MaskRegistry()
+        admin.admins.add('maskadmin!user@admin.host', save=False)
+        for mask in ('*', '*!*@*', 'testadmin', '*@admin.host', 'mask*'):
+            self.assertEqual(admin.ban_addperma(mask), [])
+        self.assertEqual(len(admin.banned), 0)
+        self.assertEqual(
+            admin.ban_addperma(['baduser', '*@bad.host']),
+            ['baduser', '*@bad.host'])
+        self.assertIn('baduser!u@h', admin.banned)
+
+    def test_network_files(self):
+        """ each network keeps its own admins and bans """
+        self.assertEqual(network_file('pyval_admins.lst'), 'pyval_admins.lst')
+        self.assertEqual(
+            network_file('pyval_admins.lst', 'freenode'),
+            'pyval_admins.freenode.lst')
+        self.assertEqual(
+            network_file('pyval_banned.lst', '../irc net'),
+            'pyval_banned..._irc_net.lst')
+        self.assertEqual(self.adminhandler.admins.filename, ADMINFILE)
+        self.assertEqual(self.adminhandler.banned.filename, BANFILE)
+        netadmin = AdminHandler(network='freenode')
+        self.assertEqual(
+            netadmin.admins.filename,
+            network_file(ADMINFILE, 'freenode'))
+        self.assertEqual(
+            netadmin.banned.filename,
+            network_file(BANFILE, 'freenode'))
+
+    def test_ban_warnings(self):
+        """ ban warnings are counted, and forgotten after a while """
+        admin = self.cmdhandler.admin
+        self.assertEqual(admin.ban_add('testadmin'), '')
+        self.assertEqual(
+            admin.ban_add('fastnick'),
+            'slow down with your commands.')
+        self.assertEqual(
+            admin.ban_add('fastnick'),
+            'really, slow down with your commands.')
+        self.assertEqual(admin.banned_warned['fastnick']['count'], 2)
+        # Old warnings expire, the next one is a first warning again.
+        admin.banned_warned['fastnick']['last'] -= admin.banwarn_expire
+        admin.ban_expire_warnings()
+        self.assertEqual(admin.banned_warned, {})
+        admin.ban_add('fastnick')
+        self.assertEqual(admin.banned_warned['fastnick']['count'], 1)
+
+    def test_cmd_python_shedding(self):
+        """ cmd_python refuses non-admin evaluations when shedding """
+        load = self.adminhandler.load
+        load.set_level(load.states.index('shedding'))
+        python = self.cmdhandler.commands.cmd_python
+        result = python('1 + 1', nick='testuser')
+        self.assertIn('too busy', result)
+        # Shedding doesn't depend on rate limiting.
+        self.adminhandler.limit_rate = False
+        result = python('1 + 1', nick='testuser')
+        self.assertIn('too busy', result)
+        # Admins (by mask, checked by privmsg) are still allowed.
+        if PYPYSANDBOX_EXISTS:
+            result = python('1 + 1', nick='testuser', is_admin=True)
+            self.assertEqual(result, '2')
+
+    def test_cmd_python_quota(self):
+        """ cmd_python refuses nicks over their cpu quota """
+        self.adminhandler.config = {'quotanick': '5', 'quotawindow': 'bad'}
+        self.adminhandler.apply_quota_config()
+        quota = self.adminhandler.quota_nick
+        self.assertEqual(quota.limit, 5)
+        self.assertEqual(quota.window, 300)
+
+        quota.add('testuser', 6)
+        python = self.cmdhandler.commands.cmd_python
+        result = python('1 + 1', nick='testuser')
+        self.assertIn('cpu quota used up', result)
+
+        # The channel is charged for the nick's cpu time.
+        if PYPYSANDBOX_EXISTS:
+            self.assertEqual(
+                python('1 + 1', nick='othernick', channel='#chan'),
+                '2')
+            self.assertTrue(self.adminhandler.quota_chan.used('#chan') > 0)
+
+        cmdresult = self.get_usercmd_result(
+            self.cmdhandler,
+            self.cmd_str('quota testuser'),
+            asadmin=True)
+        if isinstance(cmdresult, NoCommand):
+            self.fail_nocmd(cmdresult)
+        self.assertIn('0.00s left', cmdresult)
+
+    @unittest.skipUnless(PYPYSANDBOX_EXISTS, NOSANDBOX_MSG)
+    def test_cmd_python_nopaste(self):
+        """ cmd_python skips pastes when paste is disabled under load """
+        load = self.adminhandler.load
+        load.set_level(load.states.index('nopaste'))
+        python = self.cmdhandler.commands.cmd_python
+
+        # Nothing is cut from short output.
+        result = python('--paste 1 + 1', nick='testuser')
+        self.assertIn('paste is disabled', result)
+        self.assertNotIn('truncated', result)
+
+        # Long output is cut, and says so.
+        result = python("'x' * 300", nick='testuser')
+        self.assertIn('paste is disabled', result)
+        self.assertIn('truncated', result)
+
+    @unittest.skipUnless(PYPYSANDBOX_EXISTS, NOSANDBOX_MSG)
+    def test_cmd_python_time(self):
+        """ cmd_python times code with --time """
+        python = self.cmdhandler.commands.cmd_python
+        result = python('--time x = 1 + 1 ;; x = 2', nick='testuser')
+        self.assertIn('loops', result)
+        self.assertIn('[2] is', result)
+
+    @unittest.skipUnless(PYPYSANDBOX_EXISTS, NOSANDBOX_MSG)
+    def test_cmd_python_trace(self):
+        """ cmd_python adds its stages to the trace """
+        self.adminhandler.blacklist = True
+        tracer = Tracer()
+        trace = tracer.new('python', nick='testuser')
+        python = self.cmdhandler.commands.cmd_python
+        self.assertEqual(python('1 + 1', nick='testuser', trace=trace), '2')
+        tracer.finish(trace)
+        self.assertEqual(
+            [span[0] for span in trace.spans],
+            ['blacklist', 'spawn', 'run', 'format', 'total'])
+        self.adminhandler.tracer = tracer
+        cmdresult = self.get_usercmd_result(
+            self.cmdhandler,
+            self.cmd_str('stats latency'),
+            asadmin=True)
+        if isinstance(cmdresult, NoCommand):
+            self.fail_nocmd(cmdresult)
+        self.assertIn('spawn:', cmdresult)
+        self.assertIn('(n=1)', cmdresult)
+
+    def test_paste_followup(self):
+        """ long results are sent right away, the paste url follows """
+        pastes = []
+
+        class FakePaster(object):
+            def paste(self, data):
+                pastes.append(defer.Deferred())
+                return pastes[-1]
+
+        self.adminhandler.paster = FakePaster()
+        execbox = ExecBox("'x' * 300")
+        execbox.output = 'x' * 300
+        execbox.lasterror = None
+        reply = self.cmdhandler.commands.python_chatout(
+            execbox.output,
+            execbox,
+            "'x' * 300",
+            nick='testuser')
+        self.assertIsInstance(reply, Reply)
+        self.assertIn('truncated', reply)
+        followups = []
+        reply.followup.addCallback(followups.append)
+        self.assertEqual(followups, [])
+        scheduler = self.adminhandler.scheduler
+        self.assertEqual(scheduler.running[COST_NETWORK], 1)
+
+        pastes[0].callback('https://paste/1')
+        self.assertEqual(followups, ['full output: https://paste/1'])
+        self.assertEqual(scheduler.running[COST_NETWORK], 0)
+
+        # The same output again uses the cached url.
+        reply = self.cmdhandler.commands.python_chatout(
+            execbox.output,
+            execbox,
+            "'x' * 300",
+            nick='testuser')
+        reply.followup.addCallback(followups.append)
+        self.assertEqual(len(pastes), 1)
+        self.assertEqual(followups[-1], 'full output: https://paste/1')
+
+        # The paste names the nick, so another nick gets its own paste.
+        reply = self.cmdhandler.commands.python_chatout(
+            execbox.output,
+            execbox,
+            "'x' * 300",
+            nick='othernick')
+        reply.followup.addCallback(followups.append)
+        self.assertEqual(len(pastes), 2)
+        pastes[1].callback('https://paste/2')
+        self.assertEqual(followups[-1], 'full output: https://paste/2')
+
+    def test_paste_queue_full(self):
+        """ pastes aren't queued behind too many commands """
+        pastes = []
+
+        class FakePaster(object):
+            def paste(self, data):
+                pastes.append(defer.Deferred())
+                return pastes[-1]
+
+        self.adminhandler.paster = FakePaster()
+        self.adminhandler.scheduler.maxqueue = 0
+        execbox = ExecBox("'y' * 300")
+        execbox.output = 'y' * 300
+        execbox.lasterror = None
+        reply = self.cmdhandler.commands.python_chatout(
+            execbox.output,
+            execbox,
+            "'y' * 300",
+            nick='testuser')
+        self.assertIsInstance(reply, Reply)
+        followups = []
+        reply.followup.addCallback(followups.append)
+        self.assertEqual(pastes, [])
+        self.assertEqual(
+            followups,
+            ['too many commands waiting, full output not pasted.'])
+
+    def test_paste_cache_testmode(self):
+        """ test pastes aren't cached """
+        pastes = []
+
+        class FakePaster(object):
+            def paste(self, data):
+                pastes.append(data)
+                return defer.succeed('https://paste/test')
+
+        self.adminhandler.paster = FakePaster()
+        pastebin = self.cmdhandler.commands.print_topastebin
+        for _ in range(2):
+            pastebin('<pyvaltest> query', 'result')
+        self.assertEqual(len(pastes), 2)
+        self.assertTrue(pastes[0]['disabled'])
+        self.assertEqual(len(self.adminhandler.pastecache), 0)
+
+        for _ in range(2):
+            pastebin('query', 'result')
+        self.assertEqual(len(pastes), 3)
+        self.assertEqual(len(self.adminhandler.pastecache), 1)
+
     def test_print_topastebin(self):
         """ test print_topastebin() """
 
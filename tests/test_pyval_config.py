@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Config Snapshots
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from easysettings import EasySettings
+
+from pyval_config import ConfigSnapshot, format_value, load_settings
+
+
+class TestConfigSnapshot(unittest.TestCase):
+
+    def test_build(self):
+        """ cmdline args that were given win over config settings """
+        argd = {
+            '--monitor': True,
+            '--nick': None,
+            '--workers': '4',
+            '--help': False,
+        }
+        settings = {'nick': 'pyval', 'workers': '2', 'monitor': False}
+        snap = ConfigSnapshot.build(argd, settings)
+        self.assertEqual(snap.get('monitor'), True)
+        self.assertEqual(snap.get('--workers'), '4')
+        self.assertEqual(snap.get('nick'), 'pyval')
+        self.assertEqual(snap.get('help', 'default'), 'default')
+        self.assertEqual(snap.get(None, 'default'), 'default')
+        self.assertIn('nick', snap)
+        self.assertNotIn('help', snap)
+        # Changing the source doesn't change the snapshot.
+        settings['nick'] = 'other'
+        self.assertEqual(snap.get('nick'), 'pyval')
+
+    def test_diff(self):
+        """ diff() lists the changed settings """
+        old = ConfigSnapshot({'nick': 'pyval', 'monitor': False, 'x': 1})
+        new = ConfigSnapshot({'nick': 'pyval', 'monitor': True, 'y': 2})
+        self.assertEqual(
+            old.diff(new),
+            [('monitor', False, True), ('x', 1, None), ('y', None, 2)])
+        self.assertEqual(new.diff(new), [])
+
+    def test_format_value(self):
+        """ passwords are hidden in the log """
+        self.assertEqual(format_value('nick', 'pyval'), repr('pyval'))
+        self.assertEqual(format_value('password', 'secret'), '********')
+        self.assertEqual(format_value('nickservpw', 'secret'), '********')
+        self.assertEqual(format_value('password', None), 'None')
+
+    def test_readonly(self):
+        """ snapshots can't be changed """
+        snap = ConfigSnapshot({'nick': 'pyval'})
+        with self.assertRaises(AttributeError):
+            snap.values = {}
+        with self.assertRaises(AttributeError):
+            snap.nick = 'other'
+
+
+class TestLoadSettings(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'pyval.conf')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_settings(self):
+        """ load_settings() loads into new settings, or raises """
+        with self.assertRaises(EnvironmentError):
+            load_settings(self.filename)
+
+        settings = EasySettings(self.filename)
+        settings.set('channels', '#pyval,#python')
+        settings.set('workers', 3)
+        self.assertTrue(settings.save())
+        loaded = load_settings(self.filename)
+        self.assertIsNot(loaded, settings)
+        self.assertEqual(loaded.get('channels'), '#pyval,#python')
+        self.assertEqual(loaded.get('workers'), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -8,12 +8,13 @@
 
     -Christopher Welborn 5-27-15
 """
-import os.path
+import signal
 import unittest
 
-from pyval_exec import ExecBox, PYPYSANDBOX_EXE
+import pyval_exec
+from pyval_exec import ExecBox, SandboxNotFound, find_pypysandbox
 
-PYPYSANDBOX_EXISTS = os.path.exists(PYPYSANDBOX_EXE)
+PYPYSANDBOX_EXISTS = find_pypysandbox() is not None
 NOSANDBOX_MSG = (
     'ERROR: no pypy-sandbox executable found! pyvalbot will not work.'
 )
@@ -62,6 +63,68 @@ class TestExec(unittest.TestCase):
             'truncated' in safeoutput,
             msg='safe_output() did not truncate lines: {}'.format(safeoutput))
 
+    @unittest.skipUnless(PYPYSANDBOX_EXISTS, NOSANDBOX_MSG)
+    def test_limits(self):
+        """ cpu time, memory, and wall-clock limits are enforced """
+        loopcode = 'x = 0\\nwhile 1:\\n    x += 1'
+        output = ExecBox(loopcode).execute(
+            raw_output=True,
+            timeout=5,
+            cputimeout=1)
+        self.assertIn('CPU time limit exceeded (1s)', output)
+
+        output = ExecBox(loopcode).execute(
+            raw_output=True,
+            timeout=1,
+            cputimeout=5)
+        self.assertIn('timed out (1s)', output)
+
+        ebox = ExecBox('[0] * (10 ** 10)')
+        output = ebox.execute(raw_output=True)
+        self.assertIn('memory limit exceeded', output)
+
+        # Normal code is unaffected, and the cpu time is measured.
+        output = ebox.execute(evalstr='1 + 1', raw_output=True)
+        self.assertEqual(output, '2')
+        self.assertTrue(ebox.cputime > 0)
+
+    def test_limit_msg(self):
+        """ the cpu limit is decided by cpu time, not SIGKILL alone """
+        ebox = ExecBox('')
+        ebox.cputime = 0.2
+        self.assertIsNone(
+            ebox.get_limit_msg('', -signal.SIGKILL, cputimeout=5))
+        self.assertIn(
+            'CPU time limit',
+            ebox.get_limit_msg('', -signal.SIGXCPU, cputimeout=5))
+        ebox.cputime = 6.1
+        self.assertIn(
+            'CPU time limit',
+            ebox.get_limit_msg('', -signal.SIGKILL, cputimeout=5))
+        # Killed at the wall-clock timeout.
+        ebox.killed = True
+        self.assertIsNone(
+            ebox.get_limit_msg('', -signal.SIGKILL, cputimeout=5))
+
+    def test_missing_sandbox(self):
+        """ a bad sandbox path gives a clear error, not an exit """
+        with self.assertRaises(SandboxNotFound):
+            pyval_exec.set_pypysandbox('/nonexistent/pypy-sandbox')
+
+        oldexe = pyval_exec.PYPYSANDBOX_EXE
+        oldfind = pyval_exec.find_pypysandbox
+        try:
+            # Nothing found by the search.
+            pyval_exec.PYPYSANDBOX_EXE = None
+            pyval_exec.find_pypysandbox = lambda: None
+            output = ExecBox('1 + 1').execute(raw_output=True)
+            self.assertTrue(
+                output.startswith('PyVal Error: Unable to find pypy-sandbox'),
+                msg='Bad error for missing sandbox: {}'.format(output))
+        finally:
+            pyval_exec.PYPYSANDBOX_EXE = oldexe
+            pyval_exec.find_pypysandbox = oldfind
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Load Controller
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from pyval_load import LoadController
+
+
+class TestLoadController(unittest.TestCase):
+
+    def setUp(self):
+        self.load = LoadController(workers=1, interval=1)
+        self.load.recover_samples = 3
+
+    def test_steps_down_in_stages(self):
+        """ load state degrades one step per overloaded sample """
+        self.assertEqual(self.load.sample(10), 'short')
+        self.assertEqual(self.load.get_timeout(), self.load.timeout_short)
+        self.assertTrue(self.load.allow_paste())
+
+        self.assertEqual(self.load.sample(10), 'nopaste')
+        self.assertFalse(self.load.allow_paste())
+        self.assertTrue(self.load.allow_eval())
+
+        self.assertEqual(self.load.sample(10), 'shedding')
+        self.assertFalse(self.load.allow_eval())
+        self.assertTrue(self.load.allow_eval(is_admin=True))
+        # Can't go any further.
+        self.assertEqual(self.load.sample(10), 'shedding')
+        self.assertEqual(self.load.changecount, 3)
+
+    def test_busy_workers(self):
+        """ worker use alone can degrade the load state """
+        self.load.sampletime = 0
+        self.load.add_busy(0.95)
+        self.assertEqual(self.load.sample(0, now=1), 'short')
+        self.assertAlmostEqual(self.load.busy, 0.95)
+        # Busy time is only counted once.
+        self.load.sample(0, now=2)
+        self.assertEqual(self.load.busy, 0)
+
+    def test_late_sample(self):
+        """ worker use is measured over the real time between samples """
+        self.load.sampletime = 0
+        # One busy second, but the sample came 4 seconds late.
+        self.load.add_busy(1)
+        self.assertEqual(self.load.sample(0, now=5), 'normal')
+        self.assertAlmostEqual(self.load.busy, 0.2)
+
+    def test_recover_hysteresis(self):
+        """ load state recovers only after several calm samples """
+        self.load.sample(10)
+        self.load.sample(10)
+        self.assertEqual(self.load.state, 'nopaste')
+
+        # Under the limit to enter 'nopaste', but not calm enough to recover.
+        for _ in range(10):
+            self.assertEqual(self.load.sample(3), 'nopaste')
+
+        # Calm samples, one step back per recover_samples.
+        for _ in range(self.load.recover_samples - 1):
+            self.assertEqual(self.load.sample(0), 'nopaste')
+        self.assertEqual(self.load.sample(0), 'short')
+        for _ in range(self.load.recover_samples):
+            self.load.sample(0)
+        self.assertEqual(self.load.state, 'normal')
+        self.assertEqual(len(self.load.changes), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
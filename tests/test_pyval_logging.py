@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Log Pipeline
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+from io import BytesIO
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from pyval_logging import LogPipeline, parse_rates
+
+
+def event(msg, **kwargs):
+    """ Build a log event like log.msg() does. """
+    eventdict = {
+        'message': (msg,),
+        'isError': 0,
+        'system': 'test',
+        'time': 0,
+    }
+    eventdict.update(kwargs)
+    return eventdict
+
+
+class FakeReactor(task.Clock):
+
+    """ Clock that keeps startup/shutdown calls, to run them later. """
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.startup = []
+        self.shutdown = []
+
+    def addSystemEventTrigger(self, phase, eventtype, func):
+        self.shutdown.append(func)
+
+    def callWhenRunning(self, func, *args, **kwargs):
+        self.startup.append((func, args, kwargs))
+
+    def run(self):
+        for func, args, kwargs in self.startup:
+            func(*args, **kwargs)
+
+    def stop(self):
+        for func in self.shutdown:
+            func()
+
+
+class TestLogPipeline(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'test.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_lines(self, filename=None):
+        with open(filename or self.filename) as f:
+            return f.read().splitlines()
+
+    def test_batches(self):
+        """ events are written in batches once started """
+        stream = BytesIO()
+        clock = task.Clock()
+        pipeline = LogPipeline(stream=stream, maxqueue=2, jsonlines=True)
+        pipeline(event('before start'))
+        self.assertEqual(
+            json.loads(stream.getvalue()),
+            {'time': 0, 'system': 'test', 'msg': 'before start'})
+
+        pipeline.start(clock=clock)
+        # Written in the test's thread.
+        pipeline.threaded = False
+        pipeline(event('one', category='data'))
+        pipeline(event('two', isError=1, why='error'))
+        pipeline(event('dropped'))
+        self.assertEqual(len(stream.getvalue().splitlines()), 1)
+        self.assertEqual(pipeline.dropped, 1)
+
+        clock.advance(pipeline.interval)
+        records = [json.loads(l) for l in stream.getvalue().splitlines()]
+        self.assertEqual(records[1]['category'], 'data')
+        self.assertTrue(records[2]['error'])
+        self.assertEqual(pipeline.written, 3)
+
+        pipeline(event('last'))
+        pipeline.stop()
+        self.assertIn('last', stream.getvalue())
+        self.assertFalse(pipeline.loop.running)
+
+    def test_run_with(self):
+        """ events are written right away unless the reactor runs """
+        stream = BytesIO()
+        reactor = FakeReactor()
+        pipeline = LogPipeline(stream=stream)
+        pipeline.run_with(reactor)
+        # Like a startup error before sys.exit(), it can't wait.
+        pipeline(event('before running'))
+        self.assertIn('before running', stream.getvalue())
+
+        reactor.run()
+        self.assertTrue(pipeline.loop.running)
+        # Written in the test's thread.
+        pipeline.threaded = False
+        pipeline(event('batched'))
+        self.assertNotIn('batched', stream.getvalue())
+        reactor.advance(pipeline.interval)
+        self.assertIn('batched', stream.getvalue())
+
+        pipeline(event('before shutdown'))
+        reactor.stop()
+        self.assertIn('before shutdown', stream.getvalue())
+        self.assertFalse(pipeline.loop.running)
+        # Shutdown messages from other triggers aren't lost.
+        pipeline(event('after stop'))
+        self.assertIn('after stop', stream.getvalue())
+        self.assertEqual(len(pipeline.queue), 0)
+
+    def test_sampling(self):
+        """ categories are sampled by rate """
+        self.assertEqual(
+            parse_rates('data=0.5, heartbeat=0,bad=1,monitor=2'),
+            {'data': 0.5, 'heartbeat': 0})
+        stream = BytesIO()
+        pipeline = LogPipeline(stream=stream, rates={'data': 0.5})
+        randoms = iter([0.2, 0.7])
+        pipeline.random = lambda: next(randoms)
+        for msg in ('kept', 'sampled out'):
+            pipeline(event(msg, category='data'))
+        pipeline(event('other'))
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].endswith('[test] kept'))
+        self.assertEqual(pipeline.sampled, 1)
+
+    def test_rotation(self):
+        """ log files are rotated by size and age """
+        pipeline = LogPipeline(filename=self.filename, maxbytes=100,
+                               backups=2)
+        for num in range(4):
+            pipeline(event('x' * 60))
+        self.assertEqual(pipeline.rotations, 3)
+        self.assertEqual(len(self.read_lines()), 1)
+        self.assertTrue(os.path.exists('{}.2'.format(self.filename)))
+        self.assertFalse(os.path.exists('{}.3'.format(self.filename)))
+
+        pipeline.maxage = 60
+        pipeline.opened -= 60
+        pipeline(event('new day'))
+        self.assertEqual(pipeline.rotations, 4)
+        self.assertTrue(self.read_lines()[0].endswith('new day'))
+        # Existing logs are appended to.
+        pipeline.fileobj.close()
+        LogPipeline(filename=self.filename)(event('appended'))
+        self.assertEqual(len(self.read_lines()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
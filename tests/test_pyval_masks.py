@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Mask Registry
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyval_masks import MaskRegistry, normalize_mask
+
+
+class TestMaskRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'masks.lst')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_lines(self):
+        with open(self.filename) as f:
+            return f.read().splitlines()
+
+    def test_normalize(self):
+        """ masks are lowercased and filled in """
+        self.assertEqual(normalize_mask('Nick'), 'nick')
+        self.assertEqual(normalize_mask('@Host.com'), '*!*@host.com')
+        self.assertEqual(normalize_mask('nick!user'), 'nick!user@*')
+        self.assertEqual(normalize_mask('nick@host'), 'nick!*@host')
+
+    def test_match(self):
+        """ nicks, exact masks, hosts, and wildcards match """
+        registry = MaskRegistry()
+        for mask in (
+                'BadNick',
+                'exact!user@host.com',
+                '*!*@evil.example.com',
+                'spam*!*@*',
+                '*!*@*.proxy.net',
+                'any?ne'):
+            self.assertTrue(registry.add(mask))
+        self.assertFalse(registry.add('badnick'))
+        self.assertEqual(len(registry), 6)
+        self.assertEqual(len(registry.masks_wild), 3)
+
+        for user in (
+                'badnick',
+                'BADNICK!someone@anywhere',
+                'exact!user@host.com',
+                'newnick!ident@evil.example.com',
+                'spammer',
+                'spammer!u@h',
+                'x!y@node1.proxy.net',
+                'anyone'):
+            self.assertIn(user, registry)
+        for user in (
+                'goodnick',
+                'exact',
+                'exact!other@host.com',
+                'nick!ident@example.com',
+                'x!y@proxy.net',
+                'nick!*@*',
+                None):
+            self.assertNotIn(user, registry)
+
+        self.assertTrue(registry.remove('SPAM*!*@*'))
+        self.assertFalse(registry.remove('spam*!*@*'))
+        self.assertNotIn('spammer', registry)
+        self.assertEqual(registry.nicks(), set(['badnick', 'exact']))
+
+    def test_journal(self):
+        """ changes are journaled, old plain lists load, compaction works """
+        with open(self.filename, 'w') as f:
+            f.write('oldnick\nother\n')
+        registry = MaskRegistry(self.filename, defaults=('unused',))
+        self.assertEqual(list(registry), ['oldnick', 'other'])
+
+        registry.add('*!*@host.com')
+        registry.remove('other')
+        self.assertEqual(
+            self.read_lines(),
+            ['oldnick', 'other', '+*!*@host.com', '-other'])
+        self.assertEqual(
+            list(MaskRegistry(self.filename)),
+            ['*!*@host.com', 'oldnick'])
+
+        # A long journal is replaced with the current entries.
+        registry.compact_min = 2
+        for _ in range(3):
+            registry.add('flip')
+            registry.remove('flip')
+        self.assertTrue(len(self.read_lines()) < 6)
+        self.assertEqual(
+            list(MaskRegistry(self.filename)),
+            ['*!*@host.com', 'oldnick'])
+        self.assertFalse(os.path.exists('{}.tmp'.format(self.filename)))
+
+        # Defaults are used without a file, and aren't saved.
+        os.remove(self.filename)
+        registry = MaskRegistry(self.filename, defaults=('admin',))
+        self.assertIn('admin', registry)
+        self.assertFalse(os.path.exists(self.filename))
+
+
+if __name__ == '__main__':
+    unittest.main()
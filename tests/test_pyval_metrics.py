@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Metrics
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+
+from pyval_metrics import (
+    REACTOR_LAG,
+    MetricsRegistry,
+    ReactorLag,
+    listen_metrics,
+)
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter(self):
+        """ counters are rendered per label """
+        counter = self.registry.counter(
+            'test_total',
+            'Test counter.',
+            labels=('result',))
+        counter.inc(result='hit')
+        counter.inc(2, result='miss')
+        counter.inc(result='hit')
+        self.assertEqual(counter.get(result='hit'), 2)
+        self.assertRaises(ValueError, counter.inc)
+        self.assertRaises(
+            ValueError,
+            self.registry.counter,
+            'test_total',
+            'Again.')
+        self.assertEqual(
+            self.registry.render(),
+            '\n'.join((
+                '# HELP test_total Test counter.',
+                '# TYPE test_total counter',
+                'test_total{result="hit"} 2',
+                'test_total{result="miss"} 2',
+                '',
+            )))
+
+    def test_gauge(self):
+        """ gauges can be set, or read from a function """
+        gauge = self.registry.gauge('test_gauge', 'Test gauge.')
+        gauge.set(1.5)
+        self.assertIn('test_gauge 1.5\n', self.registry.render())
+        gauge.set_function(lambda: 7)
+        self.assertEqual(gauge.get(), 7)
+        self.assertIn('test_gauge 7\n', self.registry.render())
+
+    def test_histogram(self):
+        """ histograms count cumulative buckets, a sum, and a count """
+        hist = self.registry.histogram(
+            'test_seconds',
+            'Test histogram.',
+            labels=('stage',),
+            buckets=(0.1, 1))
+        for value in (0.05, 0.5, 0.5, 5):
+            hist.observe(value, stage='run')
+        self.assertEqual(hist.get_count(stage='run'), 4)
+        self.assertEqual(hist.get_count(stage='spawn'), 0)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'test_seconds_bucket{stage="run",le="0.1"} 1',
+            'test_seconds_bucket{stage="run",le="1"} 3',
+            'test_seconds_bucket{stage="run",le="+Inf"} 4',
+            'test_seconds_sum{stage="run"} 6.05',
+            'test_seconds_count{stage="run"} 4',
+        ])
+
+    def test_reactor_lag(self):
+        """ the reactor lag is how late a timed call runs """
+        clock = task.Clock()
+        lag = ReactorLag(clock, interval=1)
+        lag.start()
+        clock.advance(1.25)
+        self.assertEqual(REACTOR_LAG.get(), 0.25)
+        lag.stop()
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.registry.counter('test_total', 'Test counter.').inc()
+        self.port = listen_metrics(reactor, 0, registry=self.registry)
+        self.baseurl = 'http://127.0.0.1:{}'.format(
+            self.port.getHost().port)
+
+    def tearDown(self):
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def get(self, path):
+        url = '{}{}'.format(self.baseurl, path).encode('ascii')
+        response = yield Agent(reactor).request(b'GET', url)
+        body = yield readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def test_serve(self):
+        """ metrics are served at /metrics """
+        code, body = yield self.get('/metrics')
+        self.assertEqual(code, 200)
+        self.assertIn(b'test_total 1\n', body)
+        code, body = yield self.get('/other')
+        self.assertEqual(code, 404)
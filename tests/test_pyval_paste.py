@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Paste Client
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import json
+
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from pyval_paste import CircuitBreaker, PasteClient
+
+
+class FakePasteSite(resource.Resource):
+
+    """ Stand-in for the paste api.
+        Each request uses the next behavior in `behaviors`:
+            'ok'     : Good response with a paste url.
+            'error'  : Json error response.
+            'fail'   : HTTP 500.
+            'hang'   : Never responds.
+    """
+
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        self.behaviors = []
+        # Posted paste data, and the connections they came in on.
+        self.posted = []
+        self.channels = set()
+
+    def render_POST(self, request):
+        self.posted.append(json.loads(request.content.read()))
+        self.channels.add(id(request.channel))
+        behavior = self.behaviors.pop(0) if self.behaviors else 'ok'
+        if behavior == 'fail':
+            request.setResponseCode(500)
+            return b'Internal Server Error'
+        if behavior == 'hang':
+            return server.NOT_DONE_YET
+        if behavior == 'error':
+            resp = {'status': 'error', 'message': 'too many pastes'}
+        else:
+            resp = {
+                'status': 'ok',
+                'url': '/paste/?id={}'.format(len(self.posted))
+            }
+        request.setHeader(b'Content-Type', b'application/json')
+        return json.dumps(resp).encode('utf-8')
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_breaker(self):
+        """ circuit opens after failures, and a trial call closes it """
+        clock = task.Clock()
+        breaker = CircuitBreaker(clock, threshold=2, reset=30)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.status(), 'open (retry in 30s)')
+
+        # One trial call after the reset time, it fails.
+        clock.advance(30)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, breaker.opened)
+        self.assertEqual(breaker.opens, 2)
+
+        # The next trial works.
+        clock.advance(30)
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.status(), 'closed')
+
+
+class TestPasteClient(unittest.TestCase):
+
+    def setUp(self):
+        self.site = FakePasteSite()
+        self.port = reactor.listenTCP(
+            0,
+            server.Site(self.site),
+            interface='127.0.0.1')
+        self.url = 'http://127.0.0.1:{}/paste/api/submit'.format(
+            self.port.getHost().port)
+        self.client = PasteClient(
+            reactor,
+            url=self.url,
+            read_timeout=0.5,
+            retries=1,
+            retry_delay=0.01)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        # Timed out requests were aborted by the client.
+        yield self.client.close()
+        yield self.port.stopListening()
+
+    def paste(self):
+        return self.client.paste({'author': 'test', 'content': 'content'})
+
+    @defer.inlineCallbacks
+    def test_paste(self):
+        """ pastes give a url, over one pooled connection """
+        url = yield self.paste()
+        self.assertEqual(
+            url,
+            self.url.replace('/paste/api/submit', '/paste/?id=1'))
+        url = yield self.paste()
+        self.assertTrue(url.endswith('/paste/?id=2'))
+        self.assertEqual(self.site.posted[0]['content'], 'content')
+        self.assertEqual(len(self.site.channels), 1)
+
+        # Error responses give no url, and aren't retried.
+        self.site.behaviors = ['error']
+        url = yield self.paste()
+        self.assertIsNone(url)
+        self.assertEqual(len(self.site.posted), 3)
+        self.assertEqual(self.client.breaker.failures, 0)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        """ only requests that couldn't connect are retried """
+        # The paste may have been made, so server errors aren't retried.
+        self.site.behaviors = ['fail', 'ok']
+        url = yield self.paste()
+        self.assertIsNone(url)
+        self.assertEqual(len(self.site.posted), 1)
+        self.assertEqual(self.client.retried, 0)
+
+        # Nothing is listening on this port.
+        port = reactor.listenTCP(0, server.Site(self.site))
+        portnum = port.getHost().port
+        yield port.stopListening()
+        self.client.url = 'http://127.0.0.1:{}/paste/api/submit'.format(
+            portnum)
+        url = yield self.paste()
+        self.assertIsNone(url)
+        self.assertEqual(self.client.retried, 1)
+        self.assertEqual(self.client.failed, 2)
+
+    @defer.inlineCallbacks
+    def test_circuit(self):
+        """ timeouts open the circuit, then pastes are skipped """
+        self.site.behaviors = ['hang', 'fail', 'fail']
+        for _ in range(3):
+            url = yield self.paste()
+            self.assertIsNone(url)
+        self.assertEqual(self.client.failed, 3)
+        self.assertEqual(len(self.site.posted), 3)
+        self.assertEqual(self.client.retried, 0)
+        self.assertEqual(self.client.breaker.state, 'open')
+
+        # No request is made while the circuit is open.
+        url = yield self.paste()
+        self.assertIsNone(url)
+        self.assertEqual(len(self.site.posted), 3)
+        self.assertEqual(self.client.skipped, 1)
+        self.assertIn('circuit: open', self.client.status())
+
+
+if __name__ == '__main__':
+    unittest.main()
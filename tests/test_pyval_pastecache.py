@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Paste Cache
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from pyval_pastecache import PasteCache, paste_key
+
+
+class TestPasteCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'pastes.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lru(self):
+        """ least recently used urls are dropped first """
+        cache = PasteCache(maxsize=3)
+        for i in range(3):
+            cache.put(str(i), 'url{}'.format(i))
+        self.assertEqual(cache.get('0'), 'url0')
+        cache.put('3', 'url3')
+        self.assertNotIn('1', cache)
+        self.assertEqual(
+            [cache.get(key) for key in ('0', '2', '3')],
+            ['url0', 'url2', 'url3'])
+        self.assertEqual(cache.get('1'), None)
+        self.assertEqual((cache.hits, cache.misses), (4, 1))
+
+    def test_ttl(self):
+        """ urls expire """
+        cache = PasteCache(ttl=60)
+        key = paste_key('content')
+        self.assertEqual(key, paste_key(u'content'))
+        cache.put(key, 'url', now=1000)
+        self.assertEqual(cache.get(key, now=1059), 'url')
+        self.assertIsNone(cache.get(key, now=1060))
+        self.assertEqual(len(cache), 0)
+
+        cache.put('old', 'url', now=1000)
+        cache.put('new', 'url', now=1030)
+        self.assertEqual(cache.expire(now=1060), 1)
+        self.assertEqual(list(cache.entries), ['new'])
+
+    def test_persist(self):
+        """ the cache is saved and loaded, without expired urls """
+        cache = PasteCache(self.filename, maxsize=2)
+        cache.put('expired', 'url0', now=time.time() - 86400)
+        cache.put('a', 'url1')
+        cache.put('b', 'url2')
+        self.assertFalse(os.path.exists('{}.tmp'.format(self.filename)))
+
+        loaded = PasteCache(self.filename, maxsize=2)
+        self.assertEqual(list(loaded.entries), ['a', 'b'])
+        self.assertEqual(loaded.get('b'), 'url2')
+        # A smaller cache keeps the most recently used urls.
+        self.assertEqual(
+            list(PasteCache(self.filename, maxsize=1).entries),
+            ['b'])
+
+        with open(self.filename, 'w') as f:
+            f.write('not json')
+        self.assertEqual(len(PasteCache(self.filename)), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
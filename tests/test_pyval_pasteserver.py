@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Paste Server
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+
+from pyval_pasteserver import LocalPaster, PasteStore, listen_pastes
+
+
+class TestPasteStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmpdir, 'pastes')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def add(self, store, content, now=1000):
+        keys = []
+        store.add(content, now=now).addCallback(keys.append)
+        return keys[0]
+
+    def test_store(self):
+        """ pastes are stored once, by content """
+        store = PasteStore(self.directory)
+        key = self.add(store, u'content ✓')
+        self.assertEqual(self.add(store, u'content ✓', now=1001), key)
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.get(key, now=1001),
+                         u'content ✓'.encode('utf-8'))
+        self.assertIsNone(store.get('../{}'.format(key)))
+        self.assertIsNone(store.get('0' * 16))
+
+        # Pastes are found again on startup.
+        self.assertEqual(list(PasteStore(self.directory).index), [key])
+
+    def test_limits(self):
+        """ big pastes are refused, old pastes are removed """
+        store = PasteStore(self.directory, maxbytes=25, maxsize=10, ttl=60)
+        self.assertIsNone(self.add(store, 'x' * 11))
+        self.assertEqual(store.refused, 1)
+
+        first = self.add(store, '1' * 10, now=1000)
+        second = self.add(store, '2' * 10, now=1010)
+        # Over the size limit, the oldest paste goes.
+        third = self.add(store, '3' * 10, now=1020)
+        self.assertEqual(list(store.index), [second, third])
+        self.assertFalse(os.path.exists(store.get_path(first)))
+        self.assertEqual(store.totalbytes, 20)
+
+        # Expired pastes are gone.
+        self.assertIsNone(store.get(second, now=1070))
+        self.assertEqual(store.get(third, now=1070), '3' * 10)
+        store.expire(now=1080)
+        self.assertEqual(len(store), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+
+class TestPasteServer(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = PasteStore(self.tmpdir)
+        self.port = listen_pastes(
+            reactor,
+            self.store,
+            0,
+            interface='127.0.0.1')
+        self.paster = LocalPaster(
+            self.store,
+            'http://127.0.0.1:{}/'.format(self.port.getHost().port))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        return self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def get(self, url):
+        response = yield Agent(reactor).request(b'GET', url)
+        body = yield readBody(response)
+        defer.returnValue((response.code, body))
+
+    @defer.inlineCallbacks
+    def test_serve(self):
+        """ pasted content is served """
+        url = yield self.paster.paste({'content': 'pasted content'})
+        self.assertTrue(url.startswith(self.paster.baseurl))
+        code, body = yield self.get(url)
+        self.assertEqual((code, body), (200, 'pasted content'))
+
+        code, body = yield self.get('{}/missing'.format(self.paster.baseurl))
+        self.assertEqual(code, 404)
+        self.assertIn('pastes: 1', self.paster.status())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - CPU Quotas
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from pyval_quota import CPUQuota
+
+
+class TestCPUQuota(unittest.TestCase):
+
+    def setUp(self):
+        self.quota = CPUQuota(limit=10, window=100)
+
+    def test_rolling_window(self):
+        """ usage expires after the window """
+        self.quota.add('nick', 6, now=0)
+        self.quota.add('nick', 5, now=50)
+        self.assertTrue(self.quota.is_over('nick', now=60))
+        self.assertEqual(self.quota.remaining('nick', now=60), 0)
+        # Dropping the first entry gets back under the limit.
+        self.assertEqual(self.quota.retry_after('nick', now=60), 41)
+
+        self.assertFalse(self.quota.is_over('nick', now=101))
+        self.assertEqual(self.quota.remaining('nick', now=101), 5)
+        # Idle keys are forgotten.
+        self.quota.prune(now=200)
+        self.assertEqual(self.quota.usage, {})
+
+    def test_keys_are_separate(self):
+        """ each key has its own budget """
+        self.quota.add('busy', 20, now=0)
+        self.assertTrue(self.quota.is_over('busy', now=1))
+        self.assertFalse(self.quota.is_over('calm', now=1))
+        self.assertEqual(self.quota.retry_after('calm', now=1), 0)
+        self.assertEqual(self.quota.top(now=1), [('busy', 20)])
+        # No key (private messages have no channel) is never recorded.
+        self.quota.add(None, 5, now=1)
+        self.assertNotIn(None, self.quota.usage)
+
+    def test_no_limit(self):
+        """ a limit of 0 tracks usage, but never cuts anyone off """
+        self.quota.limit = 0
+        self.quota.add('nick', 500, now=0)
+        self.assertFalse(self.quota.is_over('nick', now=1))
+        self.assertIsNone(self.quota.remaining('nick', now=1))
+        self.assertIn('no limit', self.quota.status('nick', now=1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Rate Limiter
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+from fractions import Fraction
+import random
+import unittest
+
+from pyval_ratelimit import RateLimiter
+
+
+class TokenBucket(object):
+
+    """ Plain token bucket, the model RateLimiter should match.
+        Tokens are exact fractions, so there is no float error.
+    """
+
+    def __init__(self, interval, burst):
+        self.interval = interval
+        self.burst = burst
+        self.buckets = {}
+
+    def allow(self, key, now):
+        tokens, last = self.buckets.get(key, (self.burst, now))
+        tokens = min(tokens + Fraction(now - last, self.interval),
+                     self.burst)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        """ a burst is allowed, then one command per interval """
+        limiter = RateLimiter(interval=3, burst=2)
+        self.assertTrue(limiter.allow('nick', now=0))
+        self.assertTrue(limiter.allow('nick', now=0))
+        self.assertFalse(limiter.allow('nick', now=0))
+        self.assertEqual(limiter.retry_after('nick', now=0), 3)
+        # Other nicks aren't affected.
+        self.assertTrue(limiter.allow('other', now=0))
+        self.assertFalse(limiter.allow('nick', now=2.9))
+        self.assertTrue(limiter.allow('nick', now=3))
+        self.assertFalse(limiter.allow('nick', now=3))
+
+    def test_expire(self):
+        """ idle nicks are forgotten """
+        limiter = RateLimiter(interval=3, burst=2)
+        for i in range(1000):
+            limiter.allow('nick{}'.format(i), now=i * 0.01)
+        # Only nicks from the last interval * burst seconds are kept.
+        self.assertEqual(len(limiter), 300)
+        limiter.allow('late', now=100)
+        self.assertEqual(list(limiter.tats), ['late'])
+
+    def test_random_properties(self):
+        """ random traffic: matches a token bucket, stays bounded """
+        rand = random.Random(4242)
+        for _ in range(50):
+            # Integer milliseconds, so float error doesn't matter.
+            interval = rand.choice((500, 1000, 3000))
+            burst = rand.randint(1, 4)
+            limiter = RateLimiter(interval=interval, burst=burst)
+            model = TokenBucket(interval, burst)
+            nicks = ['nick{}'.format(i) for i in range(rand.randint(1, 20))]
+            allowed = dict((nick, []) for nick in nicks)
+            now = 0
+            for _ in range(500):
+                now += rand.choice((0, 1, 10, 100, 500, 2000))
+                nick = rand.choice(nicks)
+                result = limiter.allow(nick, now=now)
+                self.assertEqual(
+                    result,
+                    model.allow(nick, now),
+                    msg='Differs from token bucket at {}ms'.format(now))
+                if result:
+                    allowed[nick].append(now)
+                # Everything kept was allowed in the last interval * burst
+                # seconds, so memory is bounded by the recent nicks.
+                for key in limiter.tats:
+                    self.assertTrue(
+                        allowed[key][-1] > now - (interval * burst))
+
+            # No nick gets more than burst commands at once, and every
+            # command after that needs another interval.
+            for times in allowed.values():
+                for extra in range(1, 4):
+                    count = burst + extra
+                    for i in range(len(times) - count + 1):
+                        window = times[i + count - 1] - times[i]
+                        self.assertTrue(window >= extra * interval)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Command Registry
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from pyval_commands import AdminHandler, CommandHandler
+from pyval_registry import (
+    COST_EVALUATION,
+    COST_INSTANT,
+    FLAG_HIDDEN,
+    CommandRegistry,
+    command)
+
+
+class FakeFuncs(object):
+
+    @command(args='<x>', desc='Do a thing.', aliases=('thing',))
+    def cmd_dothing(self, rest, nick=None):
+        return 'did {}'.format(rest)
+
+    @command(desc='Secret.', flags=(FLAG_HIDDEN,), cost=COST_EVALUATION)
+    def cmd_secret(self, rest, nick=None):
+        return 'secret'
+
+    def cmd_plain(self, rest, nick=None):
+        return 'plain'
+
+    @command(desc='Admin only.')
+    def admin_thing(self, rest, nick=None):
+        return 'admin thing'
+
+
+class TestCommandRegistry(unittest.TestCase):
+
+    def test_registry(self):
+        """ commands, aliases, roles, and flags are registered once """
+        registry = CommandRegistry(FakeFuncs())
+        cmd = registry.get('dothing')
+        self.assertIs(registry.get('THING'), cmd)
+        self.assertEqual(cmd('x', nick='nick'), 'did x')
+        self.assertEqual(cmd.cost, COST_INSTANT)
+        self.assertEqual(
+            cmd.help(cmdchar='!'),
+            '!dothing <x>: Do a thing. (also: thing)')
+        # Undecorated commands still work, without help.
+        self.assertEqual(registry.get('plain')(''), 'plain')
+        self.assertEqual(
+            registry.get('plain').help(),
+            '!plain: no help available.')
+
+        self.assertEqual(registry.get('secret').cost, COST_EVALUATION)
+        self.assertEqual(registry.names(), ['dothing', 'plain'])
+        self.assertEqual(registry.names(role='admin'), ['thing'])
+        # Roles have their own names.
+        self.assertEqual(registry.get('thing', role='user').name, 'dothing')
+        self.assertEqual(registry.get('thing', role='admin').role, 'admin')
+        self.assertIsNone(registry.get('secret', role='admin'))
+
+        with self.assertRaises(ValueError):
+            command(cost='expensive')
+
+    def test_pyval_commands(self):
+        """ pyval's own commands are all registered with help """
+        cmdhandler = CommandHandler(adminhandler=AdminHandler())
+        registry = cmdhandler.registry
+        for role in ('user', 'admin'):
+            for name in registry.names(role=role):
+                self.assertTrue(
+                    registry.get(name, role=role).desc,
+                    msg='No help for {} command: {}'.format(role, name))
+
+        python = registry.get('py')
+        self.assertEqual(python.name, 'python')
+        self.assertEqual(python.cost, COST_EVALUATION)
+        self.assertEqual(registry.get('id', role='admin').name, 'identify')
+        self.assertIsNone(registry.get('identify'))
+        self.assertIn('py', cmdhandler.commands.get_help(cmdname='python'))
+
+
+if __name__ == '__main__':
+    unittest.main()
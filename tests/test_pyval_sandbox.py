@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - PyValSandbox
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+
+    These run pyval_sandbox.py with the current python, without
+    pypy-sandbox. Each run is killed after a few seconds, so a broken
+    limit fails the test instead of hanging it.
+"""
+
+import os.path
+import subprocess
+import sys
+import threading
+import unittest
+
+from pyval_sandbox.pyval_sandbox import (
+    BoundedRepr,
+    SnippetTimer,
+    build_locals)
+
+SANDBOX_FILE = os.path.join(
+    os.path.split(os.path.split(os.path.abspath(__file__))[0])[0],
+    'pyval_sandbox',
+    'pyval_sandbox.py')
+
+
+def run_sandbox(source, args=None, timeout=10):
+    """ Run pyval_sandbox.py on some source.
+        Returns (output, timed_out).
+    """
+    cmdargs = [sys.executable, SANDBOX_FILE]
+    cmdargs.extend(args or [])
+    proc = subprocess.Popen(
+        cmdargs,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    killed = []
+
+    def kill():
+        killed.append(True)
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output, _ = proc.communicate(source.encode('utf-8'))
+    finally:
+        timer.cancel()
+    return output.decode('utf-8', 'replace'), bool(killed)
+
+
+class TestSandbox(unittest.TestCase):
+
+    def assert_budget_output(self, source, args, expected):
+        output, timedout = run_sandbox(source, args=args)
+        self.assertFalse(timedout, msg='Sandbox did not stop: {!r}'.format(
+            source))
+        self.assertIn(expected, output)
+        return output
+
+    def test_step_budget(self):
+        """ step budget stops runaway code """
+        self.assert_budget_output(
+            'while 1:\n    pass\n',
+            ['--steps=1000'],
+            'step budget exceeded (1000 steps)')
+
+        # Catching everything doesn't help.
+        for handler in ('except Exception:', 'except:'):
+            source = '\n'.join((
+                'n = 0',
+                'while n < 50:',
+                '    try:',
+                '        while 1:',
+                '            pass',
+                '    {}'.format(handler),
+                '        n += 1',
+                ''
+            ))
+            self.assert_budget_output(
+                source,
+                ['--steps=1000'],
+                'step budget exceeded')
+
+        # Code that fits in the budget runs normally.
+        output = self.assert_budget_output(
+            'x = [i for i in (1, 2, 3)]\nprint(x)\n',
+            ['--steps=1000'],
+            '[1, 2, 3]')
+        self.assertNotIn('step budget', output)
+
+    def test_output_limit(self):
+        """ output is cut off at the byte limit """
+        output = self.assert_budget_output(
+            "print('x' * 1000)\n",
+            ['--maxoutput=50'],
+            '(...output truncated at 50 bytes.)')
+        self.assertEqual(output.count('x'), 50)
+
+        # Catching the exception doesn't allow more output.
+        source = '\n'.join((
+            'n = 0',
+            'while n < 5:',
+            '    try:',
+            "        print('x' * 100)",
+            '    except:',
+            '        n += 1',
+            "print('after')",
+            ''
+        ))
+        output = self.assert_budget_output(
+            source,
+            ['--maxoutput=50'],
+            'output truncated')
+        self.assertEqual(output.count('x'), 50)
+        self.assertNotIn('after', output)
+
+    def test_bounded_repr(self):
+        """ bounded repr keeps small results, cuts big ones """
+        brepr = BoundedRepr(100)
+        for value in (
+                {3: 1, 1: 2, 'b': [1, (2,)]},
+                set([3, 1, 2]),
+                'abc',
+                (1,),
+                [[[[1]]]]):
+            self.assertEqual(brepr.repr(value), repr(value))
+
+        biglist = brepr.repr(list(range(10 ** 5)))
+        self.assertTrue(biglist.endswith(', ...]'), msg=biglist)
+        self.assertTrue(len(biglist) < 120, msg=biglist)
+        bigdict = brepr.repr(dict((i, i) for i in range(10 ** 4)))
+        self.assertTrue(bigdict.endswith(', ...}'), msg=bigdict)
+        self.assertTrue(len(bigdict) < 120, msg=bigdict)
+        self.assertEqual(len(brepr.repr('x' * 1000)), 100)
+
+    def test_displayhook(self):
+        """ interactive results use the bounded repr """
+        output = self.assert_budget_output(
+            '[0] * (10 ** 6)',
+            ['--maxoutput=200'],
+            ', ...]')
+        self.assertTrue(len(output) < 250, msg=output)
+        self.assertNotIn('truncated', output)
+
+    def test_lazy_modules(self):
+        """ whitelisted modules are imported on first use """
+        # Building the locals doesn't import anything.
+        evallocals = build_locals(['math', 'notarealmodule'])
+        self.assertEqual(
+            evallocals['modules'](),
+            'modules are: math, notarealmodule')
+        self.assertEqual(evallocals['math'].sqrt(4), 2)
+        with self.assertRaises(ImportError):
+            evallocals['notarealmodule'].anything
+
+        output = self.assert_budget_output(
+            'math.floor(2.5)',
+            ['--modules=math,json'],
+            '2')
+        self.assertNotIn('Error', output)
+        self.assert_budget_output(
+            'modules()',
+            ['--modules=math,json'],
+            'modules are: json, math')
+
+    def test_timeit(self):
+        """ timing mode reports per-loop stats inside the budget """
+        timer = SnippetTimer(budget=0.5)
+        number, times = timer.time_inner(
+            timer.make_inner('x = 1 + 1'),
+            0.5)
+        self.assertTrue(number > 1)
+        self.assertTrue(1 <= len(times) <= timer.repeats)
+        self.assertEqual(SnippetTimer.get_unit(0.0025), ('msec', 1e3))
+        self.assertEqual(SnippetTimer.get_unit(2.5e-8), ('nsec', 1e9))
+
+        output = self.assert_budget_output(
+            'x = 1 + 1 ;; x = [0] * 1000',
+            ['--time=1'],
+            'loops')
+        self.assertIn('[1]', output)
+        self.assertIn('min', output)
+        self.assertIn('median', output)
+        self.assertIn('stddev', output)
+        self.assertIn('[2] is', output)
+
+        # The step budget applies to timed snippets too.
+        self.assert_budget_output(
+            'while 1:\n    pass',
+            ['--time=1', '--steps=1000'],
+            'step budget exceeded (1000 steps)')
+
+        # Errors in a snippet are reported, without timing.
+        output = self.assert_budget_output(
+            'x = 1 ;; 1 / 0',
+            ['--time=1'],
+            'snippet 2: ZeroDivisionError')
+        self.assertNotIn('loops', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Send Queue
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from twisted.internet import task
+
+from pyval_sendq import SendQueue
+
+
+class TestSendQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.sendq = SendQueue(
+            lambda target, msg: self.sent.append((target, msg)),
+            self.clock,
+            rate=0.5,
+            burst=3,
+            maxlength=20)
+
+    def test_token_bucket(self):
+        """ bursts go out right away, then the rate applies """
+        for i in range(5):
+            self.sendq.add('#chan{}'.format(i), 'msg')
+        self.assertEqual(len(self.sent), 3)
+        self.assertEqual(self.sendq.depth(), 2)
+        # One token every 2 seconds.
+        self.clock.advance(1.9)
+        self.assertEqual(len(self.sent), 3)
+        self.clock.advance(0.1)
+        self.assertEqual(len(self.sent), 4)
+        self.clock.advance(2)
+        self.assertEqual(len(self.sent), 5)
+        self.assertEqual(self.sendq.depth(), 0)
+        self.assertEqual(self.sendq.queues, {})
+
+        stats = self.sendq.stats()
+        self.assertEqual(stats['sent'], 5)
+        self.assertEqual(stats['latency_max'], 4)
+        # An idle bucket fills back up, but not past the burst size.
+        self.clock.advance(100)
+        self.sendq._refill(self.clock.seconds())
+        self.assertEqual(self.sendq.tokens, 3)
+
+    def test_round_robin_merge(self):
+        """ targets take turns, short waiting replies are merged """
+        self.sendq.tokens = 0
+        for msg in ('a1', 'a2', 'a3'):
+            self.sendq.add('#a', msg)
+        self.sendq.add('#b', 'b1')
+        self.sendq.add('#a', 'x' * 20)
+        self.assertEqual(self.sent, [])
+
+        self.clock.advance(2)
+        self.assertEqual(self.sent, [('#a', 'a1 | a2 | a3')])
+        self.clock.advance(2)
+        self.assertEqual(self.sent[-1], ('#b', 'b1'))
+        # Too long to merge with anything, but still sent.
+        self.clock.advance(2)
+        self.assertEqual(self.sent[-1], ('#a', 'x' * 20))
+        self.assertEqual(self.sendq.merged, 2)
+        self.assertIn('sent: 3 (2 merged)', self.sendq.status())
+
+    def test_sent_callbacks(self):
+        """ sent callbacks fire when their message goes out, merged or not """
+        sent = []
+        self.sendq.tokens = 0
+        self.sendq.add('#a', 'a1', sent=lambda when: sent.append(('a1', when)))
+        self.sendq.add('#a', 'a2', sent=lambda when: sent.append(('a2', when)))
+        self.sendq.add('#a', 'a3')
+        self.assertEqual(sent, [])
+        self.clock.advance(2)
+        self.assertEqual(sent, [('a1', 2), ('a2', 2)])
+
+    def test_backoff(self):
+        """ flood warnings pause sending, repeated ones pause longer """
+        self.sendq.backoff(reason='test')
+        self.sendq.add('#chan', 'one')
+        self.assertEqual(self.sent, [])
+        # 2 second pause, then an empty bucket.
+        self.clock.advance(2)
+        self.assertEqual(self.sent, [])
+        self.clock.advance(2)
+        self.assertEqual(self.sent, [('#chan', 'one')])
+
+        self.sendq.backoff()
+        self.assertEqual(self.sendq.backoff_secs, 4)
+        self.sendq.backoff()
+        self.assertEqual(self.sendq.backoff_secs, 8)
+        # A quiet minute starts over at the minimum.
+        self.clock.advance(61)
+        self.sendq.backoff()
+        self.assertEqual(self.sendq.backoff_secs, 2)
+        self.assertEqual(self.sendq.backoffs, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
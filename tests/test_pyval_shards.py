@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Channel Sharding
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from pyval_shards import HashRing, ShardGroup
+
+
+class FakeClient(object):
+
+    """ Keeps the channels it was told to join/leave. """
+
+    def __init__(self):
+        self.channels = set()
+
+    def join(self, channel):
+        self.channels.add(channel)
+
+    def leave(self, channel):
+        self.channels.remove(channel)
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_consistent(self):
+        """ only keys from a removed node move """
+        ring = HashRing(['pyval', 'pyval1', 'pyval2'])
+        self.assertEqual(len(ring), 3)
+        keys = ['#chan{}'.format(i) for i in range(300)]
+        before = dict((key, ring.get(key)) for key in keys)
+        # Keys are spread over every node.
+        self.assertEqual(set(before.values()), set(['pyval', 'pyval1',
+                                                     'pyval2']))
+
+        ring.remove('pyval1')
+        self.assertNotIn('pyval1', ring)
+        for key in keys:
+            if before[key] != 'pyval1':
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertNotEqual(ring.get(key), 'pyval1')
+
+        ring.add('pyval1')
+        self.assertEqual(dict((key, ring.get(key)) for key in keys), before)
+        self.assertIsNone(HashRing().get('#chan'))
+
+
+class TestShardGroup(unittest.TestCase):
+
+    def setUp(self):
+        self.channels = ['#chan{}'.format(i) for i in range(30)]
+        self.group = ShardGroup(['pyval', 'pyval1'])
+        self.group.add_channels(self.channels)
+        self.clients = {'pyval': FakeClient(), 'pyval1': FakeClient()}
+
+    def test_rebalance(self):
+        """ channels are spread across clients, and move when one drops """
+        # Channels wait for their own client at startup.
+        self.group.add('pyval', self.clients['pyval'])
+        first = set(self.clients['pyval'].channels)
+        self.assertTrue(first)
+        self.assertNotEqual(first, set(self.channels))
+
+        self.group.add('pyval1', self.clients['pyval1'])
+        second = set(self.clients['pyval1'].channels)
+        self.assertTrue(second)
+        self.assertEqual(first | second, set(self.channels))
+        self.assertFalse(first & second)
+        self.assertEqual(self.group.moved, 0)
+        self.assertIn('connections: 2/2', self.group.status())
+
+        # A dropped client's channels go to the others, and come back.
+        self.group.remove('pyval1')
+        self.assertEqual(self.clients['pyval'].channels, set(self.channels))
+        self.assertEqual(self.group.moved, len(second))
+        self.assertIn('connections: 1/2', self.group.status())
+        self.group.add('pyval1', self.clients['pyval1'])
+        self.assertEqual(self.clients['pyval'].channels, first)
+        self.assertEqual(self.clients['pyval1'].channels, second)
+
+    def test_channels(self):
+        """ channels can be added and removed while connected """
+        for name, client in self.clients.items():
+            self.group.add(name, client)
+        self.group.add_channels(['#new'])
+        owner = self.group.owner('#new')
+        self.assertIn('#new', self.clients[owner].channels)
+        self.group.remove_channels(['#new'])
+        self.assertNotIn('#new', self.clients[owner].channels)
+        self.assertEqual(len(self.group.channels), len(self.channels))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Tracing
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer
+
+from pyval_trace import Tracer, percentile
+
+
+class TestTrace(unittest.TestCase):
+
+    def setUp(self):
+        self.tracer = Tracer(maxtraces=3)
+
+    def test_spans(self):
+        """ spans are recorded with start/end, wrap() ends a waiting span """
+        trace = self.tracer.new('python', nick='testuser', now=10)
+        self.assertEqual(trace.traceid, 1)
+        trace.start('queue', now=10)
+        self.assertIsNone(trace.end('parse'))
+
+        waiting = defer.Deferred()
+        d = trace.wrap(lambda rest: waiting, 'command', waited='queue')('x')
+        self.assertIn('command', trace.opened)
+        self.assertNotIn('queue', trace.opened)
+        results = []
+        d.addCallback(results.append)
+        waiting.callback('done')
+        self.assertEqual(results, ['done'])
+        self.assertEqual(
+            [span[0] for span in trace.spans],
+            ['queue', 'command'])
+
+        with trace.span('format'):
+            pass
+        self.tracer.finish(trace, now=12)
+        self.assertEqual(trace.durations()['total'], 2)
+        self.assertEqual(len(self.tracer), 1)
+
+    def test_ring_buffer(self):
+        """ only the most recent traces are kept """
+        for i in range(5):
+            trace = self.tracer.new('python', now=i)
+            trace.add('run', i, i + (i / 10.0))
+            self.tracer.finish(trace, now=i + 1)
+        self.assertEqual(
+            [trace.traceid for trace in self.tracer.traces],
+            [3, 4, 5])
+        pcts, count = self.tracer.percentiles('run', pcts=(50, 99))
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(pcts[0][1], 0.3)
+        self.assertAlmostEqual(pcts[1][1], 0.4)
+        latency = self.tracer.latency()
+        self.assertIn('run: 300/400/400 (n=3)', latency)
+        self.assertIn('total: 1000/1000/1000 (n=3)', latency)
+        self.assertNotIn('spawn', latency)
+
+    def test_percentile(self):
+        """ percentiles use the nearest rank """
+        self.assertIsNone(percentile([], 50))
+        values = list(range(101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile([1], 99), 1)
+
+    def test_dump(self):
+        """ traces are dumped in Chrome trace-event format """
+        trace = self.tracer.new('python', nick='testuser', now=1)
+        trace.add('run', 1, 1.5)
+        self.tracer.finish(trace, now=2)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'traces.json')
+            results = []
+            self.tracer.dump(filename).addCallback(results.append)
+            self.assertEqual(results, [filename])
+            with open(filename) as f:
+                events = json.load(f)['traceEvents']
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([event['name'] for event in events], ['run', 'total'])
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[0]['ts'], 1000000)
+        self.assertEqual(events[0]['dur'], 500000)
+        self.assertEqual(events[0]['tid'], 1)
+        self.assertEqual(events[0]['args'], {'nick': 'testuser'})
+
+
+if __name__ == '__main__':
+    unittest.main()
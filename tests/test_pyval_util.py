@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" PyVal - Tests - Utilities
+
+    These files are executable, so use `nosetests --exe`.
+    `py.test` will work, as will `python -m unittest`.
+"""
+
+import unittest
+
+from pyval_util import truncate_output
+
+
+class TestTruncateOutput(unittest.TestCase):
+
+    def test_no_limits(self):
+        """ truncate_output leaves output alone without limits """
+        for s in ('', 'abc', 'a\nb\n', '\n\n'):
+            self.assertEqual(truncate_output(s), s)
+        self.assertEqual(
+            truncate_output('a\nb', joiner='\\n'),
+            'a\\nb')
+
+    def test_maxlines(self):
+        """ truncate_output cuts lines, only when there are more """
+        self.assertEqual(
+            truncate_output('a\nb\nc', maxlines=2),
+            'a\nb\n(...truncated at 2 lines.)')
+        self.assertEqual(truncate_output('a\nb', maxlines=2), 'a\nb')
+        # A trailing newline is another (empty) line, like str.split().
+        self.assertEqual(
+            truncate_output('a\nb\n', maxlines=2),
+            'a\nb\n(...truncated at 2 lines.)')
+
+    def test_maxlinelength(self):
+        """ truncate_output cuts long lines, and keeps reading """
+        self.assertEqual(
+            truncate_output(
+                'abcdef\nxy\n123456',
+                maxlinelength=3,
+                line_marker='~{maxlinelength}'),
+            'abc~3\nxy\n123~3')
+
+    def test_maxlength(self):
+        """ truncate_output stops at the total length """
+        self.assertEqual(
+            truncate_output('x' * 50, maxlength=10),
+            'x' * 10 + ' (...truncated)')
+        # The joiner counts toward the total.
+        self.assertEqual(
+            truncate_output('abcdef\nxy\n123456', maxlength=9, joiner='\\n'),
+            'abcdef\\nx (...truncated)')
+        self.assertEqual(truncate_output('abc\nd', maxlength=5), 'abc\nd')
+        # No dangling joiner when the limit is hit at a separator.
+        self.assertEqual(
+            truncate_output('abc\ndef', maxlength=3, joiner='\\n'),
+            'abc (...truncated)')
+        # Consecutive separators don't add empty lines past the limit.
+        self.assertEqual(
+            truncate_output('abc' + '\n' * 1000, maxlength=3, joiner='\\n'),
+            'abc (...truncated)')
+
+    def test_sep(self):
+        """ truncate_output reads lines with other separators """
+        self.assertEqual(
+            truncate_output('a\\nb\\nc', maxlines=2, sep='\\n'),
+            'a\nb\n(...truncated at 2 lines.)')
+
+
+if __name__ == '__main__':
+    unittest.main()
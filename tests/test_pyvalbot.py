@@ -191,5 +191,52 @@ class TestImports(unittest.TestCase):
                                     curver=curver)
             self.fail(errmsg)
 
+
+class TestPrivmsg(unittest.TestCase):
+
+    """ Commands sent through PyValIRCProtocol.privmsg() are answered. """
+
+    def setUp(self):
+        # Imported here, so missing requirements are reported by
+        # TestImports instead of breaking this module.
+        from twisted.internet.task import Clock
+        import pyvalbot
+        from pyval_sendq import SendQueue
+
+        # Command-line args (docopt can't parse them with the usage string
+        # for the test runner's script name).
+        pyvalbot.MAIN_ARGD = {'--commandchar': '!'}
+        pyvalbot.CONFIGSNAP = None
+        self.protocol = pyvalbot.PyValIRCProtocol()
+        # Evaluate right away instead of in the reactor's thread pool.
+        self.protocol.commandhandler.commands.reactor = None
+        # Keep replies instead of sending them.
+        self.sent = []
+        self.clock = Clock()
+        self.protocol.admin.sendq = SendQueue(
+            lambda target, msg: self.sent.append((target, msg)),
+            self.clock)
+
+    def test_privmsg_python(self):
+        """ privmsg dispatches !py and sends the reply """
+        from pyval_exec import find_pypysandbox
+        if find_pypysandbox() is None:
+            self.skipTest('no pypy-sandbox executable found.')
+        self.protocol.privmsg('testuser!user@host', '#pyval', '!py 1 + 1')
+        self.clock.advance(1)
+        self.assertEqual(self.sent, [('#pyval', 'testuser, 2')])
+        self.assertEqual(self.protocol.admin.handled, 1)
+
+    def test_privmsg_version(self):
+        """ privmsg dispatches a command in a private message """
+        nick = self.protocol.nickname
+        self.protocol.privmsg('testuser!user@host', nick, '!version')
+        self.clock.advance(1)
+        self.assertEqual(len(self.sent), 1)
+        target, msg = self.sent[0]
+        self.assertEqual(target, 'testuser')
+        self.assertIn('python:', msg.lower())
+
+
 if __name__ == '__main__':
     unittest.main()